@@ -0,0 +1,357 @@
+"""
+Offline benchmark: drives Run.do_checks over synthetic catalogs against
+simulated sc / tasklist, msdb / NAV and HTTP backends and reports the timings
+as JSON so runs can be compared for regressions
+"""
+
+import os
+import sys
+import json
+import random
+import tempfile
+import tracemalloc
+from time import sleep, monotonic
+from typing import List
+from threading import Lock, Thread
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from database import ConnectionPool, set_pool
+from storage import SqliteStorage, sqlite_connect
+from service import WinServiceState, parse_sc_query
+from program import parse_tasklist
+from job import ObjectType, JQE_COLUMNS
+from breaker import CircuitBreaker
+from cache import MetadataCache
+from events import EventPublisher
+from log_writer import LogWriter
+from main import Run, Check, CheckType, CheckCategory
+
+SIZES = (100, 1000, 10000)
+CHECKS_PER_HOST = 5
+
+# the check type mix of the production catalog
+CHECK_MIX = {
+    CheckType.SERVICE: 0.52,
+    CheckType.URL: 0.22,
+    CheckType.SSIS: 0.14,
+    CheckType.JOB: 0.08,
+    CheckType.PROGRAM: 0.04,
+}
+
+@dataclass
+class RoundTrips:
+    """ Statements and commits sent to a database """
+    queries: int = 0
+    commits: int = 0
+
+    def __post_init__(self):
+        self.lock = Lock()
+
+    def query(self, n: int = 1) -> None:
+        with self.lock:
+            self.queries += n
+
+    def commit(self) -> None:
+        with self.lock:
+            self.commits += 1
+
+    def to_json(self) -> dict:
+        return {'queries': self.queries, 'commits': self.commits}
+
+class CountingCursor:
+    """ A DB-API cursor that counts the statements it executes """
+    def __init__(self, cursor, trips: RoundTrips):
+        self._cursor = cursor
+        self._trips = trips
+
+    def execute(self, sql: str, values=()):
+        self._trips.query()
+        self._cursor.execute(sql, values)
+        return self
+
+    def executemany(self, sql: str, rows):
+        self._trips.query()
+        self._cursor.executemany(sql, rows)
+        return self
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+class CountingConnection:
+    def __init__(self, connection, trips: RoundTrips):
+        self._connection = connection
+        self._trips = trips
+
+    def cursor(self) -> CountingCursor:
+        return CountingCursor(self._connection.cursor(), self._trips)
+
+    def commit(self) -> None:
+        self._trips.commit()
+        self._connection.commit()
+
+    def __getattr__(self, name: str):
+        return getattr(self._connection, name)
+
+class FakeSqlCursor:
+    """ Answers the msdb and NAV queries of ssis.py and job.py with every job
+        healthy, after latency seconds per statement.  Each job last ran when
+        its history was first read and has not run since. """
+    def __init__(self, trips: RoundTrips, latency: float, server: str = '', database: str = ''):
+        self.trips = trips
+        self.latency = latency
+        self.server = server
+        self.database = database
+        self.rows: List[tuple] = []
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql: str, values=()):
+        self.trips.query()
+        sleep(self.latency)
+        values = values if isinstance(values, (tuple, list)) else (values,)
+        self.rows = self.answer(sql, list(values))
+        self.rowcount = len(self.rows)
+        return self
+
+    def executemany(self, sql: str, rows):
+        self.trips.query()
+        sleep(self.latency)
+        return self
+
+    def answer(self, sql: str, values: list) -> List[tuple]:
+        now = datetime.now()
+        schedule = (1, 4, 1, 4, 15, 0)
+        history = (1, int(now.strftime('%Y%m%d')), int(now.strftime('%H%M%S')))
+        jqe_log = (now, 0, '', '', '', '')
+        if '[sysjobschedules]' in sql and 'VALUES' in sql:
+            return [(job_id, *schedule) for job_id in values]
+        if ('[sysjobhistory]' in sql or 'Job Queue Log Entry' in sql) and 'MAX(' in sql:
+            return [(max(host_check_ids(self.server)),)]
+        if '[sysjobhistory]' in sql and 'VALUES' in sql:
+            return [(key, int(key[:8], 16), key, *history) for key in values]
+        if 'Job Queue Log Entry' in sql and 'VALUES' in sql:
+            return [(object_id, description, object_id - 50000, object_id, description, *jqe_log)
+                    for object_id, description in zip(values[::2], values[1::2])]
+        if ('[sysjobhistory]' in sql or 'Job Queue Log Entry' in sql) and '> ?' in sql:
+            return []
+        if 'FROM [sysjobschedules] WHERE' in sql:
+            return [(1, values[0])]
+        if 'FROM [sysschedules]' in sql:
+            return [schedule]
+        if 'FROM [sysjobhistory]' in sql:
+            return [history]
+        if 'Job Queue Entry' in sql and 'VALUES' in sql:
+            triples = [values[i:i + 3] for i in range(0, len(values), 3)]
+            return [(object_id, description, fetch, now, 0,
+                     *(self.jqe_config(object_id, description) if fetch == 1 else (None,) * 12))
+                    for object_id, description, fetch in triples]
+        if 'Job Queue Entry' in sql:
+            config = self.jqe_config(values[0], values[1])
+            if sql.startswith(f'SELECT {JQE_COLUMNS}'):
+                return [(now, *config[:2], 0, *config[2:])]
+            return [(now, 0)]
+        return [(1,)]
+
+    def jqe_config(self, object_id: int, description: str) -> tuple:
+        return (ObjectType.codeunit.value, object_id, 15, '1', '1', '1', '1', '1', '0', '0', description, 'BENCH')
+
+    def fetchall(self) -> List[tuple]:
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self) -> tuple:
+        return self.rows.pop(0) if len(self.rows) > 0 else None
+
+    def fetchmany(self, size: int = 1) -> List[tuple]:
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self) -> None:
+        ...
+
+class FakeSqlConnection:
+    def __init__(self, trips: RoundTrips, latency: float, server: str = '', database: str = ''):
+        self.trips = trips
+        self.latency = latency
+        self.server = server
+        self.database = database
+
+    def cursor(self) -> FakeSqlCursor:
+        return FakeSqlCursor(self.trips, self.latency, self.server, self.database)
+
+    def commit(self) -> None:
+        self.trips.commit()
+
+    def rollback(self) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+class FakeWindows:
+    """ A command runner that answers sc query and tasklist for any host,
+        replaying recorded output (sc.txt, tasklist.csv in recordings) or
+        synthesized output after latency seconds per call """
+    def __init__(self, latency: float = 0.05, services: int = 150, processes: int = 80, recordings: str = ''):
+        self.latency = latency
+        self.calls = 0
+        self.lock = Lock()
+        if len(recordings) > 0:
+            with open(os.path.join(recordings, 'sc.txt'), 'r') as f:
+                self.sc_text = f.read()
+            with open(os.path.join(recordings, 'tasklist.csv'), 'r') as f:
+                self.tasklist_text = f.read()
+        else:
+            self.sc_text = ''.join(f'SERVICE_NAME: BenchSvc{i}\nDISPLAY_NAME: Bench Service {i}\n'
+                                   f'        TYPE               : 10  WIN32_OWN_PROCESS\n'
+                                   f'        STATE              : {1 if i % 20 == 19 else 4}  RUNNING\n'
+                                   f'        WIN32_EXIT_CODE    : 0  (0x0)\n\n' for i in range(services))
+            self.tasklist_text = ''.join(f'"bench{i % (processes // 2 or 1)}.exe","{1000 + i}","Services","0","10,000 K"\n'
+                                         for i in range(processes))
+        self.services = [s.name for s in parse_sc_query(self.sc_text).values()
+                         if s.state == WinServiceState.Running]
+        self.programs = sorted(parse_tasklist(self.tasklist_text))
+
+    def __call__(self, args: List[str]) -> str:
+        with self.lock:
+            self.calls += 1
+        sleep(self.latency)
+        if args[0] == 'sc':
+            return self.sc_text
+        elif args[0] == 'tasklist':
+            return self.tasklist_text
+        raise SystemError(f'Unsupported command: {args[0]}')
+
+class BenchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        sleep(self.server.delay)
+        body = b'<html><body>ok</body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        ...
+
+def start_http_servers(count: int, delay: float) -> List[ThreadingHTTPServer]:
+    """ Local HTTP servers that answer every GET after delay seconds, each on
+        its own loopback address so it counts as a separate host """
+    servers = []
+    for i in range(count):
+        server = ThreadingHTTPServer((f'127.0.{i // 250}.{i % 250 + 1}', 0), BenchHandler)
+        server.daemon_threads = True
+        server.delay = delay
+        Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+def host_check_ids(server: str) -> range:
+    """ The IDs of the checks make_catalog puts on a host """
+    first = int(server[len('BENCH'):]) * CHECKS_PER_HOST + 1
+    return range(first, first + CHECKS_PER_HOST)
+
+def job_id(check_id: int) -> str:
+    return f'{check_id:08X}-0000-0000-0000-000000000000'
+
+def make_catalog(size: int, windows: FakeWindows, addresses: List[tuple], seed: int = 0) -> List[Check]:
+    """ size synthetic checks in the production type mix, CHECKS_PER_HOST per host """
+    rng = random.Random(seed)
+    types, weights = list(CHECK_MIX), list(CHECK_MIX.values())
+    checks = []
+    for i in range(1, size + 1):
+        check_type = rng.choices(types, weights)[0]
+        server = f'BENCH{(i - 1) // CHECKS_PER_HOST:05d}'
+        check = Check(i, f'Bench check {i}', server, check_type, CheckCategory.NONE)
+        if check_type == CheckType.SERVICE:
+            check.service = rng.choice(windows.services)
+        elif check_type == CheckType.PROGRAM:
+            check.program = rng.choice(windows.programs)
+            check.instance_count = 1
+        elif check_type == CheckType.URL:
+            host, port = addresses[i % len(addresses)]
+            check.url = f'http://{host}:{port}/{server}/{i}'
+        elif check_type == CheckType.SSIS:
+            check.job_id = job_id(i)
+        elif check_type == CheckType.JOB:
+            check.database = f'NAV{i % 3}'
+            check.object_type = ObjectType.codeunit
+            check.object_id = 50000 + i
+        checks.append(check)
+    return checks
+
+def bench(checks: List[Check], windows: FakeWindows, sql_latency: float, workers: int, per_host: int,
+          async_urls: bool, batch: bool, cache: MetadataCache, path: str) -> dict:
+    """ Time one Run.do_checks over checks """
+    store_trips, remote_trips = RoundTrips(), RoundTrips()
+    storage = SqliteStorage(path, ConnectionPool(lambda s, n: CountingConnection(sqlite_connect(s, n), store_trips)))
+    set_pool(ConnectionPool(lambda s, n: FakeSqlConnection(remote_trips, sql_latency, s, n), max_size=workers))
+    store_trips.queries = store_trips.commits = 0
+    windows.calls = 0
+    tracemalloc.start()
+    start = monotonic()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        run = Run(checks, storage=storage, breaker=CircuitBreaker(), cache=cache, runner=windows,
+                  metrics_path=f'{path}.metrics.json', publisher=EventPublisher(''),
+                  writer=LogWriter(storage, journal=f'{path}.journal'), history_path='')
+        run.do_checks(workers, per_host, async_urls, batch)
+    wall = monotonic() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    storage.pool.close()
+    return {
+        'checks': len(checks),
+        'wall_secs': round(wall, 3),
+        'probes_per_sec': round(len(checks) / wall, 1),
+        'running': run.running,
+        'probes_saved': run.probes_saved,
+        'store_round_trips': store_trips.to_json(),
+        'remote_round_trips': remote_trips.to_json(),
+        'commands': windows.calls,
+        'peak_memory_bytes': peak,
+        'metadata_cache': run.cache_stats,
+    }
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark a run against simulated backends')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='catalog sizes to run')
+    parser.add_argument('--runs', type=int, default=1, help='runs per size; later runs see a warm metadata cache')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--per-host', type=int, default=2)
+    parser.add_argument('--sync-urls', action='store_true')
+    parser.add_argument('--no-batch', action='store_true')
+    parser.add_argument('--command-latency', type=float, default=0.05, help='seconds per sc / tasklist call')
+    parser.add_argument('--sql-latency', type=float, default=0.01, help='seconds per msdb / NAV statement')
+    parser.add_argument('--http-delay', type=float, default=0.02, help='seconds per HTTP response')
+    parser.add_argument('--http-hosts', type=int, default=8, help='local HTTP servers to spread URL checks over')
+    parser.add_argument('--recordings', default='', help='directory with recorded sc.txt and tasklist.csv')
+    parser.add_argument('--output', default='', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    windows = FakeWindows(args.command_latency, recordings=args.recordings)
+    servers = start_http_servers(args.http_hosts, args.http_delay)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            checks = make_catalog(size, windows, [s.server_address for s in servers])
+            cache = MetadataCache()
+            for i in range(args.runs):
+                result = bench(checks, windows, args.sql_latency, max(args.workers, 1), args.per_host,
+                               not args.sync_urls, not args.no_batch, cache, os.path.join(tmp, f'bench{size}.db'))
+                results.append({'run': i + 1, **result})
+                print(f'{size} checks, run {i + 1}: {result["wall_secs"]}s, {result["probes_per_sec"]} probes/sec',
+                      file=sys.stderr)
+    for server in servers:
+        server.shutdown()
+    report = {'config': vars(args), 'results': results}
+    if len(args.output) > 0:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+    else:
+        print(json.dumps(report, indent=4))
@@ -0,0 +1,180 @@
+"""
+Per-host circuit breaker so checks against an unreachable server fail fast
+"""
+
+import os
+import json
+import socket
+from typing import Callable, Dict, List
+from threading import Condition
+from dataclasses import dataclass, asdict
+from state import state_path, replace_file
+
+BREAKER_STATE = state_path('breaker_state.json')
+UNREACHABLE = -1
+
+# substrings of sc / tasklist / ODBC errors that mean no connection to the host could be made;
+# a query timeout or a full connection pool says nothing about the host
+CONNECT_ERRORS = ('1722', 'rpc server is unavailable', '1753', 'network path was not found',
+                  'network-related', 'server does not exist or access denied',
+                  'login timeout', 'communication link failure', 'host unreachable')
+# connection exceptions; a login timeout is HYT00 like a query timeout and is matched by its message
+CONNECT_SQLSTATES = ('08',)
+TIMEOUT_SQLSTATES = ('HYT00', 'HYT01')
+# seconds a probe waits for the half-open trial probe of its host
+TRIAL_WAIT = 60
+
+class HostUnreachable(Exception):
+    ...
+
+class TrialPending(HostUnreachable):
+    ...
+
+class BreakerState:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+@dataclass
+class HostHealth:
+    failures: int = 0
+    state: str = BreakerState.CLOSED
+    opened_run: int = 0
+    skipped: int = 0
+    trial_started: bool = False
+
+def is_connect_failure(error: Exception) -> bool:
+    """ True when an exception means the host could not be reached at all,
+        as opposed to e.g. a missing service or a bad query """
+    if isinstance(error, (HostUnreachable, ConnectionError, socket.gaierror)):
+        return True
+    args = [str(a) for a in getattr(error, 'args', ())]
+    if type(error).__name__ in ('OperationalError', 'InterfaceError') and len(args) > 0:
+        if args[0].startswith(CONNECT_SQLSTATES):
+            return True
+    text = ' '.join(args).lower()
+    return any(e in text for e in CONNECT_ERRORS)
+
+def is_timeout(error: Exception) -> bool:
+    """ True when a probe gave up waiting, for a pooled connection or for a
+        query, which leaves the check without a result but says nothing about
+        whether its host is up """
+    if isinstance(error, TimeoutError):
+        return True
+    args = [str(a) for a in getattr(error, 'args', ())]
+    return type(error).__name__ == 'OperationalError' and len(args) > 0 and args[0].startswith(TIMEOUT_SQLSTATES)
+
+class CircuitBreaker:
+    """ Opens a host's breaker after threshold consecutive connect failures.
+        While open every probe of the host fails fast with HostUnreachable.
+        cooldown_runs runs later the breaker goes half-open and lets a single
+        trial probe through: success closes it, failure opens it again.
+        Probes of the host that arrive while the trial is in flight wait up
+        to trial_wait seconds for its outcome, or with wait=False raise
+        TrialPending so the caller can probe them later. """
+    def __init__(self, threshold: int = 3, cooldown_runs: int = 1, path: str = '', trial_wait: float = TRIAL_WAIT):
+        self.threshold = threshold
+        self.cooldown_runs = cooldown_runs
+        self.path = path
+        self.hosts: Dict[str, HostHealth] = {}
+        self.trial_wait = trial_wait
+        self.run_id = 0
+        self.lock = Condition()
+
+    @classmethod
+    def load(cls, path: str = BREAKER_STATE, **kwargs) -> 'CircuitBreaker':
+        breaker = cls(path=path, **kwargs)
+        if len(path) > 0 and os.path.exists(path):
+            with open(path, 'r') as f:
+                breaker.hosts = {host: HostHealth(**health) for host, health in json.loads(f.read()).items()}
+        return breaker
+
+    def save(self) -> None:
+        if len(self.path) == 0:
+            return
+        replace_file(self.path, json.dumps(self.dump(), indent=4))
+
+    def dump(self) -> Dict[str, dict]:
+        with self.lock:
+            return {host: asdict(health) for host, health in self.hosts.items()}
+
+    def update(self, hosts: Dict[str, dict]) -> None:
+        """ Take the health of hosts probed by another process, as given by its dump() """
+        with self.lock:
+            for host, health in hosts.items():
+                self.hosts[host] = HostHealth(**health)
+            self.lock.notify_all()
+
+    def begin_run(self, run_id: int) -> None:
+        """ Reset per-run counters and move cooled-down hosts to half-open """
+        with self.lock:
+            self.run_id = run_id
+            for health in self.hosts.values():
+                health.skipped = 0
+                health.trial_started = False
+                if health.state == BreakerState.OPEN and run_id - health.opened_run >= self.cooldown_runs:
+                    health.state = BreakerState.HALF_OPEN
+
+    def allow(self, host: str, wait: bool = True) -> None:
+        """ Raise HostUnreachable if host's breaker is open """
+        with self.lock:
+            health = self.hosts.setdefault(host, HostHealth())
+            if health.state == BreakerState.HALF_OPEN and health.trial_started:
+                if not wait:
+                    raise TrialPending(f'{host} has a trial probe in flight')
+                self.lock.wait_for(lambda: health.state != BreakerState.HALF_OPEN or not health.trial_started,
+                                   self.trial_wait)
+            if health.state == BreakerState.CLOSED:
+                return
+            if health.state == BreakerState.HALF_OPEN and not health.trial_started:
+                health.trial_started = True
+                return
+            health.skipped += 1
+        raise HostUnreachable(f'{host} is unreachable (breaker {health.state})')
+
+    def success(self, host: str) -> None:
+        with self.lock:
+            health = self.hosts.setdefault(host, HostHealth())
+            health.failures = 0
+            health.state = BreakerState.CLOSED
+            self.lock.notify_all()
+
+    def failure(self, host: str) -> None:
+        with self.lock:
+            health = self.hosts.setdefault(host, HostHealth())
+            health.failures += 1
+            if health.state == BreakerState.HALF_OPEN or health.failures >= self.threshold:
+                if health.state != BreakerState.OPEN:
+                    health.opened_run = self.run_id
+                health.state = BreakerState.OPEN
+            self.lock.notify_all()
+
+    def release(self, host: str) -> None:
+        """ End a trial probe that neither reached nor failed to reach the host,
+            so the next probe becomes the trial """
+        with self.lock:
+            health = self.hosts.setdefault(host, HostHealth())
+            health.trial_started = False
+            self.lock.notify_all()
+
+    def call(self, host: str, fn: Callable, failed: Callable = None):
+        """ Run fn against host through the breaker.  Connect failures, and
+            results for which failed(result) is true, count against the host. """
+        self.allow(host)
+        try:
+            result = fn()
+        except BaseException as e:
+            if is_connect_failure(e):
+                self.failure(host)
+            else:
+                self.release(host)
+            raise
+        if failed is not None and failed(result):
+            self.failure(host)
+        else:
+            self.success(host)
+        return result
+
+    def open_hosts(self) -> List[str]:
+        with self.lock:
+            return sorted(host for host, health in self.hosts.items() if health.state != BreakerState.CLOSED)
@@ -0,0 +1,126 @@
+"""
+TTL cache for slowly changing metadata: SSIS schedules, service display
+names and NAV job queue configuration
+"""
+
+import os
+import json
+from time import time
+from typing import Any, Callable, Dict, Hashable
+from threading import Lock
+from collections import OrderedDict
+from dataclasses import dataclass
+from state import state_path, replace_file
+
+METADATA_CACHE = state_path('metadata_cache.json')
+
+# seconds each kind of metadata is trusted for
+DEFAULT_TTLS = {
+    'ssis_schedule': 60 * 60,
+    'minutes_between_runs': 24 * 60 * 60,
+    'service_display_name': 24 * 60 * 60,
+    'jqe_config': 15 * 60,
+}
+
+MISSING = object()
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evicted: int = 0
+
+class MetadataCache:
+    """ Size-bounded LRU cache with a TTL per kind of entry, optionally
+        persisted to a JSON file so a restarted runner starts warm """
+    def __init__(self, ttls: Dict[str, float] = None, max_entries: int = 10000, path: str = ''):
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self.path = path
+        self.entries: OrderedDict = OrderedDict()
+        self.stats: Dict[str, CacheStats] = {}
+        self.lock = Lock()
+
+    def get(self, kind: str, key: Hashable) -> Any:
+        """ The cached value, or MISSING """
+        with self.lock:
+            stats = self.stats.setdefault(kind, CacheStats())
+            entry = self.entries.get((kind, key))
+            if entry is None:
+                stats.misses += 1
+                return MISSING
+            value, expires = entry
+            if expires < time():
+                del self.entries[(kind, key)]
+                stats.expired += 1
+                stats.misses += 1
+                return MISSING
+            self.entries.move_to_end((kind, key))
+            stats.hits += 1
+            return value
+
+    def put(self, kind: str, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[(kind, key)] = (value, time() + self.ttls.get(kind, 0))
+            self.entries.move_to_end((kind, key))
+            while len(self.entries) > self.max_entries:
+                (evicted_kind, _), _ = self.entries.popitem(last=False)
+                self.stats.setdefault(evicted_kind, CacheStats()).evicted += 1
+
+    def get_or_load(self, kind: str, key: Hashable, load: Callable[[], Any]) -> Any:
+        value = self.get(kind, key)
+        if value is MISSING:
+            value = load()
+            self.put(kind, key, value)
+        return value
+
+    def take_stats(self) -> Dict[str, CacheStats]:
+        """ Return and reset the per-kind counters """
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+        return stats
+
+    def load(self) -> None:
+        if len(self.path) == 0 or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            self.merge(json.loads(f.read()))
+
+    def merge(self, data: list) -> None:
+        """ Add the unexpired entries of a dump(), keeping whichever copy of an entry expires last """
+        now = time()
+        with self.lock:
+            for kind, key, value, expires in data:
+                key = (kind, to_tuple(key))
+                if expires >= now and expires >= self.entries.get(key, (None, 0))[1]:
+                    self.entries[key] = (to_tuple(value), expires)
+
+    def dump(self) -> list:
+        with self.lock:
+            return [[kind, key, value, expires] for (kind, key), (value, expires) in self.entries.items()]
+
+    def save(self) -> None:
+        if len(self.path) == 0:
+            return
+        replace_file(self.path, json.dumps(self.dump()))
+
+def to_tuple(value: Any) -> Any:
+    """ JSON turns tuples into lists; turn them back so they can be keys again """
+    if isinstance(value, list):
+        return tuple(to_tuple(v) for v in value)
+    return value
+
+def format_stats(stats: Dict[str, CacheStats]) -> str:
+    return ', '.join(f'{kind}: {s.hits} hits/{s.misses} misses' for kind, s in sorted(stats.items()))
+
+_cache: MetadataCache = None
+
+def get_cache() -> MetadataCache:
+    """ The process-wide metadata cache, loaded from METADATA_CACHE """
+    global _cache
+    if _cache is None:
+        _cache = MetadataCache(path=METADATA_CACHE)
+        _cache.load()
+    return _cache
@@ -0,0 +1,239 @@
+"""
+In-memory check catalog shared by the web server and the runner, indexed
+by server, check type, category and system
+"""
+
+import os
+import json
+import marshal
+from hashlib import sha256
+from typing import Dict, List
+from argparse import ArgumentParser
+from threading import RLock
+from time import monotonic
+from main import Run, Check, CheckType, CheckCategory, ObjectType, CHECK_TYPES, CHECK_CATEGORIES, interned, check_from_row, check_from_json
+from storage import Storage, get_storage
+from state import state_path
+
+CATALOG_SNAPSHOT = state_path('catalog_snapshot.bin')
+# bump when the compiled form of a check changes
+SNAPSHOT_VERSION = 2
+INDEXES = ('server', 'check_type', 'check_category', 'system')
+SELECTOR_KEYS = {'server': 'server', 'type': 'check_type', 'category': 'check_category', 'system': 'system'}
+FILLER_WORDS = {'all', 'every', 'the', 'check', 'checks', 'on', 'in', 'of', 'for'}
+
+# enum members by their position, as the snapshot stores them
+ENUMS = (list(CheckType), list(CheckCategory), list(ObjectType))
+
+def snapshot_row(check: Check) -> tuple:
+    return (check._id, check.name, check.server, ENUMS[0].index(check.check_type), ENUMS[1].index(check.check_category),
+            check.service, check.url, check.program, check.instance_count, check.database, check.company,
+            check.business_unit, check.system, check.job_id, ENUMS[2].index(check.object_type), check.object_id)
+
+def check_from_snapshot(row: tuple, enums: tuple = ENUMS) -> Check:
+    """ Rebuild a check written by snapshot_row, which was validated when it was compiled """
+    return Check(row[0], row[1], interned(row[2]), enums[0][row[3]], enums[1][row[4]], row[5], row[6], row[7], row[8],
+                 interned(row[9]), interned(row[10]), interned(row[11]), interned(row[12]), row[13], enums[2][row[14]], row[15])
+
+def index_key(value):
+    """ Servers and systems match case insensitively, and enums by their lower case name """
+    return value.lower() if isinstance(value, str) else getattr(value, 'name', '').lower()
+
+class CheckCatalog:
+    """ The [Check] table, or a checklist.json, loaded once and indexed by ID
+        and by INDEXES.  Writers update it in place after writing to storage,
+        and every change bumps version so pages can be revalidated without
+        touching storage.  With a snapshot_path the compiled checks are kept
+        on disk keyed by the checklist's hash or by storage's checks_marker(),
+        so a later load of unchanged checks neither reads the [Check] rows
+        nor parses and validates them. """
+    def __init__(self, storage: Storage = None, refresh_secs: float = 0, checklist_path: str = '',
+                 snapshot_path: str = ''):
+        self.storage = storage
+        self.refresh_secs = refresh_secs
+        self.checklist_path = checklist_path
+        self.snapshot_path = snapshot_path
+        self.checks: Dict[int, Check] = {}
+        self.ordered: List[Check] = []
+        self.indexes: Dict[str, Dict[object, List[Check]]] = {name: {} for name in INDEXES}
+        self.version = 0
+        self.loaded_at = None
+        self.lock = RLock()
+
+    def load(self) -> None:
+        """ (Re)load every check from the checklist or storage """
+        if len(self.checklist_path) > 0:
+            with open(self.checklist_path, 'rb') as f:
+                source = f.read()
+            compile_checks = lambda: [check_from_json(item) for item in json.loads(source)]
+        else:
+            storage = self.storage or get_storage()
+            # read before the rows, so a change made in between only costs another load
+            source = repr(storage.checks_marker()).encode() if len(self.snapshot_path) > 0 else b''
+            compile_checks = lambda: [check_from_row(row) for row in storage.select_checks()]
+        key = sha256(f'{SNAPSHOT_VERSION}:{",".join(Check.__slots__)}:'.encode() + source).hexdigest()
+        compiled = self.read_snapshot(key)
+        if compiled is not None:
+            checks = [check_from_snapshot(row) for row in compiled]
+        else:
+            checks = compile_checks()
+            self.write_snapshot(key, checks)
+        with self.lock:
+            self.checks = {c._id: c for c in checks}
+            self._changed_()
+            self.loaded_at = monotonic()
+
+    def ensure_loaded(self) -> None:
+        stale = self.loaded_at is None or (self.refresh_secs > 0 and monotonic() - self.loaded_at > self.refresh_secs)
+        if stale:
+            self.load()
+
+    def all(self) -> List[Check]:
+        self.ensure_loaded()
+        return self.ordered
+
+    def get(self, check_id: int) -> Check:
+        self.ensure_loaded()
+        return self.checks.get(check_id)
+
+    def select(self, **filters) -> List[Check]:
+        """ The checks, in ID order, whose server, check_type, check_category
+            and system match the filters given.  Only the smallest matching
+            index entry is scanned, so the cost follows the size of the
+            subset rather than of the catalog. """
+        self.ensure_loaded()
+        unknown = set(filters) - set(INDEXES)
+        if len(unknown) > 0:
+            raise KeyError(f'Cannot select checks by {", ".join(sorted(unknown))}')
+        keys = {name: index_key(value) for name, value in filters.items()}
+        if len(keys) == 0:
+            return list(self.ordered)
+        indexes = self.indexes
+        smallest = min((indexes[name].get(key, []) for name, key in keys.items()), key=len)
+        return [c for c in smallest if all(index_key(getattr(c, name)) == key for name, key in keys.items())]
+
+    def values(self, name: str) -> List:
+        """ The distinct values of an indexed field, lower case for strings """
+        self.ensure_loaded()
+        return list(self.indexes[name])
+
+    def upsert(self, check: Check) -> None:
+        self.ensure_loaded()
+        with self.lock:
+            self.checks[check._id] = check
+            self._changed_()
+
+    def delete(self, check_id: int) -> None:
+        self.ensure_loaded()
+        with self.lock:
+            self.checks.pop(check_id, None)
+            self._changed_()
+
+    def etag(self, *parts) -> str:
+        self.ensure_loaded()
+        return '-'.join(str(p) for p in ('catalog', id(self), self.version, *parts))
+
+    def read_snapshot(self, key: str) -> List[tuple]:
+        """ The compiled checks of the snapshot as snapshot_row tuples, if it was compiled from the same source """
+        if len(self.snapshot_path) == 0 or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot_key, rows = marshal.loads(f.read())
+        except (EOFError, ValueError, TypeError):
+            # written by another Python version, or cut short
+            return None
+        return rows if snapshot_key == key else None
+
+    def write_snapshot(self, key: str, checks: List[Check]) -> None:
+        if len(self.snapshot_path) == 0:
+            return
+        # marshal rather than pickle: it loads several times faster and cannot run code
+        with open(f'{self.snapshot_path}.tmp', 'wb') as f:
+            f.write(marshal.dumps((key, [snapshot_row(c) for c in checks])))
+        os.replace(f'{self.snapshot_path}.tmp', self.snapshot_path)
+
+    def _changed_(self) -> None:
+        ordered = sorted(self.checks.values(), key=lambda c: c._id)
+        indexes = {name: {} for name in INDEXES}
+        for check in ordered:
+            for name, index in indexes.items():
+                index.setdefault(index_key(getattr(check, name)), []).append(check)
+        self.ordered = ordered
+        self.indexes = indexes
+        self.version += 1
+
+_catalog: CheckCatalog = None
+
+def get_catalog() -> CheckCatalog:
+    global _catalog
+    if _catalog is None:
+        _catalog = CheckCatalog()
+    return _catalog
+
+def filter_value(name: str, value: str):
+    """ The select() value of a filter given as text """
+    if name == 'check_type':
+        if value.lower() not in CHECK_TYPES:
+            raise ValueError(f'{value!r} is not a check type')
+        return CHECK_TYPES[value.lower()]
+    if name == 'check_category':
+        if value.lower() not in CHECK_CATEGORIES:
+            raise ValueError(f'{value!r} is not a check category')
+        return CHECK_CATEGORIES[value.lower()]
+    return value.lower()
+
+def parse_selector(selector: str, catalog: CheckCatalog) -> dict:
+    """ The select() filters of a selector such as "all SQL14\\Prod checks",
+        "all EDI services" or "server:APP1 type:url".  A bare word is taken
+        as a check type when it is a plural one, else as a server, category,
+        check type or system, the first the catalog knows it as. """
+    catalog.ensure_loaded()
+    filters = {}
+    for word in selector.split():
+        key, colon, value = word.partition(':')
+        lower = word.lower()
+        if colon and key.lower() in SELECTOR_KEYS:
+            name = SELECTOR_KEYS[key.lower()]
+            value = filter_value(name, value)
+        elif lower in FILLER_WORDS:
+            continue
+        elif lower.endswith('s') and lower[:-1] in CHECK_TYPES:
+            name, value = 'check_type', CHECK_TYPES[lower[:-1]]
+        elif lower in catalog.indexes['server']:
+            name, value = 'server', lower
+        elif lower in CHECK_CATEGORIES:
+            name, value = 'check_category', CHECK_CATEGORIES[lower]
+        elif lower in CHECK_TYPES:
+            name, value = 'check_type', CHECK_TYPES[lower]
+        elif lower in catalog.indexes['system']:
+            name, value = 'system', lower
+        else:
+            raise ValueError(f'{word!r} is not a server, check type, category or system in the catalog')
+        if filters.get(name, value) != value:
+            raise ValueError(f'{selector!r} names more than one {name}')
+        filters[name] = value
+    return filters
+
+def select_checks(args) -> List[Check]:
+    """ The checks args.select picks, from args.checklist or [Check] """
+    catalog = CheckCatalog(checklist_path=args.checklist or '', snapshot_path=CATALOG_SNAPSHOT)
+    return catalog.select(**parse_selector(args.select or '', catalog))
+
+def run_checks(args) -> None:
+    """ Check and log the selected checks once """
+    run = Run(select_checks(args))
+    run.do_checks(args.workers, args.per_host, not args.sync_urls, not args.no_batch)
+    print(f'Metadata cache: {run.cache_stats}')
+    print(f'Probes saved: {run.probes_saved} of {len(run.checks)}')
+    print(f'Probes deferred: {run.probes_deferred} of {len(run.checks)}')
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='List the checks a selector picks')
+    parser.add_argument('select', nargs='?', default='', help='e.g. "all SQL14\\Prod checks" or "all EDI services"')
+    parser.add_argument('--checklist', help='read the checks from this checklist.json instead of [Check]')
+    args = parser.parse_args()
+    checks = select_checks(args)
+    for check in checks:
+        print(f'{check._id:>6}  {check.check_type.name:<8} {check.check_category.name:<10} {check.server:<20} {check.name}')
+    print(f'{len(checks)} checks')
@@ -0,0 +1,16 @@
+"""
+Runs Windows command line tools such as sc and tasklist
+"""
+
+import subprocess
+from typing import Callable, List
+
+CommandRunner = Callable[[List[str]], str]
+
+def run_command(args: List[str]) -> str:
+    """ Run a command and return its stdout, raising SystemError on failure """
+    output = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if output.returncode == 0:
+        return output.stdout.decode()
+    else:
+        raise SystemError(output.stdout.decode())
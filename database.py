@@ -2,22 +2,160 @@
 Simple sqlite3 wrapper
 """
 
-from pyodbc import Connection, Cursor, connect
+from typing import Callable, Dict, List, Tuple
+from threading import Condition
+from time import monotonic
 from dataclasses import dataclass, field
+from metrics import timed, round_trip, check_type_var
+try:
+    from pyodbc import Connection, Cursor, connect
+except ImportError:
+    # the pool also works with other DB-API drivers such as sqlite3
+    Connection = Cursor = object
+    connect = None
+
+def sql_server_connect(server: str, name: str) -> Connection:
+    """ Open a trusted connection to a SQL Server database """
+    return connect('Driver={SQL Server};'
+                   f'Server={server};'
+                   f'Database={name};'
+                   'Trusted_Connection=yes;')
+
+@dataclass
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    waits: int = 0
+    wait_secs: float = 0
+    evicted: int = 0
+    broken: int = 0
+
+class ConnectionPool:
+    """ Thread-safe pool of DB-API connections keyed by (server, database) """
+    def __init__(self, connect: Callable[[str, str], Connection] = sql_server_connect, max_size: int = 8,
+                 idle_timeout: float = 300, health_check_after: float = 30, acquire_timeout: float = 60):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.idle: Dict[Tuple[str, str], List[Tuple[Connection, float]]] = {}
+        self.in_use: Dict[Tuple[str, str], int] = {}
+        self.stats = PoolStats()
+        self.condition = Condition()
+
+    def acquire(self, server: str, name: str) -> Connection:
+        """ Check out a connection, opening one if the pool for this key is not full """
+        key = (server.lower(), name.lower())
+        start = monotonic()
+        conn = None
+        with self.condition:
+            while True:
+                self._evict_idle_()
+                idle = self.idle.get(key, [])
+                if len(idle) > 0:
+                    conn, last_used = idle.pop()
+                    break
+                if self.in_use.get(key, 0) < self.max_size:
+                    break
+                remaining = self.acquire_timeout - (monotonic() - start)
+                if remaining <= 0:
+                    raise TimeoutError(f'No free connection to {server}/{name} after {self.acquire_timeout}s')
+                self.condition.wait(remaining)
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+            waited = monotonic() - start
+            if waited > 0.001:
+                self.stats.waits += 1
+                self.stats.wait_secs += waited
+
+        if conn is not None and monotonic() - last_used > self.health_check_after and not self._healthy_(conn):
+            self._close_(conn)
+            conn = None
+            with self.condition:
+                self.stats.broken += 1
+        try:
+            if conn is None:
+                with timed(check_type_var.get(), server, 'connect'):
+                    conn = self.connect(server, name)
+                with self.condition:
+                    self.stats.misses += 1
+            else:
+                with self.condition:
+                    self.stats.hits += 1
+        except BaseException:
+            self._forget_(key)
+            raise
+        return conn
+
+    def release(self, conn: Connection, server: str, name: str, broken: bool = False) -> None:
+        """ Return a connection to the pool, or close it if it is broken """
+        key = (server.lower(), name.lower())
+        if broken:
+            self._close_(conn)
+            self._forget_(key)
+            return
+        with self.condition:
+            self.in_use[key] -= 1
+            self.idle.setdefault(key, []).append((conn, monotonic()))
+            self.condition.notify()
+
+    def close(self) -> None:
+        """ Close every idle connection """
+        with self.condition:
+            idle = [conn for conns in self.idle.values() for conn, _ in conns]
+            self.idle = {}
+        for conn in idle:
+            self._close_(conn)
+
+    def _forget_(self, key: Tuple[str, str]) -> None:
+        with self.condition:
+            self.in_use[key] -= 1
+            self.condition.notify()
+
+    def _evict_idle_(self) -> None:
+        now = monotonic()
+        for key, conns in self.idle.items():
+            fresh = [(conn, last_used) for conn, last_used in conns if now - last_used <= self.idle_timeout]
+            for conn, last_used in conns:
+                if now - last_used > self.idle_timeout:
+                    self._close_(conn)
+                    self.stats.evicted += 1
+            self.idle[key] = fresh
+
+    def _healthy_(self, conn: Connection) -> bool:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _close_(self, conn: Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+POOL = ConnectionPool()
+
+def set_pool(pool: ConnectionPool) -> None:
+    """ Replace the process-wide connection pool used by database_handler.Db """
+    global POOL
+    POOL = pool
 
 @dataclass
 class Database:
     """ Simple SQL Server wrapper """
     server: str
     name: str
-    connection: Connection = field(init=False)
+    connection: Connection = None
     cursor: Cursor = field(init=False)
 
     def __post_init__(self):
-        self.connection = connect('Driver={SQL Server};'
-                            f'Server={self.server};'
-                            f'Database={self.name};'
-                            'Trusted_Connection=yes;')
+        if self.connection is None:
+            self.connection = sql_server_connect(self.server, self.name)
         self.cursor = self.connection.cursor()
 
     def select(self, sql: str, values: tuple[str] = ()) -> Cursor:
@@ -27,24 +165,43 @@ class Database:
     def insert(self, sql: str, values: tuple[str] = ()) -> Cursor:
         """ Insert a record into a table """
         self._execute_(sql, values)
-        self.cursor.commit()
+        self.commit()
+        return self.cursor
+
+    def insert_many(self, sql: str, rows: list[tuple], commit: bool = True) -> Cursor:
+        """ Insert many records into a table with one parameter array """
+        if hasattr(self.cursor, 'fast_executemany'):
+            self.cursor.fast_executemany = True
+        round_trip(self.server, self.name)
+        with timed(check_type_var.get(), self.server, 'execute'):
+            self.cursor.executemany(sql, rows)
+        if commit:
+            self.commit()
         return self.cursor
 
-    def update(self, sql: str, values: tuple[str] = ()) -> Cursor:
+    def update(self, sql: str, values: tuple[str] = (), commit: bool = True) -> Cursor:
         """ Update a value on a record in a table """
         self._execute_(sql, values)
-        self.cursor.commit()
+        if commit:
+            self.commit()
         return self.cursor
 
     def delete(self, sql: str, values: tuple[str] = ()) -> Cursor:
         """ Delete a record from the table """
         self._execute_(sql, values)
-        self.cursor.commit()
+        self.commit()
         return self.cursor
 
+    def commit(self) -> None:
+        """ Commit the open transaction """
+        round_trip(self.server, self.name)
+        self.connection.commit()
+
     def _execute_(self, sql: str, values: tuple[str] = ()) -> Cursor:
         """ Execute a sql query """
-        self.cursor.execute(sql, values)
+        round_trip(self.server, self.name)
+        with timed(check_type_var.get(), self.server, 'execute'):
+            self.cursor.execute(sql, values)
         return self.cursor
 
 if __name__ == '__main__':
@@ -1,15 +1,28 @@
-from database import Database
+import database
+from database import Database, ConnectionPool
 
 class Db:
-    def __init__(self, server: str, name: str):
-        self.db = Database(server, name)
+    def __init__(self, server: str, name: str, pool: ConnectionPool = None):
+        self.pool = pool or database.POOL
+        connection = self.pool.acquire(server, name)
+        try:
+            self.db = Database(server, name, connection)
+        except Exception:
+            self.pool.release(connection, server, name, broken=True)
+            raise
 
     def __enter__(self):
         return self.db
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.db.cursor.close()
-        self.db.connection.close()
+        broken = False
+        try:
+            self.db.cursor.close()
+            if exc_type is not None:
+                self.db.connection.rollback()
+        except Exception:
+            broken = True
+        self.pool.release(self.db.connection, self.db.server, self.db.name, broken)
 
 if __name__ == '__main__':
     with Db('NKP8590', 'NKPSystemsCheck') as db:
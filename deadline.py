@@ -0,0 +1,222 @@
+"""
+Deadline-aware probing of scheduled jobs: a healthy SSIS or job queue result
+is reused until the earliest time, worked out from the job's schedule, at
+which its status could change.  Jobs that are not running get no deadline,
+so they are probed on every run.
+"""
+
+import os
+import json
+from enum import Enum
+from typing import Dict, Iterable, Tuple
+from threading import Lock
+from dataclasses import fields
+from datetime import date, time, datetime, timedelta
+from ssis import Ssis, FreqType, FreqSubdayType
+from job import JobQueueEntry, JobStatus
+from state import state_path, replace_file
+
+DEADLINE_STATE = state_path('deadline_state.json')
+# a job is probed at least this often, since it can also be started, stopped or edited by hand
+MAX_DEFER_MINUTES = 240
+# days searched for a schedule's next or last run, enough for a monthly schedule
+SCAN_DAYS = 62
+SUBDAY_SECONDS = {FreqSubdayType.Seconds: 1, FreqSubdayType.Minutes: 60, FreqSubdayType.Hours: 60 * 60}
+# NAV's blank date
+NAV_BLANK_DT = datetime(1753, 1, 1)
+
+def hhmmss(value: int) -> time:
+    """ An msdb HHMMSS integer as a time """
+    value = int(value)
+    return time(value // 10000, value // 100 % 100, value % 100)
+
+def runs_on(schedule: tuple, day: date) -> bool:
+    """ Whether an SSIS schedule may run on day.  Raises ValueError for
+        frequency types without a calendar. """
+    freq_type = FreqType(schedule[1])
+    if freq_type == FreqType.Daily:
+        # every freq_interval days counts from a start date not in the schedule tuple, so every day is the safe guess
+        return True
+    elif freq_type == FreqType.Weekly:
+        # freq_interval is a bitmask of weekdays: Sunday 1, Monday 2 ... Saturday 64
+        return schedule[2] & (1 << (day.isoweekday() % 7)) != 0
+    elif freq_type == FreqType.Monthly:
+        last_day = ((day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)).day
+        return day.day == min(schedule[2], last_day)
+    raise ValueError(f'Unsupported FreqType: {freq_type}')
+
+def subday_step(schedule: tuple) -> timedelta:
+    """ The time between runs within a day, or 0 for one run at the start time """
+    subday_type = FreqSubdayType(schedule[3])
+    if subday_type in (FreqSubdayType.At_Specified_Time, FreqSubdayType.Unspecified):
+        return timedelta(0)
+    return timedelta(seconds=SUBDAY_SECONDS[subday_type] * schedule[4])
+
+def next_slot(schedule: tuple, after: datetime) -> datetime:
+    """ The first scheduled run time after after, or None """
+    step = subday_step(schedule)
+    for offset in range(SCAN_DAYS):
+        day = after.date() + timedelta(days=offset)
+        if not runs_on(schedule, day):
+            continue
+        start = datetime.combine(day, hhmmss(schedule[5]))
+        if start > after:
+            return start
+        if step > timedelta(0):
+            slot = start + step * ((after - start) // step + 1)
+            if slot.date() == day:
+                return slot
+    return None
+
+def last_slot(schedule: tuple, at: datetime) -> datetime:
+    """ The last scheduled run time at or before at, or None """
+    step = subday_step(schedule)
+    for offset in range(SCAN_DAYS):
+        day = at.date() - timedelta(days=offset)
+        start = datetime.combine(day, hhmmss(schedule[5]))
+        if start > at or not runs_on(schedule, day):
+            continue
+        if step == timedelta(0):
+            return start
+        end = min(at, datetime.combine(day, time.max))
+        return start + step * ((end - start) // step)
+    return None
+
+def ssis_deadline(ssis: Ssis, schedule: tuple, now: datetime) -> datetime:
+    """ When a running SSIS job's status could next change: its next
+        scheduled run or the end of its run window, whichever is first.
+        None while a scheduled run has not reached the history yet. """
+    if not ssis.is_running:
+        return None
+    deadlines = [ssis.last_run_dt + timedelta(minutes=ssis.minutes_between_runs)]
+    if schedule[0] == 1:
+        try:
+            due = last_slot(schedule, now)
+            if due is not None and ssis.last_run_dt < due:
+                return None
+            deadlines.append(next_slot(schedule, now))
+        except ValueError:
+            return None
+    return min(d for d in deadlines if d is not None)
+
+def jqe_deadline(jqe: JobQueueEntry, now: datetime) -> datetime:
+    """ When a running job queue entry's status could next change: no sooner
+        than its Earliest Start Date_Time, nor than the next weekday it may
+        run on.  None while the entry is due or in process. """
+    if not jqe.is_running or jqe.status in (JobStatus.In_Process, JobStatus.Uninitialized):
+        return None
+    if jqe.status == JobStatus.Finished:
+        # a finished entry does not run again by itself
+        return datetime.max
+    bounds = []
+    if jqe.earliest_start_date_time > NAV_BLANK_DT:
+        # NAV stores UTC; should it be local time after all, the deadline only comes early
+        bounds.append(jqe.earliest_start_date_time + datetime.now().astimezone().utcoffset())
+    run_on = [jqe.run_on_mondays, jqe.run_on_tuesdays, jqe.run_on_wednesdays, jqe.run_on_thursdays,
+              jqe.run_on_fridays, jqe.run_on_saturdays, jqe.run_on_sundays]
+    if any(run_on) and not run_on[now.weekday()]:
+        offset = next(d for d in range(1, 8) if run_on[(now.weekday() + d) % 7])
+        bounds.append(datetime.combine(now.date() + timedelta(days=offset), time.min))
+    if len(bounds) == 0 or max(bounds) <= now:
+        return None
+    return max(bounds)
+
+def dump_result(result) -> dict:
+    """ A result's fields as JSON values """
+    data = {}
+    for f in fields(result):
+        if not f.repr:
+            continue
+        value = getattr(result, f.name)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Enum):
+            value = value.value
+        data[f.name] = value
+    return data
+
+def load_result(result_type: type, data: dict):
+    """ Rebuild a result saved by dump_result without probing """
+    types = {f.name: f.type for f in fields(result_type)}
+    values = {}
+    for name, value in data.items():
+        if types[name] is datetime and value is not None:
+            value = datetime.fromisoformat(value)
+        elif isinstance(types[name], type) and issubclass(types[name], Enum):
+            value = types[name](value)
+        values[name] = value
+    return result_type(**values, probe=False)
+
+class DeadlineBook:
+    """ The last healthy result of each scheduled job and the time until
+        which it holds, optionally persisted to a JSON file so the next run
+        of the runner can reuse it """
+    def __init__(self, max_defer_minutes: float = MAX_DEFER_MINUTES, path: str = ''):
+        self.max_defer = timedelta(minutes=max_defer_minutes)
+        self.path = path
+        self.entries: Dict[str, Tuple[datetime, dict]] = {}
+        self.lock = Lock()
+
+    @classmethod
+    def load(cls, path: str = DEADLINE_STATE, **kwargs) -> 'DeadlineBook':
+        book = cls(path=path, **kwargs)
+        if len(path) > 0 and os.path.exists(path):
+            with open(path, 'r') as f:
+                book.entries = {key: (datetime.fromisoformat(deadline), data)
+                                for key, (deadline, data) in json.loads(f.read()).items()}
+        return book
+
+    def save(self) -> None:
+        if len(self.path) == 0:
+            return
+        replace_file(self.path, json.dumps(self.dump()))
+
+    def dump(self) -> Dict[str, list]:
+        """ The entries whose deadline has not passed, as saved """
+        now = datetime.now()
+        with self.lock:
+            return {key: [deadline.isoformat(), result] for key, (deadline, result) in self.entries.items() if deadline > now}
+
+    def update(self, entries: Dict[str, list], keys: Iterable[str]) -> None:
+        """ Take the entries for keys from the dump() of a book kept by another
+            process, which forgot the keys it has no entry for """
+        with self.lock:
+            for key in keys:
+                if key in entries:
+                    deadline, result = entries[key]
+                    self.entries[key] = (datetime.fromisoformat(deadline), result)
+                else:
+                    self.entries.pop(key, None)
+
+    def reuse(self, key: str, result_type: type, now: datetime):
+        """ The saved result for key if its deadline has not passed, otherwise None """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+        return load_result(result_type, entry[1])
+
+    def observe(self, key: str, result, now: datetime, schedule: tuple = None) -> None:
+        """ Save a probed result with its deadline, or forget the key when the
+            result gives none """
+        if isinstance(result, Ssis):
+            deadline = ssis_deadline(result, schedule, now) if schedule is not None else None
+        elif isinstance(result, JobQueueEntry):
+            deadline = jqe_deadline(result, now)
+        else:
+            deadline = None
+        with self.lock:
+            if deadline is None or deadline <= now:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = (min(deadline, now + self.max_defer), dump_result(result))
+
+_deadline_book: DeadlineBook = None
+
+def get_deadline_book() -> DeadlineBook:
+    """ The process-wide deadline book, or None when every job is probed on every run """
+    return _deadline_book
+
+def set_deadline_book(book: DeadlineBook) -> None:
+    global _deadline_book
+    _deadline_book = book
@@ -0,0 +1,225 @@
+"""
+Change-only check logging: a check's log row is written only when its state
+differs from its last logged row or a keyframe is due.  The checks left out
+of a run are stored as ID ranges, from which the full per-run view of a log
+table is rebuilt for the web server and reports.
+"""
+
+from hashlib import sha1
+from bisect import bisect_right
+from typing import Dict, List, Tuple
+from threading import Lock
+from storage import Storage, LOG_TABLES, RUN_TABLE, LAST_STATE_TABLE, UNCHANGED_TABLE
+
+# a check is logged in full at least once every KEYFRAME_RUNS runs
+KEYFRAME_RUNS = 48
+
+def state_hash(state: tuple) -> str:
+    return sha1(repr(state).encode()).hexdigest()[:16]
+
+def encode_ids(ids: List[int]) -> str:
+    """ Sorted check IDs as ranges: 1-5,7,9-12 """
+    ranges = []
+    for check_id in sorted(set(ids)):
+        if len(ranges) > 0 and ranges[-1][1] == check_id - 1:
+            ranges[-1][1] = check_id
+        else:
+            ranges.append([check_id, check_id])
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+def decode_ids(text: str) -> List[int]:
+    ids = []
+    for part in (text or '').split(','):
+        if len(part) == 0:
+            continue
+        a, _, b = part.partition('-')
+        ids.extend(range(int(a), int(b or a) + 1))
+    return ids
+
+class DeltaLog:
+    """ The state and run of every check's last log row, shared by the runs
+        of a process so that overlapping daemon windows agree on it.  A row's
+        state is every column but the run, check and timing columns. """
+    def __init__(self, keyframe_runs: int = KEYFRAME_RUNS):
+        self.keyframe_runs = keyframe_runs
+        self.states: Dict[int, Tuple[str, int]] = None
+        self.stored = set()
+        # run id -> log -> [(check id, run id of the row it repeats)]
+        self.unchanged: Dict[int, Dict[str, List[Tuple[int, int]]]] = {}
+        # run id -> check id -> (state, run id)
+        self.changed: Dict[int, Dict[int, Tuple[str, int]]] = {}
+        self.lock = Lock()
+
+    def load(self, storage: Storage) -> None:
+        with self.lock:
+            if self.states is not None:
+                return
+            with storage.connect() as db:
+                rows = db.select(f'SELECT [Check ID], [State], [Logged Run ID] FROM {LAST_STATE_TABLE}').fetchall()
+            self.states = {row[0]: (row[1].strip(), row[2]) for row in rows}
+            self.stored = set(self.states)
+
+    def skip(self, log: str, values: tuple) -> bool:
+        """ Whether a log row may be left out.  values are the row's INSERT
+            values: Run ID and Check ID first, the timing columns last. """
+        run_id, check_id = values[0], values[1]
+        state = state_hash(values[2:-3])
+        with self.lock:
+            last = self.states.get(check_id)
+            if last is not None and last[0] == state and run_id - last[1] < self.keyframe_runs:
+                self.unchanged.setdefault(run_id, {}).setdefault(log, []).append((check_id, last[1]))
+                return True
+            self.states[check_id] = (state, run_id)
+            self.changed.setdefault(run_id, {})[check_id] = (state, run_id)
+            return False
+
+    def write(self, writer, run_id: int) -> None:
+        """ Queue the run's left out checks and new last states on writer, to
+            be flushed with the run's log rows """
+        with self.lock:
+            unchanged = self.unchanged.pop(run_id, {})
+            changed = self.changed.pop(run_id, {})
+            inserts = [c for c in changed if c not in self.stored]
+            self.stored.update(inserts)
+        for log, entries in unchanged.items():
+            writer.add(f'INSERT INTO {UNCHANGED_TABLE} ([Run ID],[Log],[Check IDs],[Base Run ID]) VALUES (?,?,?,?)',
+                       (run_id, log, encode_ids([c for c, _ in entries]), min(base for _, base in entries)))
+        for check_id in inserts:
+            writer.add(f'INSERT INTO {LAST_STATE_TABLE} ([Check ID],[State],[Logged Run ID]) VALUES (?,?,?)',
+                       (check_id, *changed.pop(check_id)))
+        for check_id, (state, logged_run_id) in changed.items():
+            # a later overlapping run may already have stored a newer row
+            writer.add(f'''UPDATE {LAST_STATE_TABLE} SET [State] = ?, [Logged Run ID] = ?
+                           WHERE [Check ID] = ? AND [Logged Run ID] <= ?''', (state, logged_run_id, check_id, logged_run_id))
+
+_delta_log: DeltaLog = None
+
+def get_delta_log() -> DeltaLog:
+    """ The process-wide delta log, or None when every row is logged """
+    return _delta_log
+
+def set_delta_log(delta_log: DeltaLog) -> None:
+    global _delta_log
+    _delta_log = delta_log
+
+# the key /api/logs pages a log table by
+PAGE_KEYS = ['[Run ID]', '[Check ID]', '[ID]']
+
+def left_out_rows(db, table: str, names: List[str], entries: List[tuple], check_id: int = None) -> List[tuple]:
+    """ A row for every check the runs of entries left out, each entry a
+        ([Run ID], [Check IDs], [Base Run ID], run start, run end) of the
+        unchanged table: a copy of the check's last logged row with the run's
+        ID and times and no duration.  A left out check whose last row was
+        already purged by retention is missing from the view. """
+    run_col, check_col = names.index('Run ID'), names.index('Check ID')
+    start_col, end_col, duration_col = names.index('Start DateTime'), names.index('End DateTime'), names.index('Duration (secs)')
+    left_out = {}
+    for run_id, ids, base, start_dt, end_dt in entries:
+        ids = [i for i in decode_ids(ids) if check_id is None or i == check_id]
+        if len(ids) > 0:
+            left_out[run_id] = (ids, base, start_dt, end_dt)
+    if len(left_out) == 0:
+        return []
+    wanted = {i for ids, _, _, _ in left_out.values() for i in ids}
+    where, args = ('AND [Check ID] = ?', (check_id,)) if check_id is not None else ('', ())
+    history: Dict[int, List[tuple]] = {}
+    for row in db.select(f'''SELECT * FROM {table} WHERE [Run ID] BETWEEN ? AND ? {where}
+                             ORDER BY [Run ID], [ID]''', (min(v[1] for v in left_out.values()), max(left_out), *args)).fetchall():
+        if row[check_col] in wanted:
+            history.setdefault(row[check_col], []).append(tuple(row))
+    logged_runs = {c: [r[run_col] for r in h] for c, h in history.items()}
+    rows = []
+    for run_id, (ids, _, start_dt, end_dt) in left_out.items():
+        for i in ids:
+            k = bisect_right(logged_runs.get(i, []), run_id)
+            # a daemon run that logged the check before leaving it out already has its row
+            if k == 0 or history[i][k - 1][run_col] == run_id:
+                continue
+            row = list(history[i][k - 1])
+            row[run_col] = run_id
+            row[start_col], row[end_col] = start_dt, end_dt
+            row[duration_col] = None
+            rows.append(tuple(row))
+    return rows
+
+def unchanged_sql(where: List[str], direction: str = 'ASC') -> str:
+    """ The unchanged table entries of a log matching where, with their run's times, in left_out_rows order """
+    return f'''SELECT u.[Run ID], u.[Check IDs], u.[Base Run ID], r.[Run Start DateTime], r.[Run End DateTime]
+               FROM {UNCHANGED_TABLE} u LEFT JOIN {RUN_TABLE} r ON r.[ID] = u.[Run ID]
+               WHERE u.[Log] = ? {"".join(f" AND {w}" for w in where)}
+               ORDER BY u.[Run ID] {direction}'''
+
+def read_runs(storage: Storage, log: str, first: int, last: int, check_id: int = None) -> Tuple[List[str], List[tuple]]:
+    """ The rows of a log table for the runs first to last in (Run ID,
+        Check ID, ID) order, with the rows of the checks they left out """
+    table = LOG_TABLES[log]
+    where, args = ('AND [Check ID] = ?', (check_id,)) if check_id is not None else ('', ())
+    with storage.connect() as db:
+        cursor = db.select(f'''SELECT * FROM {table} WHERE [Run ID] BETWEEN ? AND ? {where}
+                               ORDER BY [Run ID], [Check ID], [ID]''', (first, last, *args))
+        names = [d[0] for d in cursor.description]
+        rows = [tuple(row) for row in cursor.fetchall()]
+        entries = db.select(unchanged_sql(['u.[Run ID] BETWEEN ? AND ?']), (log, first, last)).fetchall()
+        rows += left_out_rows(db, table, names, entries, check_id)
+    keys = [names.index(k[1:-1]) for k in PAGE_KEYS]
+    rows.sort(key=lambda r: tuple(r[k] for k in keys))
+    return names, rows
+
+def rebuild_run(storage: Storage, log: str, run_id: int) -> Tuple[List[str], List[tuple]]:
+    """ Every row of a log table for one run, as if it had been logged in full """
+    return read_runs(storage, log, run_id, run_id)
+
+def read_page(storage: Storage, log: str, filters: dict = {}, after: tuple = None, descending: bool = True,
+              limit: int = 50) -> Tuple[List[str], List[tuple]]:
+    """ Storage.page over the rebuilt view of a log table: up to limit rows
+        in PAGE_KEYS order after the key values in after, filtered by
+        [Run ID], [Check ID] and [Is Running].  A log that no run left a
+        check out of is paged straight from its table. """
+    table = LOG_TABLES[log]
+    with storage.connect() as db:
+        if db.select(storage.limit(f'SELECT [Run ID] FROM {UNCHANGED_TABLE} WHERE [Log] = ?', 1), (log,)).fetchone() is not None:
+            return read_delta_page(storage, db, log, filters, after, descending, limit)
+    return storage.page(table, PAGE_KEYS, filters, after, descending, limit)
+
+def read_delta_page(storage: Storage, db, log: str, filters: dict, after: tuple, descending: bool,
+                    limit: int) -> Tuple[List[str], List[tuple]]:
+    """ read_page on one connection: the logged rows come from one filtered
+        keyset query, and the left out ones from the unchanged entries of the
+        runs that query leaves room for, limit + 1 runs at a time """
+    table = LOG_TABLES[log]
+    run_id, check_id, is_running = (filters.get(c) for c in ('[Run ID]', '[Check ID]', '[Is Running]'))
+    sql, values = storage.page_sql(table, PAGE_KEYS, filters, after, descending)
+    cursor = db.select(storage.limit(sql, limit), values)
+    names = [d[0] for d in cursor.description]
+    rows = [tuple(row) for row in cursor.fetchall()]
+    keys = [names.index(k[1:-1]) for k in PAGE_KEYS]
+    running_col = names.index('Is Running')
+    key = lambda r: tuple(r[k] for k in keys)
+    op, past, direction = ('<=', '>=', 'DESC') if descending else ('>=', '<=', 'ASC')
+    where, args = [], [log]
+    if run_id is not None:
+        where.append('u.[Run ID] = ?')
+        args.append(run_id)
+    if after is not None:
+        where.append(f'u.[Run ID] {op} ?')
+        args.append(after[0])
+    if len(rows) == limit:
+        # a left out row past the last logged one cannot make the page
+        where.append(f'u.[Run ID] {past} ?')
+        args.append(rows[-1][keys[0]])
+    left_out = []
+    while len(left_out) < limit:
+        entries = db.select(storage.limit(unchanged_sql(where, direction), limit + 1), tuple(args)).fetchall()
+        for row in left_out_rows(db, table, names, entries, check_id):
+            if after is not None and not (key(row) < after if descending else key(row) > after):
+                continue
+            if is_running is not None and row[running_col] != is_running:
+                continue
+            left_out.append(row)
+        if len(entries) <= limit:
+            break
+        # the runs past the ones just read
+        where.append(f'u.[Run ID] {op[0]} ?')
+        args.append(entries[-1][0])
+    rows = sorted(rows + left_out, key=key, reverse=descending)
+    return names, rows[:limit]
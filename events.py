@@ -0,0 +1,129 @@
+"""
+Live run progress: the runner publishes run and check events to the server,
+which fans them out to every subscribed browser over server-sent events
+"""
+
+import os
+import json
+import requests
+from time import monotonic, sleep
+from queue import Queue, Empty, Full
+from typing import List
+from threading import Lock, Thread
+from collections import deque
+
+# e.g. http://localhost:8008/api/events; runs publish no events unless it is set
+EVENTS_URL_ENV = 'SYSTEMS_CHECK_EVENTS_URL'
+REPLAY_SIZE = 20000
+SUBSCRIBER_QUEUE_SIZE = 1000
+PUBLISH_QUEUE_SIZE = 10000
+PUBLISH_BATCH = 200
+RETRY_SECS = 30
+
+class Subscriber:
+    def __init__(self, replay: List[dict], queue_size: int):
+        self.replay = replay
+        self.queue: Queue = Queue(queue_size)
+        self.dropped = False
+
+class EventHub:
+    """ Keeps the events of the current run for late subscribers and copies
+        each new event into every subscriber's bounded queue.  A subscriber
+        that falls queue_size events behind is disconnected; its browser
+        reconnects with Last-Event-ID and catches up from the replay. """
+    def __init__(self, replay_size: int = REPLAY_SIZE, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.replay = deque(maxlen=replay_size)
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.seq = 0
+        self.lock = Lock()
+
+    def publish(self, event: dict) -> None:
+        with self.lock:
+            self.seq += 1
+            event = {**event, 'seq': self.seq}
+            if event.get('type') == 'run_start':
+                self.replay.clear()
+            self.replay.append(event)
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.queue.put_nowait(event)
+                except Full:
+                    subscriber.dropped = True
+                    self.subscribers.discard(subscriber)
+
+    def subscribe(self, last_seq: int = 0) -> Subscriber:
+        """ Subscribe, replaying the current run's events after last_seq """
+        with self.lock:
+            if last_seq > self.seq:
+                # the id is from before this server restarted
+                last_seq = 0
+            subscriber = Subscriber([e for e in self.replay if e['seq'] > last_seq], self.queue_size)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+def format_sse(event: dict) -> str:
+    return f'id: {event["seq"]}\nevent: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+
+class EventPublisher:
+    """ Posts events to the server from a background thread so probes never
+        wait on it.  Events are dropped when the queue is full or the server
+        cannot be reached, and posting pauses RETRY_SECS after a failure. """
+    def __init__(self, url: str = ''):
+        self.url = url
+        self.queue: Queue = Queue(PUBLISH_QUEUE_SIZE)
+        self.down_until = 0
+        self.dropped = 0
+        self.thread = None
+        self.lock = Lock()
+
+    def publish(self, event: dict) -> None:
+        if len(self.url) == 0:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.send, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def send(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < PUBLISH_BATCH:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                if monotonic() < self.down_until:
+                    self.dropped += len(batch)
+                else:
+                    requests.post(self.url, json=batch, timeout=2)
+            except requests.exceptions.RequestException:
+                self.dropped += len(batch)
+                self.down_until = monotonic() + RETRY_SECS
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self, timeout: float = 5) -> None:
+        """ Wait up to timeout seconds for queued events to be sent """
+        deadline = monotonic() + timeout
+        while self.queue.unfinished_tasks > 0 and monotonic() < deadline:
+            sleep(0.05)
+
+_publisher: EventPublisher = None
+
+def get_publisher() -> EventPublisher:
+    """ The process-wide publisher, posting to SYSTEMS_CHECK_EVENTS_URL; publishing is off while it is unset """
+    global _publisher
+    if _publisher is None:
+        _publisher = EventPublisher(os.environ.get(EVENTS_URL_ENV, ''))
+    return _publisher
@@ -0,0 +1,58 @@
+"""
+Worker pool that runs checks concurrently while capping in-flight work per host
+"""
+
+from typing import Any, Callable, Dict, Hashable, Iterable, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+def run_parallel(items: Iterable[Any], fn: Callable[[Any], Any], key: Callable[[Any], Hashable],
+                 max_workers: int = 8, per_key: int = 2) -> List[Any]:
+    """ Call fn on every item using max_workers threads, never running more
+        than per_key items that share the same key at once.  Results are
+        returned in the order of items.  The first exception is re-raised
+        once the in-flight work has finished. """
+    items = list(items)
+    queues: Dict[Hashable, deque] = {}
+    for i, item in enumerate(items):
+        queues.setdefault(key(item), deque()).append(i)
+    # hosts with the most work start first so the slowest host sets the pace
+    order = sorted(queues, key=lambda k: len(queues[k]), reverse=True)
+
+    results: List[Any] = [None] * len(items)
+    in_flight: Dict[Future, tuple] = {}
+    counts: Dict[Hashable, int] = {k: 0 for k in order}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def fill() -> None:
+            for k in order:
+                queue = queues[k]
+                while queue and counts[k] < per_key and len(in_flight) < max_workers:
+                    i = queue.popleft()
+                    in_flight[pool.submit(fn, items[i])] = (k, i)
+                    counts[k] += 1
+
+        fill()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                k, i = in_flight.pop(future)
+                counts[k] -= 1
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+            if error is None:
+                fill()
+
+    if error is not None:
+        raise error
+    return results
+
+if __name__ == '__main__':
+    from time import sleep, perf_counter
+    start = perf_counter()
+    run_parallel(range(20), lambda i: sleep(0.1), lambda i: i % 4, max_workers=8, per_key=2)
+    print(f'{perf_counter() - start:.2f}s')
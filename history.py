@@ -0,0 +1,202 @@
+"""
+Incremental reads of job history tables: the latest run of every job on a
+server is kept in memory and only the rows past a high-water mark are
+fetched, so each new history row is read once however many checks look at it.
+The marks and latest rows are saved between runs, so a new process carries on
+from where the last one stopped.
+"""
+
+import os
+import json
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+from threading import Lock
+from database_handler import Db
+from state import state_path, replace_file, encode_value, decode_value
+
+HISTORY_STATE = state_path('history_state.json')
+# rows fetched per round trip while catching up on a history table
+BATCH_SIZE = 5000
+# jobs whose latest row is looked up per round trip on a cold start
+LOOKUP_SIZE = 500
+# seconds a refresh is trusted for, so the checks of one run share it
+REFRESH_SECS = 5
+
+def history_key(values: tuple) -> tuple:
+    """ Job key values compared the way SQL Server's default collation does:
+        case-insensitive and without trailing spaces """
+    return tuple(v.rstrip().lower() if isinstance(v, str) else v for v in values)
+
+class HistoryTail:
+    """ The latest row of each job in a history table whose rows are only
+        appended, keyed by the key columns and ordered by the mark column.
+        The first refresh without saved state only reads the highest mark;
+        a job's latest row at or below it is looked up with a TOP 1 query the
+        first time the job is asked for.  Later refreshes only read the rows
+        past the highest mark seen.  Rows for which unsettled(row) is true,
+        such as a run still in process, may still be updated in place and
+        are read again on each refresh while they are the latest. """
+    def __init__(self, server: str, database: str, table: str, mark: str, keys: List[str], columns: str,
+                 where: str = '', unsettled: Callable[[tuple], bool] = None,
+                 batch_size: int = BATCH_SIZE, refresh_secs: float = REFRESH_SECS):
+        self.server = server
+        self.database = database
+        self.table = table
+        self.mark_column = mark
+        self.keys = keys
+        self.columns = columns
+        self.where = where
+        self.unsettled = unsettled
+        self.batch_size = batch_size
+        self.refresh_secs = refresh_secs
+        self.mark: int = None
+        # key -> (mark, values), or (None, None) for a job with no rows up to the mark
+        self.latest: Dict[tuple, Tuple[int, tuple]] = {}
+        self.pending: Set[int] = set()
+        self.checked = False
+        self.refreshed = -refresh_secs
+        self.lock = Lock()
+
+    def last(self, *key) -> tuple:
+        """ The latest row of a job, without its mark and key columns, or None """
+        self.refresh(keys=[key])
+        with self.lock:
+            entry = self.latest.get(history_key(key))
+        return None if entry is None else entry[1]
+
+    def refresh(self, force: bool = False, keys: Iterable[tuple] = ()) -> None:
+        """ Read the rows past the mark, and the latest row of each of keys
+            not seen yet """
+        with self.lock:
+            missing = list({history_key(k): k for k in keys if history_key(k) not in self.latest}.values())
+            if not force and len(missing) == 0 and monotonic() - self.refreshed < self.refresh_secs:
+                return
+            fields = f'{self.mark_column}, {", ".join(self.keys)}, {self.columns}'
+            and_where = f'AND {self.where}' if len(self.where) > 0 else ''
+            with Db(self.server, self.database) as db:
+                if not self.checked:
+                    top = db.select(f'SELECT MAX({self.mark_column}) FROM {self.table}').fetchone()[0] or 0
+                    if self.mark is None or self.mark > top:
+                        # no saved state, or the table was emptied and its marks started over
+                        self.mark, self.latest, self.pending = top, {}, set()
+                        missing = list({history_key(k): k for k in keys}.values())
+                    self.checked = True
+                if len(self.pending) > 0:
+                    marks = sorted(self.pending)
+                    self.pending.clear()
+                    self.merge(db.select(f'SELECT {fields} FROM {self.table} WHERE {self.mark_column} IN ({",".join(["?"] * len(marks))})',
+                                         tuple(marks)).fetchall(), advance=False)
+                while True:
+                    rows = db.select(f'''SELECT TOP {self.batch_size} {fields} FROM {self.table}
+                                         WHERE {self.mark_column} > ? {and_where} ORDER BY {self.mark_column}''',
+                                     (self.mark,)).fetchall()
+                    self.merge(rows, advance=True)
+                    if len(rows) < self.batch_size:
+                        break
+                for i in range(0, len(missing), LOOKUP_SIZE):
+                    self.lookup(db, missing[i:i + LOOKUP_SIZE], fields, and_where)
+            self.refreshed = monotonic()
+
+    def lookup(self, db, keys: List[tuple], fields: str, and_where: str) -> None:
+        """ Read the latest row of each of keys, a TOP 1 per job in one round trip """
+        names = [f'[k{i}]' for i in range(len(self.keys))]
+        values = ','.join([f'({",".join(["?"] * len(names))})'] * len(keys))
+        match = ' AND '.join(f'{column} = k.{name}' for column, name in zip(self.keys, names))
+        rows = db.select(f'''SELECT k.*, h.* FROM (VALUES {values}) AS k({", ".join(names)})
+                             OUTER APPLY (SELECT TOP 1 {fields} FROM {self.table}
+                                          WHERE {match} {and_where} ORDER BY {self.mark_column} DESC) h''',
+                         tuple(v for key in keys for v in key)).fetchall()
+        self.merge([tuple(row[len(names):]) for row in rows if row[len(names)] is not None], advance=False)
+        for key in keys:
+            self.latest.setdefault(history_key(key), (None, None))
+
+    def merge(self, rows: list, advance: bool) -> None:
+        """ Keep the rows that are the latest of their job.  Only rows read in
+            mark order past the mark advance it: a row looked up out of order
+            may have a higher mark than rows not read yet. """
+        for row in rows:
+            mark, key, values = row[0], history_key(tuple(row[1:1 + len(self.keys)])), tuple(row[1 + len(self.keys):])
+            if advance:
+                self.mark = max(self.mark, mark)
+            current = self.latest.get(key)
+            if current is not None and current[0] is not None and current[0] > mark:
+                continue
+            if current is not None:
+                self.pending.discard(current[0])
+            self.latest[key] = (mark, values)
+            if self.unsettled is not None and self.unsettled(values):
+                self.pending.add(mark)
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {'mark': self.mark, 'pending': sorted(self.pending),
+                    'latest': [[list(key), mark, values] for key, (mark, values) in self.latest.items()]}
+
+    def restore(self, data: dict) -> None:
+        """ Carry on from state saved by to_json; the first refresh still
+            checks the mark against the table """
+        with self.lock:
+            self.mark = data['mark']
+            self.pending = set(data['pending'])
+            self.latest = {tuple(key): (mark, tuple(values) if values is not None else None)
+                           for key, mark, values in data['latest']}
+
+_tails: Dict[tuple, HistoryTail] = {}
+_tails_lock = Lock()
+# saved state of the tails not created yet in this process
+_saved: Dict[str, dict] = None
+
+def tail_id(key: tuple) -> str:
+    return '|'.join(key)
+
+def get_tail(kind: str, server: str, database: str, create: Callable[[], HistoryTail]) -> HistoryTail:
+    """ The process-wide tail of one history table, created on first use and
+        restored from the state loaded by load_tails """
+    key = (kind, server.lower(), database.lower())
+    with _tails_lock:
+        if key not in _tails:
+            tail = create()
+            if _saved is not None and tail_id(key) in _saved:
+                tail.restore(_saved[tail_id(key)])
+            _tails[key] = tail
+        return _tails[key]
+
+def load_tails(path: str = HISTORY_STATE) -> None:
+    """ Read the saved tails once per process """
+    global _saved
+    with _tails_lock:
+        if _saved is not None:
+            return
+        _saved = {}
+        if len(path) > 0 and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    _saved = json.loads(f.read(), object_hook=decode_value)
+            except ValueError:
+                # cut short by a crash; the tails start cold
+                _saved = {}
+
+def dump_tails() -> Dict[str, dict]:
+    """ The state of this process's tails, and the saved state of tails it did not use """
+    with _tails_lock:
+        tails = dict(_tails)
+        data = dict(_saved or {})
+    data.update({tail_id(key): tail.to_json() for key, tail in tails.items() if tail.mark is not None})
+    return data
+
+def merge_tails(data: Dict[str, dict]) -> None:
+    """ Take the tails another process read further than this one, as given
+        by its dump_tails(), for the next save_tails """
+    global _saved
+    with _tails_lock:
+        _saved = dict(_saved or {})
+        for name, tail in data.items():
+            current = _saved.get(name)
+            if current is None or (tail['mark'] or 0) >= (current['mark'] or 0):
+                _saved[name] = tail
+
+def save_tails(path: str = HISTORY_STATE) -> None:
+    """ Save this process's tails, keeping the saved state of tails it did not use """
+    if len(path) == 0:
+        return
+    replace_file(path, json.dumps(dump_tails(), default=encode_value))
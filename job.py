@@ -1,7 +1,11 @@
+from typing import Dict, List, Tuple
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
 from database_handler import Db
+from cache import MetadataCache, MISSING, get_cache
+from history import HistoryTail, get_tail
+from metrics import timed, attributed
 
 class ObjectType(Enum):
     nothing = 0
@@ -15,6 +19,7 @@ class JobStatus(Enum):
     Error = auto()
     On_Hold = auto()
     Finished = auto()
+    Unreachable = -1
 
 class LogJobStatus(Enum):
     Uninitialized = 0
@@ -44,9 +49,16 @@ class JobQueueEntry:
     last_run_dt: datetime = datetime(2000, 1, 1, 0, 0, 0)
     last_run_status: LogJobStatus = LogJobStatus.Uninitialized
     last_run_error_msg: str = ''
+    probe: bool = field(default=True, repr=False)
 
     def __post_init__(self):
-        jqe = get_jqe(self)
+        if self.probe:
+            with attributed('job'):
+                jqe, last_run = get_jqe(self), get_last_run_info(self)
+            with timed('job', self.server, 'parse'):
+                self.apply(jqe, last_run)
+
+    def apply(self, jqe: list, last_run: list) -> None:
         self.earliest_start_date_time =  jqe[0]
         self.status =  JobStatus(jqe[3] + 1)
         self.num_mins_between_runs =  int(jqe[4])
@@ -59,23 +71,88 @@ class JobQueueEntry:
         self.run_on_sundays = bool_str(jqe[11])
         self.job_queue_category_code = jqe[13]
         self.is_running = self.status not in [JobStatus.Error, JobStatus.On_Hold]
-        last_run = get_last_run_info(self)
         if last_run is not None:
             self.last_run_dt = last_run[0]
             self.last_run_status = LogJobStatus(last_run[1] + 1)
             self.last_run_error_msg = ' '.join(last_run[2:]).strip()
 
-def get_jqe(jqe: JobQueueEntry) -> list:
+JQE_COLUMNS = '''[Earliest Start Date_Time],[Object Type to Run],[Object ID to Run] ,[Status],[No_ of Minutes between Runs],[Run on Mondays],[Run on Tuesdays] ,[Run on Wednesdays],[Run on Thursdays],[Run on Fridays],[Run on Saturdays] ,[Run on Sundays],[Description],[Job Queue Category Code]'''
+JQE_LIVE_COLUMNS = '''[Earliest Start Date_Time],[Status]'''
+JQE_CONFIG_COLUMNS = '''[Object Type to Run],[Object ID to Run],[No_ of Minutes between Runs],[Run on Mondays],[Run on Tuesdays] ,[Run on Wednesdays],[Run on Thursdays],[Run on Fridays],[Run on Saturdays] ,[Run on Sundays],[Description],[Job Queue Category Code]'''
+LOG_COLUMNS = '''[Start Date_Time], [Status], [Error Message], [Error Message 2], [Error Message 3], [Error Message 4]'''
+
+def config_key(server: str, database_name: str, object_id: int, description: str) -> tuple:
+    return (server.lower(), database_name.lower(), object_id, description)
+
+def jqe_config(jqe: list) -> tuple:
+    """ The slowly changing part of a JQE_COLUMNS row """
+    return tuple(jqe[1:3]) + tuple(jqe[4:14])
+
+def jqe_row(live: list, config: tuple) -> list:
+    """ Rebuild a JQE_COLUMNS row from JQE_LIVE_COLUMNS and a cached jqe_config """
+    return [live[0], config[0], config[1], live[1], *config[2:]]
+
+def get_jqe(jqe: JobQueueEntry, cache: MetadataCache = None) -> list:
+    cache = cache or get_cache()
+    key = config_key(jqe.server, jqe.database_name, jqe.object_id_to_run, jqe.description)
+    config = cache.get('jqe_config', key)
+    columns = JQE_COLUMNS if config is MISSING else JQE_LIVE_COLUMNS
     with Db(jqe.server, jqe.database_name) as db:
-        rec = db.select(f'SELECT [Earliest Start Date_Time],[Object Type to Run],[Object ID to Run] ,[Status],[No_ of Minutes between Runs],[Run on Mondays],[Run on Tuesdays] ,[Run on Wednesdays],[Run on Thursdays],[Run on Fridays],[Run on Saturdays] ,[Run on Sundays],[Description],[Job Queue Category Code] FROM [{jqe.database_name}$Job Queue Entry] WHERE [Object ID to Run] = ? AND [Description] = ?', (jqe.object_id_to_run, jqe.description))
-        return rec.fetchall()[0]
+        rec = db.select(f'SELECT {columns} FROM [{jqe.database_name}$Job Queue Entry] WHERE [Object ID to Run] = ? AND [Description] = ?', (jqe.object_id_to_run, jqe.description))
+        rec = rec.fetchall()[0]
+    if config is MISSING:
+        cache.put('jqe_config', key, jqe_config(rec))
+        return rec
+    return jqe_row(rec, config)
 
 def get_last_run_info(jqe: JobQueueEntry) -> list:
-    with Db(jqe.server, jqe.database_name) as db:
-        rec = db.select(f'SELECT [Start Date_Time], [Status], [Error Message], [Error Message 2], [Error Message 3], [Error Message 4] FROM [{jqe.database_name}$Job Queue Log Entry] WHERE [Object ID to Run] = ? AND [Description] = ?', (jqe.object_id_to_run, jqe.description))
-        rec = rec.fetchall()
-        if len(rec) > 0:
-            return rec[-1]
+    return log_history(jqe.server, jqe.database_name).last(jqe.object_id_to_run, jqe.description)
+
+def log_history(server: str, database_name: str) -> HistoryTail:
+    """ A company's Job Queue Log Entry table, tailed by [Entry No_].  An entry
+        is written when its job starts and updated when it ends, so entries
+        still in process are read again until they are done. """
+    return get_tail('job', server, database_name,
+                    lambda: HistoryTail(server, database_name, f'[{database_name}$Job Queue Log Entry]', '[Entry No_]',
+                                        ['[Object ID to Run]', '[Description]'], LOG_COLUMNS,
+                                        unsettled=lambda row: LogJobStatus(row[1] + 1) == LogJobStatus.In_Process))
+
+def get_jqe_batch(server: str, database_name: str, jobs: List[Tuple[ObjectType, int, str]],
+                  cache: MetadataCache = None) -> Dict[Tuple[int, str], JobQueueEntry]:
+    """ Build every (object type, object id, description) job queue entry of one
+        company database with a single query.  The newest log entry of each job
+        comes from the company's log history tail, and the entry configuration
+        is only read when it is not in the metadata cache. """
+    cache = cache or get_cache()
+    keys = list({(object_id, description): object_type for object_type, object_id, description in jobs}.items())
+    configs = {key: cache.get('jqe_config', config_key(server, database_name, *key)) for key, _ in keys}
+    values = ','.join(['(?,?,?)'] * len(keys))
+    params = tuple(v for key, config in configs.items() for v in (*key, int(config is MISSING)))
+    with attributed('job'), Db(server, database_name) as db:
+        rows = db.select(f'''SELECT k.[Object ID], k.[Description], k.[Fetch Config], e.*, c.*
+                             FROM (VALUES {values}) AS k([Object ID], [Description], [Fetch Config])
+                             OUTER APPLY (SELECT TOP 1 {JQE_LIVE_COLUMNS} FROM [{database_name}$Job Queue Entry]
+                                          WHERE [Object ID to Run] = k.[Object ID] AND [Description] = k.[Description]) e
+                             OUTER APPLY (SELECT TOP 1 {JQE_CONFIG_COLUMNS} FROM [{database_name}$Job Queue Entry]
+                                          WHERE [Object ID to Run] = k.[Object ID] AND [Description] = k.[Description]
+                                          AND k.[Fetch Config] = 1) c''', params).fetchall()
+    with attributed('job'):
+        history = log_history(server, database_name)
+        history.refresh(keys=[key for key, _ in keys])
+    object_types = dict(keys)
+    results = {}
+    with timed('job', server, 'parse'):
+        for row in rows:
+            key = (row[0], row[1])
+            if row[3] is None:
+                raise IndexError(f'No Job Queue Entry for {key} in {database_name} on {server}')
+            if row[2] == 1:
+                configs[key] = tuple(row[5:17])
+                cache.put('jqe_config', config_key(server, database_name, *key), configs[key])
+            jqe = JobQueueEntry(server, database_name, object_types[key], row[0], row[1], probe=False)
+            jqe.apply(jqe_row(row[3:5], configs[key]), history.last(*key))
+            results[key] = jqe
+    return results
 
 def bool_str(bs: str) -> bool:
     return True if bs == '1' else False
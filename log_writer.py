@@ -0,0 +1,160 @@
+"""
+Buffers check log rows and writes them to the database in bulk
+"""
+
+import os
+import json
+import glob
+import tempfile
+from typing import Dict, List
+from threading import Lock
+from time import monotonic
+from state import state_path, encode_value, decode_value
+
+LOG_JOURNAL = state_path('log_journal')
+
+def lock_file(f) -> bool:
+    """ Take an exclusive lock on an open file without waiting, held until it is closed """
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def read_journal(f) -> Dict[str, List[tuple]]:
+    """ The rows of a journal that were never marked as written, per statement """
+    rows, done = [], 0
+    for line in f.read().splitlines():
+        try:
+            entry = json.loads(line, object_hook=decode_value)
+        except ValueError:
+            # the last line may be cut short by the crash
+            break
+        if len(entry) == 1:
+            done = entry[0]
+        else:
+            rows.append(entry)
+    pending = {}
+    for seq, sql, values in rows:
+        if seq > done:
+            pending.setdefault(sql, []).append(tuple(values))
+    return pending
+
+class LogWriter:
+    """ Collects INSERT rows per statement and flushes them with one
+        executemany per statement inside a single transaction.  Rows are
+        flushed once flush_size rows are pending or flush_secs have passed
+        since the last flush.  With a journal path each row is also appended
+        and synced to a journal file before it is buffered, and a later
+        writer replays the rows of a writer that died before flushing them,
+        so a crash loses no rows; a crash between a commit and its journal
+        mark replays that batch twice. """
+    def __init__(self, storage, flush_size: int = 100, flush_secs: float = 30, journal: str = ''):
+        self.storage = storage
+        self.flush_size = flush_size
+        self.flush_secs = flush_secs
+        self.rows: Dict[str, List[tuple]] = {}
+        self.pending = 0
+        self.last_flush = monotonic()
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.journal = None
+        self.seq = 0
+        if len(journal) > 0:
+            self.recover(journal)
+            directory, prefix = os.path.split(os.path.abspath(journal))
+            fd, path = tempfile.mkstemp(prefix=f'{prefix}.', suffix='.jsonl', dir=directory)
+            self.journal = os.fdopen(fd, 'a+')
+            lock_file(self.journal)
+            self.journal_path = path
+
+    def recover(self, journal: str) -> None:
+        """ Write the unflushed rows of journals left by writers that are gone """
+        for path in glob.glob(f'{glob.escape(os.path.abspath(journal))}.*.jsonl'):
+            try:
+                f = open(path, 'r+')
+            except OSError:
+                continue
+            with f:
+                if not lock_file(f):
+                    # its writer is still running
+                    continue
+                f.seek(0)
+                rows = read_journal(f)
+                if len(rows) > 0:
+                    with self.storage.connect() as db:
+                        for insert, batch in rows.items():
+                            db.insert_many(insert, batch, commit=False)
+                        db.commit()
+                    print(f'Recovered {sum(len(batch) for batch in rows.values())} log rows from {path}')
+            os.remove(path)
+
+    def add(self, sql: str, values: tuple) -> None:
+        with self.lock:
+            if self.journal is not None:
+                self.seq += 1
+                self.journal.write(json.dumps([self.seq, sql, values], default=encode_value) + '\n')
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            self.rows.setdefault(sql, []).append(values)
+            self.pending += 1
+            due = self.pending >= self.flush_size or monotonic() - self.last_flush >= self.flush_secs
+        if due:
+            self.flush()
+
+    def flush(self, sql: str = '', values: tuple = ()) -> None:
+        """ Write every pending row, plus an optional final statement such as
+            the [Run Log] update, in one transaction """
+        with self.flush_lock:
+            with self.lock:
+                rows = self.rows
+                self.rows = {}
+                self.pending = 0
+                self.last_flush = monotonic()
+                seq = self.seq
+            if len(rows) == 0 and len(sql) == 0:
+                return
+            try:
+                with self.storage.connect() as db:
+                    for insert, batch in rows.items():
+                        db.insert_many(insert, batch, commit=False)
+                    if len(sql) > 0:
+                        db.update(sql, values, commit=False)
+                    db.commit()
+            except Exception:
+                # keep the rows so a later flush can retry them
+                with self.lock:
+                    for insert, batch in rows.items():
+                        self.rows.setdefault(insert, [])[:0] = batch
+                    self.pending += sum(len(batch) for batch in rows.values())
+                raise
+            self.mark(seq)
+
+    def mark(self, seq: int) -> None:
+        """ Record in the journal that every row up to seq is written """
+        with self.lock:
+            if self.journal is None or seq == 0:
+                return
+            if self.pending == 0:
+                self.journal.seek(0)
+                self.journal.truncate()
+            else:
+                self.journal.write(json.dumps([seq]) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def close(self) -> None:
+        """ Flush and remove the journal; rows that cannot be written stay in it """
+        self.flush()
+        with self.lock:
+            if self.journal is None:
+                return
+            self.journal.close()
+            self.journal = None
+            os.remove(self.journal_path)
@@ -1,14 +1,32 @@
-from typing import List
-from dataclasses import dataclass, asdict
+import re
+import sys
+from typing import Dict, List
+from argparse import ArgumentParser
+from dataclasses import dataclass, field, asdict
 from enum import Enum, auto
 from json import loads, dumps
 from datetime import datetime
-from service import WinService
-from url import Url
-from program import WinProc, get_tasklist
-from ssis import Ssis
-from job import JobQueueEntry, ObjectType
-from database_handler import Db
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlparse, urlunparse
+from ipaddress import ip_address
+from service import WinService, WinServiceState, get_service_snapshot
+from url import Url, check_urls
+from program import WinProc, get_process_table
+from ssis import Ssis, RunStatus, get_ssis_batch, schedule_key
+from job import JobQueueEntry, JobStatus, ObjectType, get_jqe_batch
+from executor import run_parallel
+from log_writer import LogWriter, LOG_JOURNAL
+from storage import Storage, get_storage
+from breaker import CircuitBreaker, HostUnreachable, TrialPending, UNREACHABLE, is_connect_failure, is_timeout
+from cache import MetadataCache, MISSING, get_cache, format_stats
+from rollup import update_rollups
+from command import CommandRunner, run_command
+from metrics import METRICS_SNAPSHOT, dump_metrics
+from history import HISTORY_STATE, load_tails, save_tails
+from events import EventPublisher, get_publisher
+from delta import DeltaLog, KEYFRAME_RUNS, get_delta_log, set_delta_log
+from deadline import DeadlineBook, MAX_DEFER_MINUTES, get_deadline_book, set_deadline_book
 
 DB_SERVER = 'NKP8590'
 DB_NAME = 'NKPSystemsCheck'
@@ -35,8 +53,16 @@ class CheckCategory(Enum):
     WEBPAGE = auto()
     WS09R2 = auto()
 
+# the enum members by their lower case names, as stored in [Check] and checklist.json
+CHECK_TYPES = {t.name.lower(): t for t in CheckType}
+CHECK_CATEGORIES = {c.name.lower(): c for c in CheckCategory}
+OBJECT_TYPES = {**{o.name.lower(): o for o in ObjectType}, 'null': ObjectType.nothing}
 
-@dataclass
+def interned(value):
+    """ Share one copy of the strings many checks repeat, such as servers and systems """
+    return sys.intern(value) if isinstance(value, str) else value
+
+@dataclass(slots=True)
 class Check:
     _id: int
     name: str
@@ -73,105 +99,368 @@ class Run:
     duration_secs: int = 0
     running: int = 0
     not_running: int = 0
+    skipped: int = 0
+    probes_saved: int = 0
+    probes_deferred: int = 0
+    unreachable_hosts: str = ''
+    cache_stats: str = ''
+    process_ttl: float = 0
+    snapshot_ttl: float = 0
+    metrics_path: str = METRICS_SNAPSHOT
+    history_path: str = HISTORY_STATE
+    storage: Storage = field(default=None, repr=False)
+    writer: LogWriter = field(default=None, repr=False)
+    breaker: CircuitBreaker = field(default=None, repr=False)
+    cache: MetadataCache = field(default=None, repr=False)
+    runner: CommandRunner = field(default=run_command, repr=False)
+    publisher: EventPublisher = field(default=None, repr=False)
+    delta: DeltaLog = field(default=None, repr=False)
+    deadlines: DeadlineBook = field(default=None, repr=False)
+    unreachable_checks: set = field(default_factory=set, init=False, repr=False)
+    process_tables: dict = field(default_factory=dict, init=False, repr=False)
+    service_snapshots: dict = field(default_factory=dict, init=False, repr=False)
+    prefetched: dict = field(default_factory=dict, init=False, repr=False)
+    deferred: set = field(default_factory=set, init=False, repr=False)
+    results: list = field(default_factory=list, init=False, repr=False)
+    _progress: int = field(default=0, init=False, repr=False)
+    _recorded: int = field(default=0, init=False, repr=False)
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+    _locks: dict = field(default_factory=dict, init=False, repr=False)
+    _fetched: dict = field(default_factory=dict, init=False, repr=False)
 
     def __post_init__(self):
-        with Db('NKP8590', 'NKPSystemsCheck') as db:
-            runs = db.select('SELECT * FROM [Run Log]').fetchall()
-            if len(runs) == 0:
-                self._id = 1
-            else:
-                self._id = runs[-1][0] + 1
-            db.insert('''INSERT INTO [Run Log] ([ID]) VALUES (?)''', (self._id))
+        if self.breaker is None:
+            self.breaker = CircuitBreaker.load()
+        if self.cache is None:
+            self.cache = get_cache()
+        load_tails(self.history_path)
+        if self.deadlines is None:
+            self.deadlines = get_deadline_book()
+        # a Run given the _id of a run logged elsewhere (a shard worker) only probes
+        if self._id == 0:
+            if self.storage is None:
+                self.storage = get_storage()
+            if self.writer is None:
+                self.writer = LogWriter(self.storage, journal=LOG_JOURNAL)
+            self._id = self.storage.new_run_id()
+            if self.publisher is None:
+                self.publisher = get_publisher()
+            if self.delta is None:
+                self.delta = get_delta_log()
+            if self.delta is not None:
+                self.delta.load(self.storage)
+        self.breaker.begin_run(self._id)
+
+    def do_checks(self, max_workers: int = 1, per_host: int = 2, async_urls: bool = True, batch: bool = True) -> None:
+        """ Run every check and log the results.  With max_workers > 1 checks
+            against different hosts overlap, with at most per_host probes in
+            flight against any one host.  With async_urls every URL check is
+            probed up front on a shared keep-alive connection pool, and with
+            batch the SSIS and job queue checks are collected with one query
+            per server and database. """
+        self.started()
+        self._progress = self._recorded = 0
+        try:
+            self.collect(self.checks, self.record, max_workers, per_host, async_urls, batch)
+        except BaseException:
+            # keep the results of the checks that did complete
+            self.flush_after_error()
+            raise
+        self.log_run()
 
-    def do_checks(self) -> None:
+    def flush_after_error(self) -> None:
+        """ Write the logged rows while an error is raised, without hiding that error """
+        try:
+            self.writer.flush()
+        except Exception as e:
+            print(f'Could not write the check log: {e!r}')
+
+    def started(self) -> None:
         self.start_dt = datetime.now()
-        tasklists = {}
-        total = len(self.checks)
-        for i, check in enumerate(self.checks):
-            print(f'{i + 1} of {total}: Checking {check.name}...')
-            if check.check_type == CheckType.JOB:
-                start_dt = datetime.now()
-                proc = JobQueueEntry(check.server, check.database.upper(), check.object_type, check.object_id, check.name)
-                end_dt = datetime.now()
-                check.is_running = proc.is_running
-                self.log_jqe(proc, check._id, start_dt, end_dt)
-            elif check.check_type == CheckType.SSIS:
-                start_dt = datetime.now()
-                proc = Ssis(check.name, check.job_id, check.server)
-                end_dt = datetime.now()
-                check.is_running = proc.is_running
-                self.log_ssis(proc, check._id, start_dt, end_dt)
-            elif check.check_type == CheckType.PROGRAM:
-                start_dt = datetime.now()
-                if check.server not in tasklists:
-                    tasklists[check.server] = get_tasklist(check.server)
-                tl = tasklists[check.server]
-                proc = WinProc(check.program, check.server, tl)
-                end_dt = datetime.now()
-                check.is_running = proc.is_running
-                self.log_program(proc, check._id, start_dt, end_dt)
-            elif check.check_type == CheckType.SERVICE:
-                start_dt = datetime.now()
-                proc = WinService(check.service, check.server)
-                end_dt = datetime.now()
-                check.is_running = proc.is_running
-                self.log_service(proc, check._id, start_dt, end_dt)
-            elif check.check_type == CheckType.URL:
-                start_dt = datetime.now()
-                proc = Url(check.url)
-                end_dt = datetime.now()
-                check.is_running = proc.is_running
-                self.log_url(proc, check._id, start_dt, end_dt)
+        self.publish({'type': 'run_start', 'total': len(self.checks), 'start': self.start_dt.isoformat()})
+
+    def publish(self, event: dict) -> None:
+        """ Send a progress event to the web server's live view """
+        if self.publisher is not None:
+            self.publisher.publish({**event, 'run_id': self._id})
+
+    def collect(self, checks: List[Check], handle, max_workers: int = 1, per_host: int = 2,
+                async_urls: bool = True, batch: bool = True) -> None:
+        """ Probe checks as do_checks does, passing each result to
+            handle(check, proc, start_dt, end_dt).  Checks with the same
+            probe_key are probed once and share the result. """
+        checks, duplicates = coalesce(checks)
+        if len(duplicates) > 0:
+            with self._lock:
+                self.probes_saved += sum(len(d) for d in duplicates.values())
+            handle = self.fan_out(handle or self.record, duplicates)
+        if self.deadlines is not None:
+            self.defer(checks)
+        if async_urls:
+            self.prefetch_urls(checks)
+        if batch:
+            self.prefetch_batches(checks, max_workers, per_host)
+        if max_workers > 1:
+            run_parallel(checks, lambda check: self.do_check(check, handle), host_key, max_workers, per_host)
+        else:
+            for check in checks:
+                self.do_check(check, handle)
+
+    def fan_out(self, handle, duplicates: Dict[int, List[Check]]):
+        """ A handle that also passes a probed check's result on to the checks that share its target """
+        def handle_all(check: Check, proc, start_dt: datetime, end_dt: datetime) -> None:
+            handle(check, proc, start_dt, end_dt)
+            for duplicate in duplicates.get(check._id, []):
+                with self._lock:
+                    self._progress += 1
+                    if check._id in self.unreachable_checks:
+                        self.unreachable_checks.add(duplicate._id)
+                    if check._id in self.deferred:
+                        self.deferred.add(duplicate._id)
+                handle(duplicate, proc, start_dt, end_dt)
+        return handle_all
+
+    def defer(self, checks: List[Check]) -> None:
+        """ Reuse the saved result of each scheduled job whose deadline has not passed """
+        now = datetime.now()
+        for check in checks:
+            result_type = SCHEDULED_RESULTS.get(check.check_type)
+            proc = self.deadlines.reuse(deadline_key(check), result_type, now) if result_type is not None else None
+            if proc is not None:
+                self.prefetched[check._id] = (proc, now, now)
+                with self._lock:
+                    self.deferred.add(check._id)
+                    self.probes_deferred += 1
+
+    def observe(self, check: Check, proc) -> None:
+        """ Save a probed scheduled job's result until its next deadline """
+        if check.check_type not in SCHEDULED_RESULTS or check._id in self.deferred:
+            return
+        schedule = None
+        if check.check_type == CheckType.SSIS:
+            schedule = self.cache.get('ssis_schedule', schedule_key(check.server, check.job_id))
+            schedule = None if schedule is MISSING else schedule
+        self.deadlines.observe(deadline_key(check), proc, datetime.now(), schedule)
+
+    def do_check(self, check: Check, handle=None) -> None:
+        with self._lock:
+            self._progress += 1
+            print(f'{self._progress} of {len(self.checks)}: Checking {check.name}...')
+        (handle or self.record)(check, *self.result(check))
+
+    def result(self, check: Check) -> tuple:
+        """ A check's prefetched or reused result, or a new probe, as (proc, start_dt, end_dt) """
+        if check._id in self.prefetched:
+            proc, start_dt, end_dt = self.prefetched.pop(check._id)
+        else:
+            start_dt = datetime.now()
+            proc = self.probe_check(check)
+            end_dt = datetime.now()
+        if self.deadlines is not None:
+            self.observe(check, proc)
+        return proc, start_dt, end_dt
+
+    def prefetch_urls(self, checks: List[Check]) -> None:
+        checks = [c for c in checks if c.check_type == CheckType.URL]
+        if len(checks) == 0:
+            return
+        probes = []
+        for check in checks:
+            try:
+                self.breaker.allow(host_key(check), wait=False)
+                probes.append(check)
+            except TrialPending:
+                # probed one by one once the host's trial probe is back
+                continue
+            except HostUnreachable:
+                now = datetime.now()
+                self.prefetched[check._id] = (self.unreachable(check, skipped=True), now, now)
+        results = check_urls([Url(c.url, probe=False) for c in probes])
+        for check, result in zip(probes, results):
+            if probe_failed(result[0]):
+                self.breaker.failure(host_key(check))
             else:
-                raise KeyError(f'Unknown check type: {check.check_type}\n{check}')
-        self.log_run()
+                self.breaker.success(host_key(check))
+            self.prefetched[check._id] = result
+
+    def prefetch_batches(self, checks: List[Check], max_workers: int = 1, per_host: int = 2) -> None:
+        """ Collect set-based check types with one round trip per server """
+        batches = {}
+        for check in checks:
+            if check._id in self.prefetched:
+                continue
+            if check.check_type == CheckType.SSIS:
+                batches.setdefault((CheckType.SSIS, check.server, 'msdb'), []).append(check)
+            elif check.check_type == CheckType.JOB:
+                batches.setdefault((CheckType.JOB, check.server, check.database.upper()), []).append(check)
+        run_parallel(batches.items(), self.prefetch_batch, lambda b: host_name(b[0][1]), max(max_workers, 1), per_host)
+
+    def prefetch_batch(self, batch: tuple) -> None:
+        (check_type, server, database), checks = batch
+        start_dt = datetime.now()
+        try:
+            results, key = self.breaker.call(host_name(server), lambda: self.collect_batch(check_type, server, database, checks))
+        except Exception as e:
+            if not (is_connect_failure(e) or is_timeout(e)):
+                raise
+            end_dt = datetime.now()
+            for check in checks:
+                self.prefetched[check._id] = (self.unreachable(check, isinstance(e, HostUnreachable)), start_dt, end_dt)
+            return
+        end_dt = datetime.now()
+        for check in checks:
+            self.prefetched[check._id] = (results[key(check)], start_dt, end_dt)
+
+    def collect_batch(self, check_type: CheckType, server: str, database: str, checks: List[Check]) -> tuple:
+        """ Returns the batch results and the function that maps a check to its result key """
+        if check_type == CheckType.SSIS:
+            return get_ssis_batch(server, {c.job_id: c.name for c in checks}, self.cache), lambda c: c.job_id
+        elif check_type == CheckType.JOB:
+            return (get_jqe_batch(server, database, [(c.object_type, c.object_id, c.name) for c in checks], self.cache),
+                    lambda c: (c.object_id, c.name))
+
+    def probe_check(self, check: Check):
+        """ Probe a check through its host's circuit breaker.  Connect failures,
+            timeouts and open breakers give an unreachable result instead of
+            raising; only connect failures count against the host. """
+        try:
+            return self.breaker.call(host_key(check), lambda: self.probe(check), failed=probe_failed)
+        except Exception as e:
+            if not (is_connect_failure(e) or is_timeout(e)):
+                raise
+            return self.unreachable(check, isinstance(e, HostUnreachable))
+
+    def unreachable(self, check: Check, skipped: bool = False):
+        """ A not-running result whose status column records that the host
+            could not be reached """
+        with self._lock:
+            self.unreachable_checks.add(check._id)
+            if skipped:
+                self.skipped += 1
+        if check.check_type == CheckType.JOB:
+            return JobQueueEntry(check.server, check.database.upper(), check.object_type, check.object_id, check.name,
+                                 status=JobStatus.Unreachable, probe=False)
+        elif check.check_type == CheckType.SSIS:
+            return Ssis(check.name, check.job_id, check.server, last_run_status=RunStatus.Unreachable, probe=False)
+        elif check.check_type == CheckType.PROGRAM:
+            return WinProc(check.program, check.server, probe=False)
+        elif check.check_type == CheckType.SERVICE:
+            return WinService(check.service, check.server, state=WinServiceState.Unreachable, probe=False)
+        elif check.check_type == CheckType.URL:
+            return Url(check.url, status_code=UNREACHABLE, probe=False)
+        else:
+            raise KeyError(f'Unknown check type: {check.check_type}\n{check}')
+
+    def probe(self, check: Check):
+        if check.check_type == CheckType.JOB:
+            return JobQueueEntry(check.server, check.database.upper(), check.object_type, check.object_id, check.name)
+        elif check.check_type == CheckType.SSIS:
+            return Ssis(check.name, check.job_id, check.server)
+        elif check.check_type == CheckType.PROGRAM:
+            table = self.cached(self.process_tables, check.server, lambda s: get_process_table(s, self.process_ttl, self.runner))
+            return WinProc(check.program, check.server, should_be_running_count=max(check.instance_count, 1), table=table)
+        elif check.check_type == CheckType.SERVICE:
+            snapshot = self.cached(self.service_snapshots, check.server, lambda s: get_service_snapshot(s, self.runner))
+            return WinService(check.service, check.server, snapshot=snapshot)
+        elif check.check_type == CheckType.URL:
+            return Url(check.url)
+        else:
+            raise KeyError(f'Unknown check type: {check.check_type}\n{check}')
+
+    def record(self, check: Check, proc, start_dt: datetime, end_dt: datetime) -> None:
+        check.is_running = proc.is_running
+        duration = self.duration(check._id, start_dt, end_dt)
+        with self._lock:
+            # a reused result was not probed, so it has no latency to roll up
+            if duration is not None:
+                self.results.append((check._id, proc.is_running, start_dt, duration))
+            self._recorded += 1
+            # live counts for the progress events; log_run recounts them
+            if proc.is_running:
+                self.running += 1
+            else:
+                self.not_running += 1
+            event = {'type': 'check', 'check_id': check._id, 'name': check.name, 'server': check.server,
+                     'check_type': check.check_type.name.lower(), 'is_running': bool(proc.is_running),
+                     'unreachable': check._id in self.unreachable_checks, 'duration': duration,
+                     'progress': self._recorded, 'total': len(self.checks),
+                     'running': self.running, 'not_running': self.not_running}
+        self.publish(event)
+        if check.check_type == CheckType.JOB:
+            self.log_jqe(proc, check._id, start_dt, end_dt)
+        elif check.check_type == CheckType.SSIS:
+            self.log_ssis(proc, check._id, start_dt, end_dt)
+        elif check.check_type == CheckType.PROGRAM:
+            self.log_program(proc, check._id, start_dt, end_dt)
+        elif check.check_type == CheckType.SERVICE:
+            self.log_service(proc, check._id, start_dt, end_dt)
+        elif check.check_type == CheckType.URL:
+            self.log_url(proc, check._id, start_dt, end_dt)
+
+    def cached(self, cache: dict, server: str, fetch):
+        """ Fetch a per-server value once per run, or once per snapshot_ttl
+            seconds if set, even when several workers ask for the same server
+            at the same time """
+        key = (id(cache), server)
+        with self._lock:
+            lock = self._locks.setdefault(key, Lock())
+        with lock:
+            expired = self.snapshot_ttl > 0 and monotonic() - self._fetched.get(key, 0) > self.snapshot_ttl
+            if server not in cache or expired:
+                cache[server] = fetch(server)
+                self._fetched[key] = monotonic()
+            return cache[server]
+
+    def log(self, log: str, sql: str, values: tuple) -> None:
+        """ Queue a check log row, unless delta logging finds the check unchanged.
+            A reused result is always logged, its empty duration marking it. """
+        if self.delta is None or values[1] in self.deferred or not self.delta.skip(log, values):
+            self.writer.add(sql, values)
+
+    def duration(self, check_id: int, start_dt: datetime, end_dt: datetime) -> float:
+        """ A probe's duration in seconds, or None for a reused result that was not probed """
+        if check_id in self.deferred:
+            return None
+        return (end_dt - start_dt).total_seconds()
 
     def log_jqe(self, jqe: JobQueueEntry, check_id: int, start_dt: datetime, end_dt: datetime) -> None:
-        duration = end_dt - start_dt
-        duration = duration.total_seconds()
-        with Db(DB_SERVER, DB_NAME) as db:
-            db.insert('''INSERT INTO [Nav Job Check Log] ([Run ID],[Check ID],[Earliest Start DateTime],[Status],[Job Queue Category Code],
-                                                          [Is Running],[Last Run DateTime],[Last Run Status],[Last Run Error Message],
-                                                          [Start DateTime],[End DateTime],[Duration (secs)])
-                         VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''', (self._id, check_id, jqe.earliest_start_date_time, jqe.status.value, jqe.job_queue_category_code,
-                                                               bool_int(jqe.is_running), jqe.last_run_dt, jqe.last_run_status.value, jqe.last_run_error_msg,
-                                                               start_dt, end_dt, duration))
+        duration = self.duration(check_id, start_dt, end_dt)
+        self.log('job', '''INSERT INTO [Nav Job Check Log] ([Run ID],[Check ID],[Earliest Start DateTime],[Status],[Job Queue Category Code],
+                                                      [Is Running],[Last Run DateTime],[Last Run Status],[Last Run Error Message],
+                                                      [Start DateTime],[End DateTime],[Duration (secs)])
+                     VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''', (self._id, check_id, jqe.earliest_start_date_time, jqe.status.value, jqe.job_queue_category_code,
+                                                           bool_int(jqe.is_running), jqe.last_run_dt, jqe.last_run_status.value, jqe.last_run_error_msg,
+                                                           start_dt, end_dt, duration))
 
     def log_ssis(self, ssis: Ssis, check_id: int, start_dt: datetime, end_dt: datetime) -> None:
-        duration = end_dt - start_dt
-        duration = duration.total_seconds()
-        with Db(DB_SERVER, DB_NAME) as db:
-            db.insert('''INSERT INTO [SSIS Check Log] ([Run ID],[Check ID],[Enabled],[Minutes Between Runs],[Last Run DateTime],[Last Run Status],
-                                                       [Is Running],[Start DateTime],[End DateTime],[Duration (secs)]) 
-                         VALUES (?,?,?,?,?,?,?,?,?,?)''', (self._id, check_id, bool_int(ssis.enabled), ssis.minutes_between_runs, ssis.last_run_dt, ssis.last_run_status.value,
-                                                         bool_int(ssis.is_running), start_dt, end_dt, duration))
+        duration = self.duration(check_id, start_dt, end_dt)
+        self.log('ssis', '''INSERT INTO [SSIS Check Log] ([Run ID],[Check ID],[Enabled],[Minutes Between Runs],[Last Run DateTime],[Last Run Status],
+                                                   [Is Running],[Start DateTime],[End DateTime],[Duration (secs)]) 
+                     VALUES (?,?,?,?,?,?,?,?,?,?)''', (self._id, check_id, bool_int(ssis.enabled), ssis.minutes_between_runs, ssis.last_run_dt, ssis.last_run_status.value,
+                                                     bool_int(ssis.is_running), start_dt, end_dt, duration))
 
     def log_program(self, program: WinProc, check_id: int, start_dt: datetime, end_dt: datetime) -> None:
-        duration = end_dt - start_dt
-        duration = duration.total_seconds()
-        with Db(DB_SERVER, DB_NAME) as db:
-            db.insert('''INSERT INTO [Program Check Log] ([Run ID],[Check ID],[Program],[Instance Count],[Is Running]
-                                                         ,[Start DateTime],[End DateTime],[Duration (secs)])
-                         VALUES (?,?,?,?,?,?,?,?)''', (self._id, check_id, program.name, len(program.instances), bool_int(program.is_running),
-                                                       start_dt, end_dt, duration))
+        duration = self.duration(check_id, start_dt, end_dt)
+        self.log('program', '''INSERT INTO [Program Check Log] ([Run ID],[Check ID],[Program],[Instance Count],[Is Running]
+                                                     ,[Start DateTime],[End DateTime],[Duration (secs)])
+                     VALUES (?,?,?,?,?,?,?,?)''', (self._id, check_id, program.name,
+                                                   UNREACHABLE if check_id in self.unreachable_checks else len(program.instances),
+                                                   bool_int(program.is_running),
+                                                   start_dt, end_dt, duration))
 
     def log_service(self, service: WinService, check_id: int, start_dt: datetime, end_dt: datetime) -> None:
-        duration = end_dt - start_dt
-        duration = duration.total_seconds()
-        with Db(DB_SERVER, DB_NAME) as db:
-            db.insert('''INSERT INTO [Service Check Log] ([Run ID],[Check ID],[Service],[State],
-                                                          [Is Running],[Start DateTime],[End DateTime],[Duration (secs)])
-                         VALUES (?,?,?,?,?,?,?,?)''', (self._id, check_id,service.name,service.state.value,
-                                                       bool_int(service.is_running), start_dt, end_dt, duration))
+        duration = self.duration(check_id, start_dt, end_dt)
+        self.log('service', '''INSERT INTO [Service Check Log] ([Run ID],[Check ID],[Service],[State],
+                                                      [Is Running],[Start DateTime],[End DateTime],[Duration (secs)])
+                     VALUES (?,?,?,?,?,?,?,?)''', (self._id, check_id,service.name,service.state.value,
+                                                   bool_int(service.is_running), start_dt, end_dt, duration))
 
     def log_url(self, url: Url, check_id: int, start_dt: datetime, end_dt: datetime) -> None:
-        duration = end_dt - start_dt
-        duration = duration.total_seconds()
-        with Db(DB_SERVER, DB_NAME) as db:
-            db.insert('''INSERT INTO [URL Check Log] ([Run ID],[Check ID],[URL],[Status Code],
-                                                      [Is Running],[Start DateTime],[End DateTime],[Duration (secs)])
-                         VALUES (?,?,?,?,?,?,?,?)''', (self._id, check_id, url.url, url.status_code,
-                                                       bool_int(url.is_running), start_dt, end_dt, duration))
+        duration = self.duration(check_id, start_dt, end_dt)
+        self.log('url', '''INSERT INTO [URL Check Log] ([Run ID],[Check ID],[URL],[Status Code],
+                                                  [Is Running],[Start DateTime],[End DateTime],[Duration (secs)])
+                     VALUES (?,?,?,?,?,?,?,?)''', (self._id, check_id, url.url, url.status_code,
+                                                   bool_int(url.is_running), start_dt, end_dt, duration))
 
     def log_run(self) -> None:
         self.end_dt = datetime.now()
@@ -180,12 +469,95 @@ class Run:
         self.total_checks = len(self.checks)
         self.running = len([c for c in self.checks if c.is_running])
         self.not_running = self.total_checks - self.running
-        with Db(DB_SERVER, DB_NAME) as db:
-            db.update('''UPDATE [Run Log] 
-                         SET [Run Start DateTime] = ?,[Run End DateTime] = ?,[Total Checks] = ?,
-                             [Running] = ?,[Not Running] = ?,[Run Duration (secs)] = ?
-                         WHERE [ID] = ?''', (self.start_dt, self.end_dt, self.total_checks,
-                                             self.running, self.not_running, self.duration_secs, self._id))
+        self.unreachable_hosts = ', '.join(self.breaker.open_hosts())
+        if self.delta is not None:
+            self.delta.write(self.writer, self._id)
+        self.writer.flush('''UPDATE [Run Log] 
+                             SET [Run Start DateTime] = ?,[Run End DateTime] = ?,[Total Checks] = ?,
+                                 [Running] = ?,[Not Running] = ?,[Run Duration (secs)] = ?,
+                                 [Skipped Checks] = ?,[Unreachable Hosts] = ?,[Probes Saved] = ?
+                             WHERE [ID] = ?''', (self.start_dt, self.end_dt, self.total_checks,
+                                                 self.running, self.not_running, self.duration_secs,
+                                                 self.skipped, self.unreachable_hosts, self.probes_saved, self._id))
+        self.writer.close()
+        update_rollups(self.storage, self.results)
+        self.breaker.save()
+        if self.deadlines is not None:
+            self.deadlines.save()
+        self.cache_stats = format_stats(self.cache.take_stats())
+        self.cache.save()
+        save_tails(self.history_path)
+        dump_metrics(self.metrics_path)
+        self.publish({'type': 'run_finish', 'total': self.total_checks, 'running': self.running,
+                      'not_running': self.not_running, 'skipped': self.skipped, 'probes_saved': self.probes_saved,
+                      'probes_deferred': self.probes_deferred,
+                      'duration': self.duration_secs, 'unreachable_hosts': self.unreachable_hosts})
+        if self.publisher is not None:
+            self.publisher.flush()
+
+def host_name(name: str) -> str:
+    """ A host name as the catalog writes servers: its first label in lower
+        case, so SQL01, sql01\\NAV, sql01,1433 and sql01.corp.local are one host """
+    name = re.split(r'[\\,]', name.strip().lower(), 1)[0]
+    try:
+        return str(ip_address(name))
+    except ValueError:
+        return name.split('.', 1)[0]
+
+def host_key(check: Check) -> str:
+    """ The host a check talks to, used to cap concurrent probes per host """
+    if check.check_type == CheckType.URL:
+        return host_name(urlparse(check.url).hostname or '')
+    return host_name(check.server)
+
+def probe_key(check: Check) -> tuple:
+    """ The target a check probes: checks with the same key would make the
+        same probe and get the same result """
+    if check.check_type == CheckType.URL:
+        return (CheckType.URL, normalize_url(check.url))
+    elif check.check_type == CheckType.SERVICE:
+        return (CheckType.SERVICE, check.server.lower(), check.service.lower())
+    elif check.check_type == CheckType.PROGRAM:
+        return (CheckType.PROGRAM, check.server.lower(), check.program.lower(), max(check.instance_count, 1))
+    elif check.check_type == CheckType.SSIS:
+        return (CheckType.SSIS, check.server.lower(), check.job_id.lower())
+    elif check.check_type == CheckType.JOB:
+        return (CheckType.JOB, check.server.lower(), check.database.upper(), check.object_type, check.object_id, check.name)
+    return (check.check_type, check._id)
+
+def deadline_key(check: Check) -> str:
+    """ probe_key as a string, naming a scheduled job in the deadline book """
+    return '|'.join(str(getattr(part, 'name', part)) for part in probe_key(check))
+
+def normalize_url(url: str) -> str:
+    """ Scheme and host in lower case, without a default port or fragment """
+    tokens = urlparse(url.strip())
+    scheme = tokens.scheme.lower()
+    netloc = tokens.netloc.lower()
+    if (scheme, tokens.port) in (('http', 80), ('https', 443)):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunparse((scheme, netloc, tokens.path or '/', tokens.params, tokens.query, ''))
+
+def coalesce(checks: List[Check]) -> tuple:
+    """ Split checks into the first check of each probe_key and, by that
+        check's ID, the later checks that share its key """
+    first: Dict[tuple, Check] = {}
+    duplicates: Dict[int, List[Check]] = {}
+    for check in checks:
+        key = probe_key(check)
+        if key in first:
+            duplicates.setdefault(first[key]._id, []).append(check)
+        else:
+            first[key] = check
+    return list(first.values()), duplicates
+
+# check types whose results are reused until their schedule's next deadline
+SCHEDULED_RESULTS = {CheckType.SSIS: Ssis, CheckType.JOB: JobQueueEntry}
+
+def probe_failed(proc) -> bool:
+    """ Probe results that mean no connection to the host could be made; a
+        slow or broken answer says nothing about whether the host is up """
+    return isinstance(proc, Url) and proc.connect_failed
 
 def bool_int(b: bool) -> int:
     return 1 if b else 0
@@ -200,38 +572,33 @@ def write_checklist(checks: List[Check], checklist_filepath: str) -> None:
 def get_checks(checklist_filepath: str) -> List[Check]:
     with open(checklist_filepath, 'r') as f:
         data = loads(f.read())
-    
-    checks: List[Check] = []
-    for item in data:
-        ct = CheckType[item['check_type'].upper()]
-        st = CheckCategory[item['check_category'].upper()]
-        object_type = ObjectType[item['object_type'].lower()]
-
-        check = Check(item['_id'], item['name'], item['server'], ct, st, item['service'], item['url'], \
-                      item['program'], item['instance_count'], item['database'], \
-                      item['company'], item['business_unit'], item['system'], item['job_id'], \
-                      object_type, item['object_id'])
-        
-        checks.append(check)
-    return checks
-
-def get_checks_sql() -> List[Check]:
-    with Db('NKP8590', 'NKPSystemsCheck') as db:
-        checklist = db.select('SELECT * FROM [Check]').fetchall()
-    checks: List[Check] = []
-    for item in checklist:
-        ct = CheckType[item[3].upper()]
-        st = CheckCategory[item[4].upper()]
-        object_type = ObjectType['nothing' if item[14].lower() == 'null' else item[14].lower()]
-
-        check = Check(item[0], item[1], item[2], ct, st, item[5], item[6], item[7], item[8], item[9], \
-                      item[10], item[11], item[12], item[13], object_type, item[15])
-        
-        checks.append(check)
-    return checks
+    return [check_from_json(item) for item in data]
+
+def get_checks_sql(storage: Storage = None) -> List[Check]:
+    storage = storage or get_storage()
+    return [check_from_row(item) for item in storage.select_checks()]
+
+def check_from_row(item: tuple) -> Check:
+    """ Build a Check from a [Check] row in CHECK_COLUMNS order """
+    return Check(item[0], item[1], interned(item[2]), CHECK_TYPES[item[3].lower()], CHECK_CATEGORIES[item[4].lower()],
+                 item[5], item[6], item[7], item[8], interned(item[9]), interned(item[10]), interned(item[11]),
+                 interned(item[12]), item[13], OBJECT_TYPES[item[14].lower()], item[15])
+
+def check_from_json(item: dict) -> Check:
+    """ Build a Check from a checklist.json entry written by write_checklist """
+    return Check(item['_id'], item['name'], interned(item['server']), CHECK_TYPES[item['check_type'].lower()],
+                 CHECK_CATEGORIES[item['check_category'].lower()], item['service'], item['url'], item['program'],
+                 item['instance_count'], interned(item['database']), interned(item['company']), interned(item['business_unit']),
+                 interned(item['system']), item['job_id'], OBJECT_TYPES[item['object_type'].lower()], item['object_id'])
+
+def check_values(check: Check) -> tuple:
+    """ A check's [Check] column values, without the ID """
+    return (check.name, check.server, check.check_type.name.lower(), check.check_category.name.lower(), check.service,
+            check.url, check.program, check.instance_count, check.database, check.company, check.business_unit,
+            check.system, check.job_id, check.object_type.name.lower(), check.object_id)
 
 def do_checks(checks) -> None:
-    tasklists = {}
+    process_tables = {}
     total = len(checks)
     for i, check in enumerate(checks):
         print(f'{i + 1} of {total}: Checking {check.name}...')
@@ -240,10 +607,10 @@ def do_checks(checks) -> None:
         elif check.check_type == CheckType.SSIS:
             proc = Ssis(check.name, check.job_id, check.server)
         elif check.check_type == CheckType.PROGRAM:
-            if check.server not in tasklists:
-                tasklists[check.server] = get_tasklist(check.server)
-            tl = tasklists[check.server]
-            proc = WinProc(check.program, check.server, tl)
+            if check.server not in process_tables:
+                process_tables[check.server] = get_process_table(check.server)
+            proc = WinProc(check.program, check.server, should_be_running_count=max(check.instance_count, 1),
+                           table=process_tables[check.server])
         elif check.check_type == CheckType.SERVICE:
             proc = WinService(check.service, check.server)
         elif check.check_type == CheckType.URL:
@@ -257,9 +624,47 @@ def do_checks(checks) -> None:
 if __name__ == '__main__':
     # checklist_filepath = 'checklist.json'
 
-    checks = get_checks_sql()
-    run = Run(checks)
-    run.do_checks()
+    parser = ArgumentParser(description='NKP Systems Checker')
+    parser.add_argument('--select', metavar='SELECTOR', help='only run these checks, e.g. "all SQL14\\Prod checks" or "all EDI services"')
+    parser.add_argument('--checklist', metavar='PATH', help='read the checks from a checklist.json instead of [Check]')
+    parser.add_argument('--workers', type=int, default=1, help='number of checks to run at once')
+    parser.add_argument('--per-host', type=int, default=2, help='max checks in flight against one host')
+    parser.add_argument('--sync-urls', action='store_true', help='probe URLs one at a time with requests')
+    parser.add_argument('--no-batch', action='store_true', help='query SSIS and job queue checks one at a time')
+    parser.add_argument('--daemon', action='store_true', help='keep running, probing each check on its own interval')
+    parser.add_argument('--interval', action='append', default=[], metavar='TYPE=SECS',
+                        help='daemon interval per check type (url=30) or check ID (12=600)')
+    parser.add_argument('--window', type=float, default=300, help='daemon seconds per logged run')
+    parser.add_argument('--coordinate', nargs='?', const='localhost:8009', metavar='HOST:PORT',
+                        help='hand the checks to worker processes, sharded by target host')
+    parser.add_argument('--local-workers', type=int, default=0, help='worker processes to start with --coordinate')
+    parser.add_argument('--shard-timeout', type=float, default=120, help='seconds before a slow shard is given to another worker')
+    parser.add_argument('--worker-wait', type=float, default=60,
+                        help='seconds without a connected worker before the coordinator probes the remaining checks itself')
+    parser.add_argument('--worker', metavar='HOST:PORT', help='probe shards for the coordinator at HOST:PORT')
+    parser.add_argument('--delta-log', nargs='?', type=int, const=KEYFRAME_RUNS, metavar='KEYFRAME_RUNS',
+                        help='only log checks whose state changed, and every check once per KEYFRAME_RUNS runs')
+    parser.add_argument('--deadlines', nargs='?', type=float, const=MAX_DEFER_MINUTES, metavar='MAX_MINUTES',
+                        help='reuse healthy SSIS and job queue results until their schedule says they could change, '
+                             'probing each job at least every MAX_MINUTES')
+    args = parser.parse_args()
+
+    if args.delta_log:
+        set_delta_log(DeltaLog(args.delta_log))
+    if args.deadlines:
+        set_deadline_book(DeadlineBook.load(max_defer_minutes=args.deadlines))
+
+    if args.daemon:
+        # imported here so the scheduler shares the main module's classes
+        from scheduler import run_daemon
+        run_daemon(args)
+    elif args.coordinate or args.worker:
+        # checks are pickled between processes, so both ends use the main module's classes
+        from shard import run_coordinator, run_worker
+        run_coordinator(args) if args.coordinate else run_worker(args)
+    else:
+        from catalog import run_checks
+        run_checks(args)
 
     # checks = get_checks(checklist_filepath)
     # write_checklist(checks, checklist_filepath)
@@ -0,0 +1,155 @@
+"""
+Low-overhead probe metrics: phase timing histograms and counters per check
+type and host, rendered in the Prometheus text format
+"""
+
+import os
+import json
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, Tuple
+from threading import Lock
+from contextlib import contextmanager
+from contextvars import ContextVar
+from state import state_path, replace_file
+
+METRICS_SNAPSHOT = state_path('metrics_snapshot.json')
+PREFIX = 'systems_check'
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    'phase_seconds': 'Time spent in each phase of a probe',
+    'failures_total': 'Probe steps that raised, by exception type',
+    'retries_total': 'Probe steps that were retried',
+    'db_round_trips_total': 'Statements and commits sent to a database',
+}
+
+# the check type that database calls made by this thread or task are counted under
+check_type_var: ContextVar[str] = ContextVar('check_type', default='store')
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Registry:
+    """ Histograms keep one count per bucket plus +Inf, then the sum """
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Labels], list] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.lock = Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect_left(BUCKETS, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            histogram[i] += 1
+            histogram[-1] += value
+
+    def inc(self, name: str, n: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'histograms': [[name, labels, list(h)] for (name, labels), h in self.histograms.items()],
+                    'counters': [[name, labels, value] for (name, labels), value in self.counters.items()]}
+
+    def drain(self) -> dict:
+        """ Return a snapshot and reset every metric """
+        with self.lock:
+            snapshot = {'histograms': [[name, labels, h] for (name, labels), h in self.histograms.items()],
+                        'counters': [[name, labels, value] for (name, labels), value in self.counters.items()]}
+            self.histograms = {}
+            self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        with self.lock:
+            for name, labels, counts in snapshot.get('histograms', []):
+                key = (name, tuple(tuple(l) for l in labels))
+                histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+                for i, count in enumerate(counts):
+                    histogram[i] += count
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(tuple(l) for l in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self) -> str:
+        """ The Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# HELP {PREFIX}_{name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {PREFIX}_{name} histogram')
+            cumulative = 0
+            for le, count in zip([*BUCKETS, '+Inf'], histogram[:-1]):
+                cumulative += count
+                lines.append(f'{PREFIX}_{name}_bucket{format_labels(labels + (("le", str(le)),))} {cumulative}')
+            lines.append(f'{PREFIX}_{name}_sum{format_labels(labels)} {histogram[-1]}')
+            lines.append(f'{PREFIX}_{name}_count{format_labels(labels)} {cumulative}')
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# HELP {PREFIX}_{name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {PREFIX}_{name} counter')
+            lines.append(f'{PREFIX}_{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ''
+    values = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+    return '{' + values + '}'
+
+METRICS = Registry()
+
+@contextmanager
+def timed(check_type: str, host: str, phase: str):
+    """ Time a probe phase; an exception is also counted as a failure """
+    start = perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        failure(check_type, host, e)
+        raise
+    finally:
+        METRICS.observe('phase_seconds', perf_counter() - start, check_type=check_type, host=host.lower(), phase=phase)
+
+def failure(check_type: str, host: str, error: BaseException) -> None:
+    METRICS.inc('failures_total', check_type=check_type, host=host.lower(), error=type(error).__name__)
+
+def retry(check_type: str, host: str) -> None:
+    METRICS.inc('retries_total', check_type=check_type, host=host.lower())
+
+def round_trip(host: str, database: str) -> None:
+    METRICS.inc('db_round_trips_total', check_type=check_type_var.get(), host=host.lower(), database=database.lower())
+
+@contextmanager
+def attributed(check_type: str):
+    """ Count the database calls made inside the block under check_type """
+    token = check_type_var.set(check_type)
+    try:
+        yield
+    finally:
+        check_type_var.reset(token)
+
+def load_snapshot(path: str = METRICS_SNAPSHOT) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+def dump_metrics(path: str = METRICS_SNAPSHOT) -> None:
+    """ Add everything measured since the last dump to the snapshot file the
+        server's /metrics endpoint reads, keeping its counters cumulative """
+    registry = Registry()
+    registry.merge(load_snapshot(path))
+    registry.merge(METRICS.drain())
+    replace_file(path, json.dumps(registry.snapshot()))
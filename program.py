@@ -1,15 +1,55 @@
 from __future__ import annotations
-from typing import List
+from typing import Dict, List
 import os
-import subprocess
+import csv
+from threading import Lock
+from datetime import datetime
 from dataclasses import dataclass, field
+from command import CommandRunner, run_command
+from metrics import timed
 
-def get_tasklist(server_name: str) -> str:
-    output = subprocess.run(['tasklist', '/s', rf'\\{server_name}', '/fo', 'csv', '/nh'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if output.returncode == 0:
-        return output.stdout.decode()
-    else:
-        raise SystemError(output.stdout.decode())
+def get_tasklist(server_name: str, runner: CommandRunner = run_command) -> str:
+    with timed('program', server_name, 'spawn'):
+        return runner(['tasklist', '/s', rf'\\{server_name}', '/fo', 'csv', '/nh'])
+
+def parse_tasklist(tasklist: str) -> Dict[str, List[int]]:
+    """ Index tasklist CSV output by lowercased image name -> PIDs """
+    processes: Dict[str, List[int]] = {}
+    for row in csv.reader(l for l in tasklist.splitlines() if len(l.strip()) > 0):
+        if len(row) > 1 and row[1].isdigit():
+            processes.setdefault(row[0].lower(), []).append(int(row[1]))
+    return processes
+
+@dataclass
+class ProcessTable:
+    """ A parsed tasklist snapshot of one host """
+    server_name: str
+    processes: Dict[str, List[int]] = field(default_factory=dict)
+    fetched_at: datetime = field(default_factory=datetime.now)
+
+    def pids(self, name: str) -> List[int]:
+        return self.processes.get(name.lower(), [])
+
+    def age(self) -> float:
+        return (datetime.now() - self.fetched_at).total_seconds()
+
+_process_tables: Dict[str, ProcessTable] = {}
+_process_tables_lock = Lock()
+
+def get_process_table(server_name: str, ttl: float = 0, runner: CommandRunner = run_command) -> ProcessTable:
+    """ Fetch and parse a host's process table, reusing one fetched less than
+        ttl seconds ago """
+    key = server_name.lower()
+    with _process_tables_lock:
+        table = _process_tables.get(key)
+    if table is not None and table.age() < ttl:
+        return table
+    tasklist = get_tasklist(server_name, runner)
+    with timed('program', server_name, 'parse'):
+        table = ProcessTable(server_name, parse_tasklist(tasklist))
+    with _process_tables_lock:
+        _process_tables[key] = table
+    return table
 
 @dataclass
 class WinProc:
@@ -19,27 +59,26 @@ class WinProc:
     should_be_running_count: int = 1
     is_running: bool = False
     instances: List[int] = field(default_factory=list)
+    table: ProcessTable = field(default=None, repr=False)
+    runner: CommandRunner = field(default=run_command, repr=False)
+    probe: bool = field(default=True, repr=False)
 
     def __post_init__(self):
         if (len(self.server_name) == 0):
             self.server_name = os.environ['COMPUTERNAME']
-        self.update(self.tasklist)
+        if self.probe:
+            self.update(self.tasklist)
 
     def update(self, tasklist: str = '') -> None:
-        tl = get_tasklist(self.server_name) if len(tasklist) == 0 else tasklist
-        tl = [l.strip() for l in get_tasklist(self.server_name).split('\n') if len(l.strip()) > 0]
-        tl = [[i.strip('\"') for i in l.split(',"')] for l in tl]
-        tasks = [t for t in tl if t[0].lower() == self.name.lower()]
-        
-        self.is_running = False;
-        self.instances = [];
-        
-        if len(tasks) > 0:
-            self.is_running = len(tasks) >= self.should_be_running_count
-            for task in tasks:
-                self.instances.append(int(task[1]))
+        if self.table is None or len(tasklist) > 0:
+            tl = get_tasklist(self.server_name, self.runner) if len(tasklist) == 0 else tasklist
+            with timed('program', self.server_name, 'parse'):
+                self.table = ProcessTable(self.server_name, parse_tasklist(tl))
+
+        self.instances = list(self.table.pids(self.name))
+        self.is_running = len(self.instances) > 0 and len(self.instances) >= self.should_be_running_count
 
 if __name__ == '__main__':
     proc = WinProc('ProdSP2.exe', 'prophesysrv')
     print(proc)
-    # print(get_tasklist('prophesysrv'))
\ No newline at end of file
+    # print(get_tasklist('prophesysrv'))
@@ -0,0 +1,200 @@
+"""
+Retention for the check log tables: rows older than the window are collapsed
+into per-check state-change intervals and then purged in small batches
+"""
+
+from time import sleep
+from typing import Dict
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+from storage import Storage, get_storage, LOG_TABLES, RUN_TABLE, INTERVAL_TABLE, INTERVAL_COLUMNS, UNCHANGED_TABLE
+from delta import decode_ids
+
+KEEP_DAYS = 30
+BATCH_SIZE = 2000
+
+COLUMNS = ', '.join(f'[{c}]' for c in INTERVAL_COLUMNS)
+
+@dataclass
+class Interval:
+    """ A stretch of consecutive probes of one check with the same Is Running """
+    check_id: int
+    start_dt: datetime
+    end_dt: datetime
+    is_running: bool
+    probes: int = 1
+    first_run_id: int = 0
+    last_run_id: int = 0
+    stored: bool = False
+
+    def values(self) -> tuple:
+        return (self.end_dt, int(self.is_running), self.probes, self.first_run_id, self.last_run_id)
+
+@dataclass
+class CompactionReport:
+    cutoff_run_id: int = 0
+    rows: Dict[str, int] = field(default_factory=dict)
+    bytes_before: Dict[str, int] = field(default_factory=dict)
+    bytes_after: Dict[str, int] = field(default_factory=dict)
+    intervals_added: int = 0
+
+    def bytes_reclaimed(self) -> int:
+        return sum(self.bytes_before[t] - self.bytes_after[t] for t in self.bytes_before
+                   if self.bytes_before[t] is not None and self.bytes_after.get(t) is not None)
+
+    def __str__(self) -> str:
+        lines = [f'Compacted runs up to {self.cutoff_run_id}: {self.intervals_added} intervals added']
+        for table, rows in self.rows.items():
+            before, after = self.bytes_before.get(table), self.bytes_after.get(table)
+            size = f', {before - after} bytes' if before is not None and after is not None else ''
+            lines.append(f'  {table}: {rows} rows{size}')
+        lines.append(f'  total: {sum(self.rows.values())} rows, {self.bytes_reclaimed()} bytes')
+        return '\n'.join(lines)
+
+def get_cutoff_run_id(storage: Storage, keep: timedelta) -> int:
+    """ The newest run that started before the retention window """
+    with storage.connect() as db:
+        row = db.select(f'SELECT MAX([ID]) FROM {RUN_TABLE} WHERE [Run Start DateTime] < ?',
+                        (datetime.now() - keep,)).fetchone()
+    return int(row[0]) if row is not None and row[0] is not None else 0
+
+def get_open_intervals(storage: Storage) -> Dict[int, Interval]:
+    """ The latest interval of every check, which the next old probe may extend """
+    with storage.connect() as db:
+        rows = db.select(f'''SELECT {COLUMNS} FROM {INTERVAL_TABLE} i
+                             WHERE [Start DateTime] = (SELECT MAX([Start DateTime]) FROM {INTERVAL_TABLE}
+                                                       WHERE [Check ID] = i.[Check ID])''').fetchall()
+    return {row[0]: Interval(row[0], row[1], row[2], bool(row[3]), row[4], row[5], row[6], stored=True) for row in rows}
+
+def compact_table(storage: Storage, table: str, cutoff_run_id: int, intervals: Dict[int, Interval],
+                  batch_size: int = BATCH_SIZE, pause: float = 0) -> tuple:
+    """ Fold the rows of table up to cutoff_run_id into intervals and delete
+        them, whole runs of about batch_size rows per transaction so a
+        concurrent run never waits long on the locks.  Checks that delta
+        logging left out of a run extend their current interval.  While runs
+        past a batch left checks out with a base run in it, each check's last
+        row in the batch is kept for their view; a kept row is not folded
+        again.  Returns (rows purged, intervals added). """
+    log = next(k for k, t in LOG_TABLES.items() if t == table)
+    purged = added = done = 0
+    while True:
+        with storage.connect() as db:
+            # past the last batch, whose kept rows would otherwise fill every batch
+            run_ids = db.select(storage.limit(f'SELECT [Run ID] FROM {table} WHERE [Run ID] > ? AND [Run ID] <= ? ORDER BY [Run ID]',
+                                              batch_size), (done, cutoff_run_id)).fetchall()
+            upto = run_ids[-1][0] if len(run_ids) > 0 else 0
+            if len(run_ids) < batch_size:
+                # the last batch, which also takes runs that only left checks out
+                upto = cutoff_run_id
+            elif run_ids[0][0] < upto:
+                # the last run may continue past the batch, so leave it for the next one
+                upto = max(r[0] for r in run_ids if r[0] < upto)
+            rows = db.select(f'''SELECT l.[Run ID], l.[Check ID], l.[Is Running], l.[Start DateTime], r.[Run Start DateTime]
+                                 FROM {table} l LEFT JOIN {RUN_TABLE} r ON r.[ID] = l.[Run ID]
+                                 WHERE l.[Run ID] <= ?
+                                 ORDER BY l.[Run ID], l.[Check ID]''', (upto,)).fetchall()
+            unchanged = db.select(f'''SELECT u.[Run ID], u.[Check IDs], r.[Run Start DateTime]
+                                      FROM {UNCHANGED_TABLE} u LEFT JOIN {RUN_TABLE} r ON r.[ID] = u.[Run ID]
+                                      WHERE u.[Log] = ? AND u.[Run ID] <= ?''', (log, upto)).fetchall()
+            if len(rows) == 0 and len(unchanged) == 0:
+                break
+            # a left out check has the Is Running of its current interval, marked None
+            rows += [(run_id, check_id, None, None, run_start_dt)
+                     for run_id, ids, run_start_dt in unchanged for check_id in decode_ids(ids)]
+            rows.sort(key=lambda r: (r[0], r[1]))
+            # rows up to here were folded by an earlier batch and kept for a later left out run
+            folded = {check_id: interval.last_run_id for check_id, interval in intervals.items()}
+            # keyed by identity: a check can close one interval and open another in a batch
+            changed: Dict[int, Interval] = {}
+            for run_id, check_id, is_running, start_dt, run_start_dt in rows:
+                if is_running is not None and run_id <= folded.get(check_id, 0):
+                    continue
+                start_dt = start_dt or run_start_dt
+                interval = intervals.get(check_id)
+                if is_running is None and interval is None:
+                    continue
+                is_running = interval.is_running if is_running is None else bool(is_running)
+                if interval is not None and interval.is_running == is_running:
+                    interval.end_dt = max(interval.end_dt, start_dt or interval.end_dt)
+                    interval.probes += 1
+                    interval.last_run_id = run_id
+                elif start_dt is not None:
+                    interval = Interval(check_id, start_dt, start_dt, is_running, 1, run_id, run_id)
+                    intervals[check_id] = interval
+                    added += 1
+                else:
+                    continue
+                changed[id(interval)] = interval
+            updates = [(*i.values(), i.check_id, i.start_dt) for i in changed.values() if i.stored]
+            inserts = [(i.check_id, i.start_dt, *i.values()) for i in changed.values() if not i.stored]
+            if len(updates) > 0:
+                db.insert_many(f'''UPDATE {INTERVAL_TABLE}
+                                   SET [End DateTime] = ?, [Is Running] = ?, [Probes] = ?, [First Run ID] = ?, [Last Run ID] = ?
+                                   WHERE [Check ID] = ? AND [Start DateTime] = ?''', updates, commit=False)
+            if len(inserts) > 0:
+                db.insert_many(f'INSERT INTO {INTERVAL_TABLE} ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)', inserts, commit=False)
+            keyframes = db.select(storage.limit(f'''SELECT [Run ID] FROM {UNCHANGED_TABLE}
+                                                   WHERE [Log] = ? AND [Run ID] > ? AND [Base Run ID] <= ?''', 1),
+                                  (log, upto, upto)).fetchone() is not None
+            if keyframes:
+                purged += db.update(f'''DELETE FROM {table} WHERE [Run ID] <= ? AND [ID] NOT IN
+                                            (SELECT MAX(l.[ID]) FROM {table} l
+                                             WHERE l.[Run ID] = (SELECT MAX([Run ID]) FROM {table}
+                                                                 WHERE [Check ID] = l.[Check ID] AND [Run ID] <= ?)
+                                             GROUP BY l.[Check ID])''', (upto, upto), commit=False).rowcount
+            else:
+                purged += db.update(f'DELETE FROM {table} WHERE [Run ID] <= ?', (upto,), commit=False).rowcount
+            db.update(f'DELETE FROM {UNCHANGED_TABLE} WHERE [Log] = ? AND [Run ID] <= ?', (log, upto), commit=False)
+            db.commit()
+        for interval in changed.values():
+            interval.stored = True
+        if upto == cutoff_run_id:
+            break
+        done = upto
+        sleep(pause)
+    return purged, added
+
+def purge_runs(storage: Storage, cutoff_run_id: int, batch_size: int = BATCH_SIZE, pause: float = 0) -> int:
+    """ Delete the [Run Log] rows up to cutoff_run_id, oldest first """
+    purged = 0
+    while True:
+        with storage.connect() as db:
+            ids = db.select(storage.limit(f'SELECT [ID] FROM {RUN_TABLE} WHERE [ID] <= ? ORDER BY [ID]', batch_size),
+                            (cutoff_run_id,)).fetchall()
+            if len(ids) == 0:
+                break
+            purged += db.update(f'DELETE FROM {RUN_TABLE} WHERE [ID] <= ?', (ids[-1][0],)).rowcount
+        if len(ids) < batch_size:
+            break
+        sleep(pause)
+    return purged
+
+def compact(storage: Storage, keep: timedelta = timedelta(days=KEEP_DAYS), batch_size: int = BATCH_SIZE,
+            pause: float = 0, purge_run_log: bool = True) -> CompactionReport:
+    """ Keep full resolution rows for keep, collapse everything older into
+        [Check State Interval] rows and purge it """
+    report = CompactionReport(get_cutoff_run_id(storage, keep))
+    if report.cutoff_run_id == 0:
+        return report
+    tables = list(LOG_TABLES.values()) + ([RUN_TABLE] if purge_run_log else [])
+    for table in tables:
+        report.bytes_before[table] = storage.table_bytes(table)
+    intervals = get_open_intervals(storage)
+    for table in LOG_TABLES.values():
+        report.rows[table], added = compact_table(storage, table, report.cutoff_run_id, intervals, batch_size, pause)
+        report.intervals_added += added
+    if purge_run_log:
+        report.rows[RUN_TABLE] = purge_runs(storage, report.cutoff_run_id, batch_size, pause)
+    for table in tables:
+        report.bytes_after[table] = storage.table_bytes(table)
+    return report
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Collapse old check log rows into state-change intervals')
+    parser.add_argument('--keep-days', type=float, default=KEEP_DAYS, help='days of full resolution rows to keep')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows purged per transaction')
+    parser.add_argument('--pause', type=float, default=0, help='seconds to wait between batches')
+    parser.add_argument('--keep-run-log', action='store_true', help='do not purge old [Run Log] rows')
+    args = parser.parse_args()
+    print(compact(get_storage(), timedelta(days=args.keep_days), args.batch_size, args.pause, not args.keep_run_log))
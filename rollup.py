@@ -0,0 +1,221 @@
+"""
+Hourly and daily availability and latency rollups per check, updated as each
+run is logged so reports never have to scan the check log tables
+"""
+
+import math
+from typing import Dict, List, Tuple
+from threading import Lock
+from datetime import datetime
+from dataclasses import dataclass, field
+from storage import Storage, ROLLUP_TABLES, ROLLUP_COLUMNS, LOG_TABLES
+from delta import left_out_rows, unchanged_sql
+
+SKETCH_ACCURACY = 0.02
+SKETCH_MIN = 0.001
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+COLUMNS = ', '.join(f'[{c}]' for c in ROLLUP_COLUMNS)
+
+# (check ID, is running, start, duration in seconds or None) of one probe
+Result = Tuple[int, bool, datetime, float]
+
+_lock = Lock()
+
+@dataclass
+class Sketch:
+    """ Log-bucketed quantile sketch.  Quantiles are within SKETCH_ACCURACY of
+        the true value (durations under SKETCH_MIN read as 0) and two sketches
+        merge by adding their bucket counts, so hours add up to days. """
+    counts: Dict[int, int] = field(default_factory=dict)
+
+    def add(self, value: float, count: int = 1) -> None:
+        index = 0 if value <= SKETCH_MIN else math.ceil(math.log(value / SKETCH_MIN, SKETCH_GAMMA))
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other: 'Sketch') -> None:
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def quantile(self, q: float) -> float:
+        total = sum(self.counts.values())
+        if total == 0:
+            return 0.0
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                break
+        if index == 0:
+            return 0.0
+        return SKETCH_MIN * 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+
+    def to_text(self) -> str:
+        return ','.join(f'{index}:{count}' for index, count in sorted(self.counts.items()))
+
+    @classmethod
+    def from_text(cls, text: str) -> 'Sketch':
+        sketch = cls()
+        for item in (text or '').split(','):
+            if len(item) > 0:
+                index, _, count = item.partition(':')
+                sketch.counts[int(index)] = int(count)
+        return sketch
+
+@dataclass
+class Rollup:
+    runs: int = 0
+    running: int = 0
+    duration_sum: float = 0
+    duration_min: float = 0
+    duration_max: float = 0
+    sketch: Sketch = field(default_factory=Sketch)
+
+    def timed(self) -> int:
+        """ The runs with a duration, which the latency figures are over """
+        return sum(self.sketch.counts.values())
+
+    def add(self, is_running: bool, duration: float = None) -> None:
+        """ Add a run; one without a duration only counts towards availability """
+        self.runs += 1
+        self.running += int(bool(is_running))
+        if duration is None:
+            return
+        self.duration_min = duration if self.timed() == 0 else min(self.duration_min, duration)
+        self.duration_max = max(self.duration_max, duration)
+        self.duration_sum += duration
+        self.sketch.add(duration)
+
+    def merge(self, other: 'Rollup') -> None:
+        if other.runs == 0:
+            return
+        if other.timed() > 0:
+            self.duration_min = other.duration_min if self.timed() == 0 else min(self.duration_min, other.duration_min)
+        self.duration_max = max(self.duration_max, other.duration_max)
+        self.runs += other.runs
+        self.running += other.running
+        self.duration_sum += other.duration_sum
+        self.sketch.merge(other.sketch)
+
+    def to_json(self) -> dict:
+        return {
+            'runs': self.runs,
+            'running': self.running,
+            'availability': self.running / self.runs if self.runs > 0 else None,
+            'duration_avg': self.duration_sum / self.timed() if self.timed() > 0 else None,
+            'duration_min': self.duration_min,
+            'duration_max': self.duration_max,
+            'duration_p50': self.sketch.quantile(0.5),
+            'duration_p95': self.sketch.quantile(0.95),
+            'duration_p99': self.sketch.quantile(0.99),
+        }
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Rollup':
+        """ From a row in ROLLUP_COLUMNS order """
+        return cls(row[2], row[3], row[4], row[5], row[6], Sketch.from_text(row[7]))
+
+def bucket_start(granularity: str, dt: datetime) -> datetime:
+    if granularity == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    elif granularity == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f'Unknown rollup granularity: {granularity}')
+
+def update_rollups(storage: Storage, results: List[Result]) -> None:
+    """ Merge a run's results into the hourly and daily rollups in one transaction """
+    if len(results) == 0:
+        return
+    hint = ' WITH (UPDLOCK, HOLDLOCK)' if storage.dialect == 'mssql' else ''
+    with _lock, storage.connect() as db:
+        for granularity, table in ROLLUP_TABLES.items():
+            rollups: Dict[Tuple[int, datetime], Rollup] = {}
+            for check_id, is_running, start_dt, duration in results:
+                rollups.setdefault((check_id, bucket_start(granularity, start_dt)), Rollup()).add(is_running, duration)
+            buckets = sorted({bucket for _, bucket in rollups})
+            rows = db.select(f'SELECT {COLUMNS} FROM {table}{hint} WHERE [Bucket Start] >= ? AND [Bucket Start] <= ?',
+                             (buckets[0], buckets[-1])).fetchall()
+            existing = set()
+            for row in rows:
+                key = (row[0], row[1])
+                if key in rollups:
+                    existing.add(key)
+                    merged = Rollup.from_row(row)
+                    merged.merge(rollups[key])
+                    rollups[key] = merged
+            updates = [(r.runs, r.running, r.duration_sum, r.duration_min, r.duration_max, r.sketch.to_text(), *key)
+                       for key, r in rollups.items() if key in existing]
+            inserts = [(*key, r.runs, r.running, r.duration_sum, r.duration_min, r.duration_max, r.sketch.to_text())
+                       for key, r in rollups.items() if key not in existing]
+            if len(updates) > 0:
+                db.insert_many(f'''UPDATE {table}
+                                   SET [Runs] = ?, [Running] = ?, [Duration Sum] = ?, [Duration Min] = ?,
+                                       [Duration Max] = ?, [Sketch] = ?
+                                   WHERE [Check ID] = ? AND [Bucket Start] = ?''', updates, commit=False)
+            if len(inserts) > 0:
+                db.insert_many(f'INSERT INTO {table} ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', inserts, commit=False)
+        db.commit()
+
+def query_rollups(storage: Storage, check_id: int, granularity: str, start: datetime,
+                  end: datetime) -> Tuple[List[Tuple[datetime, Rollup]], Rollup]:
+    """ The rollup buckets of a check starting in [start, end) and their total """
+    if granularity not in ROLLUP_TABLES:
+        raise ValueError(f'Unknown rollup granularity: {granularity}')
+    with storage.connect() as db:
+        rows = db.select(f'''SELECT {COLUMNS} FROM {ROLLUP_TABLES[granularity]}
+                             WHERE [Check ID] = ? AND [Bucket Start] >= ? AND [Bucket Start] < ?
+                             ORDER BY [Bucket Start]''', (check_id, start, end)).fetchall()
+    buckets = [(row[1], Rollup.from_row(row)) for row in rows]
+    total = Rollup()
+    for _, rollup in buckets:
+        total.merge(rollup)
+    return buckets, total
+
+def rebuild_rollups(storage: Storage, chunk_size: int = 10000, chunk_runs: int = 100) -> int:
+    """ Recompute every rollup from the check log tables.  Logged rows
+        without a duration are reused results that were not probed and are
+        left out, as update_rollups leaves them out.  The checks delta logging
+        left out of a run were probed, but only their availability is known,
+        from their last logged row.  Returns the number of log rows read. """
+    with storage.connect() as db:
+        for table in ROLLUP_TABLES.values():
+            db.update(f'DELETE FROM {table}', commit=False)
+        db.commit()
+    total = 0
+    for log, table in LOG_TABLES.items():
+        with storage.connect() as db:
+            cursor = db.select(f'''SELECT [Check ID], [Is Running], [Start DateTime], [Duration (secs)] FROM {table}
+                                   WHERE [Start DateTime] IS NOT NULL AND [Duration (secs)] IS NOT NULL''')
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                update_rollups(storage, [(r[0], bool(r[1]), r[2], r[3]) for r in rows])
+                total += len(rows)
+        total += rebuild_left_out(storage, log, chunk_runs)
+    return total
+
+def rebuild_left_out(storage: Storage, log: str, chunk_runs: int = 100) -> int:
+    """ Roll up the rows delta logging left out of a log, chunk_runs runs at a time """
+    table = LOG_TABLES[log]
+    total, last = 0, 0
+    while True:
+        with storage.connect() as db:
+            cursor = db.select(storage.limit(f'SELECT * FROM {table}', 0))
+            names = [d[0] for d in cursor.description]
+            cursor.fetchall()
+            entries = db.select(storage.limit(unchanged_sql(['u.[Run ID] > ?']), chunk_runs), (log, last)).fetchall()
+            rows = left_out_rows(db, table, names, entries)
+        check_col, running_col, start_col = (names.index(c) for c in ('Check ID', 'Is Running', 'Start DateTime'))
+        update_rollups(storage, [(r[check_col], bool(r[running_col]), r[start_col], None) for r in rows
+                                 if r[start_col] is not None])
+        total += len(rows)
+        if len(entries) < chunk_runs:
+            return total
+        last = entries[-1][0]
+
+if __name__ == '__main__':
+    # python rollup.py -> rebuild the rollups from the existing check logs
+    from storage import get_storage
+    print(f'{rebuild_rollups(get_storage())} log rows rolled up')
@@ -0,0 +1,187 @@
+"""
+Long-running scheduler that probes each check on its own interval
+"""
+
+import heapq
+from collections import deque
+from typing import Dict, List
+from random import uniform
+from threading import Event, Lock, Thread
+from time import monotonic
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from main import Check, CheckType, Run, host_key
+from catalog import CheckCatalog
+from storage import Storage, get_storage
+from breaker import CircuitBreaker
+
+DEFAULT_INTERVALS = {
+    CheckType.URL: 30,
+    CheckType.SERVICE: 60,
+    CheckType.PROGRAM: 60,
+    CheckType.JOB: 300,
+    CheckType.SSIS: 300,
+}
+
+class Scheduler:
+    """ Keeps a priority queue of checks keyed by when they are next due and
+        hands due checks to a worker pool, holding back checks of a host that
+        already has per_host probes in flight.  Results are logged into Run
+        windows of window_secs each. """
+    def __init__(self, storage: Storage = None, intervals: Dict[CheckType, float] = None,
+                 check_intervals: Dict[int, float] = None, jitter: float = 0.1, max_workers: int = 8,
+                 per_host: int = 2, window_secs: float = 300, catalog_refresh_secs: float = 300):
+        self.storage = storage or get_storage()
+        self.intervals = {**DEFAULT_INTERVALS, **(intervals or {})}
+        self.check_intervals = check_intervals or {}
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.window_secs = window_secs
+        self.catalog = CheckCatalog(self.storage, refresh_secs=catalog_refresh_secs)
+        self.queue: List[tuple] = []
+        self.scheduled = set()
+        self.seq = 0
+        self.in_flight: Dict[str, int] = {}
+        self.waiting: Dict[str, deque] = {}
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.wake = Event()
+        self.breaker = CircuitBreaker.load()
+
+    def interval(self, check: Check) -> float:
+        return self.check_intervals.get(check._id, self.intervals[check.check_type])
+
+    def schedule(self, check_id: int, due: float) -> None:
+        self.seq += 1
+        heapq.heappush(self.queue, (due, self.seq, check_id))
+        self.scheduled.add(check_id)
+
+    def sync_catalog(self) -> None:
+        """ Schedule checks that are new in the catalog; deleted checks are
+            dropped when they come due """
+        now = monotonic()
+        for check in self.catalog.all():
+            if check._id not in self.scheduled:
+                # spread the first probes over one interval
+                self.schedule(check._id, now + uniform(0, self.interval(check)))
+
+    def new_window(self) -> Run:
+        run = Run([], storage=self.storage, breaker=self.breaker, snapshot_ttl=min(self.intervals.values()))
+        run.started()
+        return run
+
+    def close_window(self, run: Run, futures: List[Future]) -> None:
+        wait(futures)
+        run.log_run()
+        print(f'Run {run._id}: {run.total_checks} checks, {run.running} running, {run.not_running} not running')
+        print(f'Metadata cache: {run.cache_stats}')
+
+    def execute(self, run: Run, check: Check) -> None:
+        try:
+            if run.deadlines is not None:
+                run.defer([check])
+            proc, start_dt, end_dt = run.result(check)
+            with run._lock:
+                run.checks.append(check)
+            run.record(check, proc, start_dt, end_dt)
+            with run._lock:
+                # a later probe of the check in this window may not be reused
+                run.deferred.discard(check._id)
+            if not check.is_running:
+                print(f'NOT RUNNING: {check.name}')
+        except Exception as e:
+            print(f'{check.name} failed: {e!r}')
+
+    def host_full(self, key: str) -> bool:
+        with self.lock:
+            return self.in_flight.get(key, 0) >= self.per_host
+
+    def submit(self, pool: ThreadPoolExecutor, check: Check, now: float) -> None:
+        """ Hand check to the pool and schedule its next probe """
+        key = host_key(check)
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        future = pool.submit(self.execute, self.window, check)
+        future.add_done_callback(lambda _: self.finished(key))
+        self.futures.append(future)
+        interval = self.interval(check)
+        self.schedule(check._id, now + interval * (1 + uniform(-self.jitter, self.jitter)))
+
+    def finished(self, key: str) -> None:
+        with self.lock:
+            self.in_flight[key] -= 1
+        # the dispatcher may have checks of this host waiting
+        self.wake.set()
+
+    def run(self) -> None:
+        """ Dispatch due checks until stop() is called or the process is interrupted """
+        self.window = self.new_window()
+        self.window_end = monotonic() + self.window_secs
+        self.futures: List[Future] = []
+        self.closers: List[Thread] = []
+        self.sync_catalog()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                self.dispatch(pool)
+            except KeyboardInterrupt:
+                pass
+            self.close_window(self.window, self.futures)
+        for closer in self.closers:
+            closer.join()
+
+    def dispatch(self, pool: ThreadPoolExecutor) -> None:
+        while not self.stop_event.is_set():
+            now = monotonic()
+            if now >= self.window_end:
+                # the old window is logged once its in-flight checks finish
+                closer = Thread(target=self.close_window, args=(self.window, self.futures))
+                closer.start()
+                self.closers.append(closer)
+                self.window = self.new_window()
+                self.window_end = now + self.window_secs
+                self.futures = []
+                self.sync_catalog()
+            for key in list(self.waiting):
+                waiting = self.waiting[key]
+                while len(waiting) > 0 and not self.host_full(key):
+                    self.submit(pool, waiting.popleft(), now)
+                if len(waiting) == 0:
+                    del self.waiting[key]
+            while len(self.queue) > 0 and self.queue[0][0] <= now:
+                _, _, check_id = heapq.heappop(self.queue)
+                check = self.catalog.get(check_id)
+                if check is None:
+                    self.scheduled.discard(check_id)
+                    continue
+                check = replace(check)
+                key = host_key(check)
+                if key in self.waiting or self.host_full(key):
+                    # stays scheduled; it is submitted when a probe of its host finishes
+                    self.waiting.setdefault(key, deque()).append(check)
+                    continue
+                self.submit(pool, check, now)
+            next_due = self.queue[0][0] if len(self.queue) > 0 else self.window_end
+            self.wake.wait(max(0, min(next_due, self.window_end) - monotonic()))
+            self.wake.clear()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wake.set()
+
+def parse_intervals(values: List[str]) -> tuple:
+    """ Split TYPE=SECS and CHECK_ID=SECS arguments into per-type and per-check intervals """
+    intervals, check_intervals = {}, {}
+    for value in values:
+        key, _, secs = value.partition('=')
+        if key.isdigit():
+            check_intervals[int(key)] = float(secs)
+        else:
+            intervals[CheckType[key.upper()]] = float(secs)
+    return intervals, check_intervals
+
+def run_daemon(args) -> None:
+    intervals, check_intervals = parse_intervals(args.interval)
+    scheduler = Scheduler(intervals=intervals, check_intervals=check_intervals, max_workers=max(args.workers, 1),
+                          per_host=args.per_host, window_secs=args.window)
+    scheduler.run()
@@ -2,23 +2,34 @@
 This is the server file that serves the webpages and talks to the database.
 """
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request, make_response, abort
 from flask_cors import CORS
 import json
-from main import get_checks_sql, get_checks, CheckType, CheckCategory, ObjectType, Check
-from database_handler import Db
+from queue import Empty
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, date, timedelta
+from main import check_values, CheckType, CheckCategory, ObjectType, Check
+from storage import get_storage, LOG_TABLES, RUN_TABLE
+from catalog import get_catalog, filter_value
+from rollup import query_rollups
+from metrics import METRICS, Registry, load_snapshot
+from events import EventHub, format_sse
+from delta import read_page
 
 app = Flask(__name__)
 CORS(app)
+hub = EventHub()
 
-DB_SERVER = 'NKP8590'
-DB_NAME = 'NKPSystemsCheck'
-CHECK_TABLE = '[Check]'
+MAX_PAGE_SIZE = 500
+ROLLUP_DEFAULT_SPAN = {'hour': timedelta(hours=48), 'day': timedelta(days=30)}
+SSE_KEEPALIVE_SECS = 15
+CHECK_SORTS = ('_id', 'name', 'server', 'check_type', 'check_category', 'system', 'business_unit')
 
 @app.route('/')
 def index():
-    """ serves the home page """
-    return render_template('index.html', checks=get_checks('checklist.json'))
+    """ serves the home page; the checks are loaded from /api/checks """
+    return render_template('index.html', check_types=[c.name.upper() for c in list(CheckType)], 
+                                         check_categories=[s.name.upper() for s in list(CheckCategory)])
 
 @app.route('/documentation')
 def documentation():
@@ -28,17 +39,28 @@ def documentation():
 @app.route('/edit/<check_id>')
 def edit(check_id):
     check_id = int(check_id)
-    checks = get_checks('checklist.json')
-    if check_id > len(checks):
+    catalog = get_catalog()
+    checks = catalog.all()
+    if len(checks) == 0:
+        abort(404)
+    if check_id > checks[-1]._id:
         check = checks[-1]
-    elif check_id == 0:
+    elif check_id <= 0:
         check = checks[0]
     else:
-        check = [c for c in checks if c._id == check_id][0]
-    return render_template('edit.html', check=check, 
+        check = catalog.get(check_id)
+        if check is None:
+            check = next(c for c in checks if c._id > check_id)
+    etag = catalog.etag('edit', check._id)
+    if etag in request.if_none_match:
+        return '', 304
+    response = make_response(render_template('edit.html', check=check, 
                                         check_types=[c.name.upper() for c in list(CheckType)], 
                                         check_categories=[s.name.upper() for s in list(CheckCategory)], 
-                                        object_types=[o.name.upper() for o in list(ObjectType)])
+                                        object_types=[o.name.upper() for o in list(ObjectType)]))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/edit/save', methods=['POST'])
 def saveEdit():
@@ -46,26 +68,15 @@ def saveEdit():
     check = Check(int(data['id']), data['name'], data['server'], CheckType[data['checkType']], CheckCategory[data['checkCategory']], 
                   data['service'], data['url'], data['program'], int(data['instanceCount']), data['database'], data['company'], 
                   data['businessUnit'], data['system'], data['jobID'], ObjectType[data['objectType'].lower()], int(data['objectID']))
-    with Db(DB_SERVER, DB_NAME) as db:
-        db.update(f'''UPDATE {CHECK_TABLE}
-                      SET [Name] = ?, [Server] = ?, [Check Type] = ?, 
-                          [Check Category] = ?, [Service] = ?, [URL] = ?, 
-                          [Program] = ?, [Instance Count] = ?, [Database] = ?, 
-                          [Company] = ?, [Business Unit] = ?, [System] = ?, 
-                          [Job ID] = ?, [Object Type] = ?, [Object ID] = ?
-                      WHERE [ID] = ?''', 
-                      (check.name, check.server, check.check_type.name.lower(), 
-                       check.check_category.name.lower(), check.service, check.url,
-                       check.program, check.instance_count, check.database, 
-                       check.company, check.business_unit, check.system, 
-                       check.job_id, check.object_type.name.lower(), check.object_id, check._id))
+    get_storage().update_check(check._id, check_values(check))
+    get_catalog().upsert(check)
     return check.to_json()
 
 @app.route('/edit/delete', methods=['POST'])
 def editDelete():
     data = json.loads(request.data)
-    with Db(DB_SERVER, DB_NAME) as db:
-        db.delete(f'DELETE FROM {CHECK_TABLE} WHERE [ID] = ?', (int(data['id'])))
+    get_storage().delete_check(int(data['id']))
+    get_catalog().delete(int(data['id']))
     return {'success': True}
 
 @app.route('/add')
@@ -80,18 +91,199 @@ def saveNew():
     check = Check(int(data['id']), data['name'], data['server'], CheckType[data['checkType']], CheckCategory[data['checkCategory']], 
                   data['service'], data['url'], data['program'], int(data['instanceCount']), data['database'], data['company'], 
                   data['businessUnit'], data['system'], data['jobID'], ObjectType[data['objectType'].lower()], int(data['objectID']))
-    with Db(DB_SERVER, DB_NAME) as db:
-        checks = db.select('SELECT * FROM [Check]').fetchall()
-        check._id = checks[-1][0] + 1
-        sql = f'''SET IDENTITY_INSERT "Check" ON;
-                    INSERT INTO [dbo].[Check] ([ID], [Name], [Server], [Check Type], [Check Category], [Service], 
-                                                [URL], [Program], [Instance Count], [Database], [Company], [Business Unit], 
-                                                [System], [Job ID], [Object Type], [Object ID]) 
-                                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                    SET IDENTITY_INSERT "Check" OFF;'''
-        values = (check._id, check.name, check.server, check.check_type.name.lower(), check.check_category.name.lower(), check.service, check.url, check.program, check.instance_count, check.database, check.company, check.business_unit, check.system, check.job_id, check.object_type.name.lower(), check.object_id)
-        db.insert(sql, values)
+    check._id = get_storage().add_check(check_values(check))
+    get_catalog().upsert(check)
     return check.to_json()
 
+def encode_cursor(values: list) -> str:
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        return json.loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        abort(400, 'Invalid cursor')
+
+def int_arg(name: str, value) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, f'{name} must be an integer')
+
+def page_size() -> int:
+    return max(1, min(int_arg('limit', request.args.get('limit', 50)), MAX_PAGE_SIZE))
+
+def json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def conditional(etag: str, build):
+    """ Answer 304 when the client already has etag, otherwise build the JSON body """
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(build())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def check_sort_value(check: Check, sort: str):
+    value = getattr(check, sort)
+    return value.name.lower() if hasattr(value, 'name') and not isinstance(value, str) else value
+
+@app.route('/api/checks')
+def api_checks():
+    """ the check catalog: ?check_type=&check_category=&server=&system=&sort=&order=&limit=&cursor= """
+    catalog = get_catalog()
+    sort = request.args.get('sort', '_id')
+    if sort not in CHECK_SORTS:
+        abort(400, f'sort must be one of {CHECK_SORTS}')
+    descending = request.args.get('order', 'asc') == 'desc'
+    try:
+        filters = {f: filter_value(f, request.args[f]) for f in ('check_type', 'check_category', 'server', 'system')
+                   if request.args.get(f)}
+    except ValueError:
+        # an unknown check type or category matches nothing
+        filters = None
+    cursor = request.args.get('cursor', '')
+    limit = page_size()
+
+    def build():
+        checks = catalog.select(**filters) if filters is not None else []
+        key = lambda c: (check_sort_value(c, sort), c._id)
+        checks.sort(key=key, reverse=descending)
+        if len(cursor) > 0:
+            after = decode_cursor(cursor)
+            if not isinstance(after, list) or len(after) != 2:
+                abort(400, 'Invalid cursor')
+            after = tuple(after)
+            try:
+                checks = [c for c in checks if (key(c) < after if descending else key(c) > after)]
+            except TypeError:
+                # a cursor from another sort
+                abort(400, 'Invalid cursor')
+        page = checks[:limit]
+        next_cursor = encode_cursor(list(key(page[-1]))) if len(checks) > limit else None
+        return {'items': [c.to_json() for c in page], 'next_cursor': next_cursor}
+
+    return conditional(catalog.etag('api', request.query_string.decode()), build)
+
+def api_page(table: str, keys: list, columns: dict, read=None):
+    """ A keyset-paginated page of a run or log table, filtered by the query
+        arguments named in columns.  read(filters, after, descending, limit)
+        replaces Storage.page for tables read through another view. """
+    storage = get_storage()
+    read = read or (lambda *args: storage.page(table, keys, *args))
+    descending = request.args.get('order', 'desc') != 'asc'
+    filters = {column: int_arg(arg, request.args[arg]) for arg, column in columns.items() if request.args.get(arg)}
+    cursor = request.args.get('cursor', '')
+    after = decode_cursor(cursor) if len(cursor) > 0 else None
+    if after is not None:
+        if not isinstance(after, list) or len(after) != len(keys) or not all(type(v) is int for v in after):
+            abort(400, 'Invalid cursor')
+        after = tuple(after)
+    limit = page_size()
+
+    def build():
+        names, rows = read(filters, after, descending, limit + 1)
+        items = [{n: json_value(v) for n, v in zip(names, row)} for row in rows[:limit]]
+        next_cursor = encode_cursor([items[-1][k[1:-1]] for k in keys]) if len(rows) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+    # a run that logged no rows to a table under delta logging still changes its view
+    stamp = '-'.join(str(json_value(v)) for t in dict.fromkeys([table, RUN_TABLE]) for v in storage.stamp(t))
+    return conditional(f'{table}-{stamp}-{request.query_string.decode()}', build)
+
+@app.route('/api/runs')
+def api_runs():
+    """ [Run Log]: ?order=&limit=&cursor= """
+    return api_page(RUN_TABLE, ['[ID]'], {})
+
+@app.route('/api/logs/<check_type>')
+def api_logs(check_type):
+    """ a check log table, with the rows delta logging left out rebuilt: ?run_id=&check_id=&is_running=&order=&limit=&cursor= """
+    log = check_type.lower()
+    if log not in LOG_TABLES:
+        abort(404)
+    # a daemon run can log a check more than once, so the row [ID] breaks ties
+    return api_page(LOG_TABLES[log], ['[Run ID]', '[Check ID]', '[ID]'],
+                    {'run_id': '[Run ID]', 'check_id': '[Check ID]', 'is_running': '[Is Running]'},
+                    lambda *args: read_page(get_storage(), log, *args))
+
+@app.route('/metrics')
+def metrics():
+    """ Prometheus metrics of the runner, from its last dumped snapshot, and of this server """
+    registry = Registry()
+    registry.merge(load_snapshot())
+    registry.merge(METRICS.snapshot())
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+def parse_datetime(arg: str, default: datetime) -> datetime:
+    try:
+        return datetime.fromisoformat(request.args[arg]) if request.args.get(arg) else default
+    except ValueError:
+        abort(400, f'{arg} must be an ISO date or datetime')
+
+@app.route('/api/rollups/<int:check_id>')
+def api_rollups(check_id):
+    """ availability and latency of a check from its rollups: ?granularity=hour|day&from=&to= """
+    storage = get_storage()
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ROLLUP_DEFAULT_SPAN:
+        abort(400, f'granularity must be one of {list(ROLLUP_DEFAULT_SPAN)}')
+    end = parse_datetime('to', datetime.now())
+    start = parse_datetime('from', end - ROLLUP_DEFAULT_SPAN[granularity])
+
+    def build():
+        buckets, total = query_rollups(storage, check_id, granularity, start, end)
+        return {'check_id': check_id, 'granularity': granularity, 'from': start.isoformat(), 'to': end.isoformat(),
+                **total.to_json(), 'buckets': [{'start': b.isoformat(), **r.to_json()} for b, r in buckets]}
+
+    if request.args.get('to'):
+        # a closed window only changes when another run is logged
+        stamp = '-'.join(str(json_value(v)) for v in storage.stamp(RUN_TABLE))
+        return conditional(f'rollups-{stamp}-{request.query_string.decode()}', build)
+    return build()
+
+@app.route('/api/events', methods=['POST'])
+def api_events_publish():
+    """ run and check events posted by the runner, one event or a list of them """
+    events = request.get_json(silent=True)
+    if isinstance(events, dict):
+        events = [events]
+    if not isinstance(events, list) or not all(isinstance(e, dict) and 'type' in e for e in events):
+        abort(400, 'expected an event or a list of events, each with a type')
+    for event in events:
+        hub.publish(event)
+    return '', 204
+
+@app.route('/api/events/stream')
+def api_events_stream():
+    """ server-sent events of the current run: the events so far, then each new one as it arrives """
+    last_seq = int_arg('Last-Event-ID', request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+    subscriber = hub.subscribe(last_seq)
+
+    def stream():
+        try:
+            yield 'retry: 2000\n\n'
+            for event in subscriber.replay:
+                yield format_sse(event)
+            while not subscriber.dropped:
+                try:
+                    event = subscriber.queue.get(timeout=SSE_KEEPALIVE_SECS)
+                except Empty:
+                    # a comment line keeps proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_sse(event)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8008, debug=True)
\ No newline at end of file
@@ -1,7 +1,10 @@
 import os
-import subprocess
-from dataclasses import dataclass
+from typing import Dict
+from dataclasses import dataclass, field
 from enum import Enum
+from command import CommandRunner, run_command
+from cache import get_cache
+from metrics import timed
 
 class WinServiceState(Enum):
     Uninitialized = 0
@@ -12,6 +15,51 @@ class WinServiceState(Enum):
     ContinuePending = 5
     PausePending = 6
     Paused = 7
+    Unreachable = -1
+
+@dataclass
+class ServiceInfo:
+    name: str
+    display_name: str = ''
+    state: WinServiceState = WinServiceState.Uninitialized
+
+@dataclass
+class ServiceSnapshot:
+    """ Every service on a host, indexed by lowercased service name """
+    server_name: str
+    services: Dict[str, ServiceInfo] = field(default_factory=dict)
+
+    def lookup(self, name: str) -> ServiceInfo:
+        if name.lower() not in self.services:
+            raise SystemError(f'The specified service does not exist on {self.server_name}: {name}')
+        return self.services[name.lower()]
+
+def parse_sc_query(text: str) -> Dict[str, ServiceInfo]:
+    """ Parse the SERVICE_NAME / DISPLAY_NAME / STATE blocks printed by sc query """
+    services = {}
+    info = None
+    for line in text.splitlines():
+        key, _, value = line.strip().partition(':')
+        key = key.strip()
+        value = value.strip()
+        if key == 'SERVICE_NAME':
+            info = ServiceInfo(value)
+            services[value.lower()] = info
+        elif info is None:
+            continue
+        elif key == 'DISPLAY_NAME':
+            info.display_name = value
+        elif key == 'STATE':
+            info.state = WinServiceState(int(value.split(' ')[0]))
+    return services
+
+def get_service_snapshot(server_name: str, runner: CommandRunner = run_command) -> ServiceSnapshot:
+    """ Query the state of every service on a host with a single sc call """
+    host = [rf'\\{server_name}'] if len(server_name) > 0 else []
+    with timed('service', server_name, 'spawn'):
+        text = runner(['sc', *host, 'query', 'type=', 'service', 'state=', 'all', 'bufsize=', '262144'])
+    with timed('service', server_name, 'parse'):
+        return ServiceSnapshot(server_name, parse_sc_query(text))
 
 @dataclass
 class WinService:
@@ -20,28 +68,36 @@ class WinService:
     display_name: str = ''
     state: WinServiceState = WinServiceState.Uninitialized
     is_running: bool = False
+    snapshot: ServiceSnapshot = field(default=None, repr=False)
+    runner: CommandRunner = field(default=run_command, repr=False)
+    probe: bool = field(default=True, repr=False)
 
     def __post_init__(self):
         if len(self.server_name) == 0:
             self.server_name = os.environ['COMPUTERNAME']
-        self.display_name = self.get_display_name()
+        if not self.probe:
+            return
+        if self.snapshot is not None:
+            info = self.snapshot.lookup(self.name)
+            self.display_name = info.display_name
+            self.state = info.state
+            self.is_running = self.state == WinServiceState.Running
+            return
+        self.display_name = get_cache().get_or_load('service_display_name', (self.server_name.lower(), self.name.lower()),
+                                                     self.get_display_name)
         self.update()
 
     def sc(self, sc_cmd: str) -> str:
-        output = subprocess.run(['sc', rf'\\{self.server_name}', sc_cmd, self.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if output.returncode == 0:
-            return output.stdout.decode()
-        else:
-            raise SystemError(output.stdout.decode())
+        with timed('service', self.server_name, 'spawn'):
+            return self.runner(['sc', rf'\\{self.server_name}', sc_cmd, self.name])
 
     def get_display_name(self) -> str:
         svc_details = self.sc('getdisplayname')
         return [l.strip() for l in svc_details.split('\n') if len(l.strip()) > 0][-1].split('=')[-1].strip()
 
-    def get_state(self) -> str:
+    def get_state(self) -> WinServiceState:
         svc_details = self.sc('query')
-        data = [l.strip() for l in svc_details.split('\n') if len(l.strip()) > 0]
-        return list(WinServiceState)[int(data[2].split(':')[-1].strip().split(' ')[0].strip())]
+        return ServiceSnapshot(self.server_name, parse_sc_query(svc_details)).lookup(self.name).state
 
     def update(self):
         self.state = self.get_state()
@@ -0,0 +1,283 @@
+"""
+Coordinator / worker mode: the coordinator splits a run's checks into one
+shard per target host and hands the shards to worker processes, local or on
+other machines, which probe them and send the results back to be logged as
+one Run
+"""
+
+import os
+import sys
+import socket
+import secrets
+import ipaddress
+import subprocess
+from time import monotonic
+from typing import Dict, List, Tuple
+from threading import Lock, Thread
+from collections import deque
+from multiprocessing.connection import Listener, Client, Connection, wait
+from main import Run, Check, host_key, deadline_key, SCHEDULED_RESULTS
+from catalog import select_checks
+from metrics import METRICS
+from history import dump_tails, merge_tails
+
+DEFAULT_PORT = 8009
+AUTHKEY_ENV = 'SYSTEMS_CHECK_AUTHKEY'
+SHARD_TIMEOUT = 120
+# seconds the coordinator goes without a worker before it probes the remaining shards itself
+WORKER_WAIT = 60
+# seconds the coordinator waits for a finished worker's state
+STATE_WAIT = 10
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except OSError:
+        return False
+
+def get_authkey(host: str, create: bool = False) -> bytes:
+    """ The key workers and the coordinator authenticate each other with,
+        from SYSTEMS_CHECK_AUTHKEY.  Without it a coordinator bound to the
+        loopback interface (create) makes up a key for the workers it starts;
+        anything else refuses to start. """
+    key = os.environ.get(AUTHKEY_ENV, '')
+    if len(key) == 0:
+        if not (create and is_loopback(host)):
+            raise ValueError(f'Set {AUTHKEY_ENV} to the same secret on the coordinator and its workers')
+        # inherited by the local workers
+        key = os.environ[AUTHKEY_ENV] = secrets.token_hex(16)
+    return key.encode()
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return (host or 'localhost', int(port or DEFAULT_PORT))
+
+def partition(checks: List[Check]) -> List[List[Check]]:
+    """ One shard per target host, largest first, so a worker reuses its
+        connections and host snapshots for every check of a shard """
+    shards: Dict[str, List[Check]] = {}
+    for check in checks:
+        shards.setdefault(host_key(check), []).append(check)
+    return sorted(shards.values(), key=len, reverse=True)
+
+def strip(proc):
+    """ Drop the per-host snapshots a result keeps a reference to before it is sent back """
+    for name in ('snapshot', 'table'):
+        if getattr(proc, name, None) is not None:
+            setattr(proc, name, None)
+    return proc
+
+class Coordinator:
+    """ Hands shards to workers as they ask for work, so a slow worker simply
+        takes fewer shards.  The shards of a worker that disconnects go back
+        on the queue, and a shard still out after shard_timeout is also given
+        to the next idle worker; the first result to arrive is logged.  When
+        no worker has been connected for worker_wait seconds serve() returns
+        with shards left, for the caller to probe.  Finished workers send
+        their breaker, deadline, cache, history and metrics state, which is
+        merged into the run's for the hosts whose shards they delivered. """
+    def __init__(self, run: Run, address: Tuple[str, int] = ('localhost', DEFAULT_PORT),
+                 shard_timeout: float = SHARD_TIMEOUT, options: dict = None, worker_wait: float = WORKER_WAIT):
+        self.run = run
+        self.shard_timeout = shard_timeout
+        self.worker_wait = worker_wait
+        self.options = options or {}
+        self.shards = partition(run.checks)
+        self.pending = deque(range(len(self.shards)))
+        self.in_flight: Dict[int, Dict[Connection, float]] = {}
+        self.done = set()
+        # the shards whose result each worker delivered
+        self.delivered: Dict[Connection, List[int]] = {}
+        self.idle: List[Connection] = []
+        self.workers: Dict[Connection, str] = {}
+        self.new_workers: List[Connection] = []
+        self.lock = Lock()
+        self.listener = Listener(address, authkey=get_authkey(address[0], create=True))
+        self.address = self.listener.address
+
+    def accept(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # the listener was closed
+                return
+            with self.lock:
+                self.new_workers.append(conn)
+
+    def serve(self) -> None:
+        """ Hand out shards until every shard has a result, or no worker is left """
+        Thread(target=self.accept, daemon=True).start()
+        alone_since = monotonic()
+        try:
+            while len(self.done) < len(self.shards):
+                with self.lock:
+                    for conn in self.new_workers:
+                        self.workers[conn] = '?'
+                    self.new_workers = []
+                if len(self.workers) > 0:
+                    alone_since = monotonic()
+                elif monotonic() - alone_since > self.worker_wait:
+                    print(f'No worker for {self.worker_wait:g} seconds')
+                    break
+                for conn in wait(list(self.workers), timeout=0.5):
+                    try:
+                        self.handle(conn, conn.recv())
+                    except (EOFError, OSError):
+                        self.lost(conn)
+                self.assign()
+        finally:
+            self.listener.close()
+            for conn in list(self.workers):
+                try:
+                    conn.send(('done',))
+                    self.receive_state(conn)
+                    conn.close()
+                except (EOFError, OSError):
+                    pass
+
+    def receive_state(self, conn: Connection) -> None:
+        """ Wait up to STATE_WAIT seconds for a worker's state, past any late result it still sends """
+        deadline = monotonic() + STATE_WAIT
+        while conn.poll(max(0, deadline - monotonic())):
+            message = conn.recv()
+            if message[0] == 'state':
+                self.merge(conn, message[1])
+                return
+
+    def remaining(self) -> List[Check]:
+        """ The checks of the shards without a result """
+        return [c for shard_id, shard in enumerate(self.shards) if shard_id not in self.done for c in shard]
+
+    def merge(self, conn: Connection, state: dict) -> None:
+        """ Take a finished worker's state for the checks it delivered; the
+            other hosts keep the run's own state """
+        checks = [c for shard_id in self.delivered.get(conn, []) for c in self.shards[shard_id]]
+        hosts = {host_key(c) for c in checks}
+        self.run.breaker.update({host: health for host, health in state['breaker'].items() if host in hosts})
+        if self.run.deadlines is not None and state['deadlines'] is not None:
+            self.run.deadlines.update(state['deadlines'], {deadline_key(c) for c in checks if c.check_type in SCHEDULED_RESULTS})
+        self.run.cache.merge(state['cache'])
+        merge_tails(state['tails'])
+        METRICS.merge(state['metrics'])
+
+    def handle(self, conn: Connection, message: tuple) -> None:
+        kind = message[0]
+        if kind == 'hello':
+            self.workers[conn] = message[1]
+            conn.send(('run', self.run._id, self.options))
+        elif kind == 'ready':
+            self.idle.append(conn)
+        elif kind == 'result':
+            _, shard_id, results, unreachable, deferred, skipped, probes_saved, probes_deferred = message
+            self.in_flight.get(shard_id, {}).pop(conn, None)
+            if shard_id in self.done:
+                return
+            self.done.add(shard_id)
+            self.in_flight.pop(shard_id, None)
+            self.delivered.setdefault(conn, []).append(shard_id)
+            checks = {c._id: c for c in self.shards[shard_id]}
+            with self.run._lock:
+                self.run.unreachable_checks |= unreachable
+                self.run.deferred |= deferred
+                self.run.skipped += skipped
+                self.run.probes_saved += probes_saved
+                self.run.probes_deferred += probes_deferred
+            for check_id, proc, start_dt, end_dt in results:
+                self.run.record(checks[check_id], proc, start_dt, end_dt)
+            print(f'{len(self.done)} of {len(self.shards)} shards: {self.workers[conn]} finished {host_key(checks[results[0][0]]) if results else shard_id}')
+
+    def lost(self, conn: Connection) -> None:
+        print(f'Lost worker {self.workers.pop(conn, "?")}')
+        if conn in self.idle:
+            self.idle.remove(conn)
+        for shard_id, holders in self.in_flight.items():
+            if holders.pop(conn, None) is not None and len(holders) == 0 and shard_id not in self.done:
+                self.pending.appendleft(shard_id)
+
+    def assign(self) -> None:
+        now = monotonic()
+        while len(self.idle) > 0:
+            if len(self.pending) > 0:
+                shard_id = self.pending.popleft()
+            else:
+                # re-issue the longest running shard this worker does not hold yet
+                late = [(min(holders.values()), shard_id) for shard_id, holders in self.in_flight.items()
+                        if shard_id not in self.done and len(holders) > 0 and self.idle[0] not in holders
+                        and now - max(holders.values()) > self.shard_timeout]
+                if len(late) == 0:
+                    return
+                shard_id = min(late)[1]
+            conn = self.idle.pop(0)
+            try:
+                conn.send(('shard', shard_id, self.shards[shard_id]))
+            except OSError:
+                self.pending.appendleft(shard_id)
+                self.lost(conn)
+                continue
+            self.in_flight.setdefault(shard_id, {})[conn] = now
+
+def work(address: Tuple[str, int], name: str = '') -> None:
+    """ Probe shards for a coordinator until it has no more, then send it
+        this process's state instead of saving it """
+    conn = Client(address, authkey=get_authkey(address[0]))
+    conn.send(('hello', name or f'{os.environ.get("COMPUTERNAME", "worker")}:{os.getpid()}'))
+    _, run_id, options = conn.recv()
+    run = Run([], _id=run_id)
+    while True:
+        conn.send(('ready',))
+        message = conn.recv()
+        if message[0] == 'done':
+            break
+        _, shard_id, checks = message
+        results = []
+        skipped, probes_saved, probes_deferred = run.skipped, run.probes_saved, run.probes_deferred
+        run.unreachable_checks = set()
+        run.checks = checks
+        run._progress = 0
+        run.collect(checks, lambda check, proc, start_dt, end_dt: results.append((check._id, strip(proc), start_dt, end_dt)),
+                    **options)
+        deferred = {c._id for c in checks if c._id in run.deferred}
+        conn.send(('result', shard_id, results, run.unreachable_checks, deferred, run.skipped - skipped,
+                   run.probes_saved - probes_saved, run.probes_deferred - probes_deferred))
+    conn.send(('state', {'breaker': run.breaker.dump(),
+                         'deadlines': run.deadlines.dump() if run.deadlines is not None else None,
+                         'cache': run.cache.dump(), 'tails': dump_tails(), 'metrics': METRICS.drain()}))
+    conn.close()
+
+def spawn_workers(address: Tuple[str, int], count: int, threads: int, deadlines: float = None) -> List[subprocess.Popen]:
+    """ Start count local worker processes """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    options = ['--deadlines', str(deadlines)] if deadlines else []
+    return [subprocess.Popen([sys.executable, script, '--worker', f'{address[0]}:{address[1]}',
+                              '--workers', str(threads), *options], stdout=subprocess.DEVNULL)
+            for _ in range(count)]
+
+def run_coordinator(args) -> None:
+    """ Coordinate a run of the selected checks over the workers that connect,
+        starting args.local_workers of them on this machine """
+    run = Run(select_checks(args))
+    options = {'max_workers': max(args.workers, 1), 'per_host': args.per_host,
+               'async_urls': not args.sync_urls, 'batch': not args.no_batch}
+    coordinator = Coordinator(run, parse_address(args.coordinate), args.shard_timeout, options, args.worker_wait)
+    print(f'Coordinating run {run._id}: {len(run.checks)} checks in {len(coordinator.shards)} shards on {coordinator.address}')
+    processes = spawn_workers(coordinator.address, args.local_workers, options['max_workers'], args.deadlines)
+    run.started()
+    try:
+        coordinator.serve()
+        remaining = coordinator.remaining()
+        if len(remaining) > 0:
+            print(f'Probing the {len(remaining)} remaining checks locally')
+            run.collect(remaining, run.record, **options)
+    except BaseException:
+        run.flush_after_error()
+        raise
+    finally:
+        for process in processes:
+            process.wait()
+    run.log_run()
+    print(f'Probes saved: {run.probes_saved} of {len(run.checks)}')
+    print(f'Probes deferred: {run.probes_deferred} of {len(run.checks)}')
+
+def run_worker(args) -> None:
+    work(parse_address(args.worker))
@@ -1,8 +1,12 @@
-from dataclasses import dataclass
+from typing import Dict
+from dataclasses import dataclass, field
 from enum import Enum
 from datetime import date, time, datetime
 # import time
 from database_handler import Db
+from cache import MetadataCache, MISSING, get_cache
+from history import HistoryTail, get_tail
+from metrics import timed, attributed
 
 class FreqType(Enum):
     Never = 0
@@ -27,6 +31,7 @@ class RunStatus(Enum):
     Retry = 2
     Canceled = 3
     In_Progress = 4
+    Unreachable = -1
 
 @dataclass
 class Ssis:
@@ -39,13 +44,23 @@ class Ssis:
     last_run_status: RunStatus = RunStatus.Failed
     is_running: bool = False
 
+    probe: bool = field(default=True, repr=False)
+
     def __post_init__(self):
-        schedule = get_job_schedule(self)
-        
+        if self.probe:
+            with attributed('ssis'):
+                schedule = get_cache().get_or_load('ssis_schedule', schedule_key(self.server, self.job_id),
+                                                   lambda: tuple(get_job_schedule(self)))
+                last_run = get_last_run(self)
+            with timed('ssis', self.server, 'parse'):
+                self.apply(schedule, last_run)
+
+    def apply(self, schedule: tuple[int], last_run: list, cache: MetadataCache = None) -> None:
+        cache = cache or get_cache()
         self.enabled = True if schedule[0] == 1 else False
-        self.minutes_between_runs = calc_minutes_between_runs(schedule)
-        
-        last_run = get_last_run(self)
+        self.minutes_between_runs = cache.get_or_load('minutes_between_runs', tuple(schedule),
+                                                      lambda: calc_minutes_between_runs(schedule))
+
         if last_run is not None:
             d = parse_date(last_run[1])
             t = parse_time(last_run[2])
@@ -61,11 +76,12 @@ def last_run_within_target_run_window(minutes_between_runs: int, last_run_dt: da
     return mins <= minutes_between_runs
 
 def get_last_run(ssis: Ssis) -> list:
-    with Db(ssis.server, 'msdb') as db:
-        history = db.select('SELECT [run_status],[run_date],[run_time] FROM [sysjobhistory] WHERE [job_id] = ? AND [step_id] = 0', (ssis.job_id))
-        history = history.fetchall()
-        if len(history) > 0:
-            return history[-1]
+    return job_history(ssis.server).last(ssis.job_id)
+
+def job_history(server: str) -> HistoryTail:
+    """ The job outcome (step 0) rows of a server's sysjobhistory, tailed by [instance_id] """
+    return get_tail('ssis', server, 'msdb', lambda: HistoryTail(server, 'msdb', '[sysjobhistory]', '[instance_id]', ['[job_id]'],
+                                                               '[run_status],[run_date],[run_time]', where='[step_id] = 0'))
 
 def get_job_schedule(ssis: Ssis) -> tuple[int]:
     with Db(ssis.server, 'msdb') as db:
@@ -78,6 +94,43 @@ def get_job_schedule(ssis: Ssis) -> tuple[int]:
         schedule = schedule.fetchall()[0]
         return schedule
 
+def schedule_key(server: str, job_id: str) -> tuple:
+    return (server.lower(), str(job_id).lower())
+
+def get_ssis_batch(server: str, jobs: Dict[str, str], cache: MetadataCache = None) -> Dict[str, Ssis]:
+    """ Build the Ssis results for every job_id -> name in jobs on one server:
+        each job's latest step 0 history row comes from the server's history
+        tail, and the schedules not already in the metadata cache are read
+        with a single msdb round trip. """
+    cache = cache or get_cache()
+    schedules = {job_id: cache.get('ssis_schedule', schedule_key(server, job_id)) for job_id in jobs}
+    missing = [job_id for job_id, schedule in schedules.items() if schedule is MISSING]
+    with attributed('ssis'):
+        if len(missing) > 0:
+            values = ','.join(['(?)'] * len(missing))
+            with Db(server, 'msdb') as db:
+                rows = db.select(f'''SELECT ids.[job_id], s.[enabled], s.[freq_type], s.[freq_interval], s.[freq_subday_type],
+                                            s.[freq_subday_interval], s.[active_start_time]
+                                     FROM (VALUES {values}) AS ids([job_id])
+                                     OUTER APPLY (SELECT TOP 1 sch.* FROM [sysjobschedules] js
+                                                  JOIN [sysschedules] sch ON sch.[schedule_id] = js.[schedule_id]
+                                                  WHERE js.[job_id] = ids.[job_id]
+                                                  ORDER BY js.[schedule_id]) s''', tuple(missing)).fetchall()
+            for row in rows:
+                if row[1] is None:
+                    raise IndexError(f'No schedule found for SSIS job {row[0]} on {server}')
+                schedules[row[0]] = tuple(row[1:7])
+                cache.put('ssis_schedule', schedule_key(server, row[0]), schedules[row[0]])
+        history = job_history(server)
+        history.refresh(keys=[(job_id,) for job_id in jobs])
+    results = {}
+    with timed('ssis', server, 'parse'):
+        for job_id, name in jobs.items():
+            ssis = Ssis(name, job_id, server, probe=False)
+            ssis.apply(schedules[job_id], history.last(job_id), cache)
+            results[job_id] = ssis
+    return results
+
 def calc_minutes_between_runs(schedule: tuple[int]) -> int:
     freq_type = FreqType(schedule[1])
     freq_interval = schedule[2]
@@ -0,0 +1,34 @@
+"""
+Where the runner and the web server keep their state files, and how they
+are written
+"""
+
+import os
+import threading
+from datetime import datetime
+
+STATE_DIR_ENV = 'SYSTEMS_CHECK_STATE_DIR'
+
+def state_path(name: str) -> str:
+    """ The path of a state file: in SYSTEMS_CHECK_STATE_DIR if set, otherwise
+        next to the code, so every process finds it whatever its working directory """
+    directory = os.environ.get(STATE_DIR_ENV, '') or os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(directory, name)
+
+def replace_file(path: str, text: str) -> None:
+    """ Write a whole file through a temporary file of this process and thread,
+        so concurrent writers never interleave and readers see one or the other """
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def encode_value(value):
+    """ json.dumps default for the datetimes in saved rows """
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    raise TypeError(f'Cannot save {type(value).__name__}')
+
+def decode_value(value: dict):
+    """ json.loads object_hook undoing encode_value """
+    return datetime.fromisoformat(value['dt']) if 'dt' in value else value
@@ -1,12 +1,35 @@
 const docChecksTable = document.querySelector("#checks-table");
-const docCheckRows = docChecksTable.querySelectorAll("tr");
+const docChecksBody = docChecksTable.querySelector("tbody");
 
 const docViewCheckBtn = document.querySelector("#view-edit-check-btn");
 const docAddCheckBtn = document.querySelector("#add-check-btn");
+const docLoadMoreBtn = document.querySelector("#load-more-btn");
+const docFilterCheckType = document.querySelector("#filter-check-type");
+const docFilterCheckCat = document.querySelector("#filter-check-category");
+const docFilterServer = document.querySelector("#filter-server");
+const docRunProgress = document.querySelector("#run-progress");
+
+const PAGE_SIZE = 100;
+const COLUMNS = ["_id", "name", "server", "check_type", "check_category", "service", "url", "program",
+                 "instance_count", "database", "company", "business_unit", "system", "job_id",
+                 "object_type", "object_id"];
 
 let activeRow;
+let nextCursor = null;
+let runState = {};
 
-for (let row of docCheckRows) {
+const addRow = (check) => {
+    let row = document.createElement("tr");
+    for (let column of COLUMNS) {
+        let cell = document.createElement("td");
+        let value = check[column];
+        cell.innerText = ["check_type", "check_category", "object_type"].includes(column) ? value.toUpperCase() : value;
+        row.appendChild(cell);
+    }
+    row.dataset.id = check._id;
+    if (check._id in runState) {
+        row.classList.toggle("has-text-danger", !runState[check._id]);
+    }
     row.addEventListener("click", e => {
         if (activeRow) {
             activeRow.classList.remove("is-selected");
@@ -14,6 +37,30 @@ for (let row of docCheckRows) {
         activeRow = row;
         activeRow.classList.add("is-selected");
     });
+    docChecksBody.appendChild(row);
+}
+
+const loadChecks = async (reset) => {
+    let params = new URLSearchParams({ limit: PAGE_SIZE });
+    if (docFilterCheckType.value) params.set("check_type", docFilterCheckType.value);
+    if (docFilterCheckCat.value) params.set("check_category", docFilterCheckCat.value);
+    if (docFilterServer.value) params.set("server", docFilterServer.value);
+    if (!reset && nextCursor) params.set("cursor", nextCursor);
+    const response = await fetch(`api/checks?${params}`);
+    const data = await response.json();
+    if (reset) {
+        docChecksBody.innerHTML = "";
+        activeRow = undefined;
+    }
+    for (let check of data.items) {
+        addRow(check);
+    }
+    nextCursor = data.next_cursor;
+    if (nextCursor) {
+        docLoadMoreBtn.classList.remove("is-hidden");
+    } else {
+        docLoadMoreBtn.classList.add("is-hidden");
+    }
 }
 
 const getActiveRowID = () => {
@@ -26,4 +73,48 @@ docViewCheckBtn.addEventListener("click", e => {
 
 docAddCheckBtn.addEventListener("click", e => {
     window.location.href = "add";
-})
\ No newline at end of file
+})
+
+docLoadMoreBtn.addEventListener("click", e => {
+    loadChecks(false);
+});
+
+docFilterCheckType.addEventListener("change", e => loadChecks(true));
+docFilterCheckCat.addEventListener("change", e => loadChecks(true));
+docFilterServer.addEventListener("change", e => loadChecks(true));
+
+const showProgress = (text, style) => {
+    docRunProgress.innerText = text;
+    docRunProgress.className = `tag is-medium ${style}`;
+}
+
+const watchRun = () => {
+    // the browser reconnects on its own and the server replays what was missed
+    const events = new EventSource("api/events/stream");
+    events.addEventListener("run_start", e => {
+        const event = JSON.parse(e.data);
+        runState = {};
+        docChecksBody.querySelectorAll("tr.has-text-danger").forEach(row => row.classList.remove("has-text-danger"));
+        showProgress(`Run ${event.run_id}: starting ${event.total} checks`, "is-info");
+    });
+    events.addEventListener("check", e => {
+        const event = JSON.parse(e.data);
+        runState[event.check_id] = event.is_running;
+        const row = docChecksBody.querySelector(`tr[data-id="${event.check_id}"]`);
+        if (row) {
+            row.classList.toggle("has-text-danger", !event.is_running);
+        }
+        showProgress(`Run ${event.run_id}: ${event.progress} of ${event.total}, ${event.running} running, ${event.not_running} not running`,
+                     event.not_running > 0 ? "is-warning" : "is-info");
+    });
+    events.addEventListener("run_finish", e => {
+        const event = JSON.parse(e.data);
+        showProgress(`Run ${event.run_id} finished: ${event.running} running, ${event.not_running} not running`,
+                     event.not_running > 0 ? "is-danger" : "is-success");
+    });
+}
+
+window.addEventListener("load", e => {
+    loadChecks(true);
+    watchRun();
+});
@@ -0,0 +1,497 @@
+"""
+Where checks, runs and check logs are stored: SQL Server in production or a
+local SQLite file for development and benchmarks
+"""
+
+import os
+import sqlite3
+from typing import Dict, List, Set, Tuple
+from database import ConnectionPool
+from database_handler import Db
+
+DB_SERVER = 'NKP8590'
+DB_NAME = 'NKPSystemsCheck'
+STORAGE_ENV = 'SYSTEMS_CHECK_DB'
+
+CHECK_COLUMNS = '''[ID], [Name], [Server], [Check Type], [Check Category], [Service],
+                   [URL], [Program], [Instance Count], [Database], [Company], [Business Unit],
+                   [System], [Job ID], [Object Type], [Object ID]'''
+
+LOG_TABLES = {
+    'job': '[Nav Job Check Log]',
+    'ssis': '[SSIS Check Log]',
+    'program': '[Program Check Log]',
+    'service': '[Service Check Log]',
+    'url': '[URL Check Log]',
+}
+RUN_TABLE = '[Run Log]'
+ROLLUP_TABLES = {
+    'hour': '[Check Rollup Hourly]',
+    'day': '[Check Rollup Daily]',
+}
+ROLLUP_COLUMNS = {
+    'Check ID': ('INT NOT NULL', 'INTEGER NOT NULL'),
+    'Bucket Start': ('DATETIME2 NOT NULL', 'TIMESTAMP NOT NULL'),
+    'Runs': ('INT', 'INTEGER'),
+    'Running': ('INT', 'INTEGER'),
+    'Duration Sum': ('FLOAT', 'REAL'),
+    'Duration Min': ('FLOAT', 'REAL'),
+    'Duration Max': ('FLOAT', 'REAL'),
+    'Sketch': ('NVARCHAR(MAX)', 'TEXT'),
+}
+
+INTERVAL_TABLE = '[Check State Interval]'
+INTERVAL_COLUMNS = {
+    'Check ID': ('INT NOT NULL', 'INTEGER NOT NULL'),
+    'Start DateTime': ('DATETIME2 NOT NULL', 'TIMESTAMP NOT NULL'),
+    'End DateTime': ('DATETIME2', 'TIMESTAMP'),
+    'Is Running': ('INT', 'INTEGER'),
+    'Probes': ('INT', 'INTEGER'),
+    'First Run ID': ('INT', 'INTEGER'),
+    'Last Run ID': ('INT', 'INTEGER'),
+}
+
+LAST_STATE_TABLE = '[Check Last State]'
+LAST_STATE_COLUMNS = {
+    'Check ID': ('INT NOT NULL', 'INTEGER NOT NULL'),
+    'State': ('CHAR(16)', 'TEXT'),
+    'Logged Run ID': ('INT', 'INTEGER'),
+}
+
+UNCHANGED_TABLE = '[Unchanged Check Log]'
+UNCHANGED_COLUMNS = {
+    'Run ID': ('INT NOT NULL', 'INTEGER NOT NULL'),
+    'Log': ('VARCHAR(16) NOT NULL', 'TEXT NOT NULL'),
+    'Check IDs': ('NVARCHAR(MAX)', 'TEXT'),
+    'Base Run ID': ('INT', 'INTEGER'),
+}
+
+# columns added since the original schema: table -> {column: (SQL Server type, SQLite type)}
+MIGRATIONS = {
+    RUN_TABLE: {'Skipped Checks': ('INT', 'INTEGER'), 'Unreachable Hosts': ('NVARCHAR(MAX)', 'TEXT'),
+                'Probes Saved': ('INT', 'INTEGER')},
+}
+
+# log tables given an identity [ID] since the original schema, so every row has a unique key
+ROW_ID_TABLES = list(LOG_TABLES.values())
+
+# indexes added since the original schema: table -> {index name: columns}
+INDEXES = {table: {f'{table[1:-1]} Run Check': ['Run ID', 'Check ID']} for table in LOG_TABLES.values()}
+
+# tables added since the original schema: table -> (columns, primary key)
+NEW_TABLES = {
+    **{table: (ROLLUP_COLUMNS, ['Check ID', 'Bucket Start']) for table in ROLLUP_TABLES.values()},
+    INTERVAL_TABLE: (INTERVAL_COLUMNS, ['Check ID', 'Start DateTime']),
+    LAST_STATE_TABLE: (LAST_STATE_COLUMNS, ['Check ID']),
+    UNCHANGED_TABLE: (UNCHANGED_COLUMNS, ['Run ID', 'Log']),
+}
+
+class SchemaOutOfDate(Exception):
+    ...
+
+class Storage:
+    """ Base class for the check, run and log stores.  Check rows are tuples in
+        CHECK_COLUMNS order; check values are the same without the ID. """
+    dialect = ''
+
+    def __init__(self, server: str, name: str, pool: ConnectionPool = None):
+        self.server = server
+        self.name = name
+        self.pool = pool
+
+    def connect(self) -> Db:
+        return Db(self.server, self.name, self.pool)
+
+    def select_checks(self) -> List[tuple]:
+        with self.connect() as db:
+            return [tuple(row) for row in db.select(f'SELECT {CHECK_COLUMNS} FROM [Check] ORDER BY [ID]').fetchall()]
+
+    def add_check(self, values: tuple) -> int:
+        raise NotImplementedError
+
+    def update_check(self, check_id: int, values: tuple) -> None:
+        with self.connect() as db:
+            db.update('''UPDATE [Check]
+                         SET [Name] = ?, [Server] = ?, [Check Type] = ?,
+                             [Check Category] = ?, [Service] = ?, [URL] = ?,
+                             [Program] = ?, [Instance Count] = ?, [Database] = ?,
+                             [Company] = ?, [Business Unit] = ?, [System] = ?,
+                             [Job ID] = ?, [Object Type] = ?, [Object ID] = ?
+                         WHERE [ID] = ?''', (*values, check_id))
+
+    def delete_check(self, check_id: int) -> None:
+        with self.connect() as db:
+            db.delete('DELETE FROM [Check] WHERE [ID] = ?', (check_id,))
+
+    def new_run_id(self) -> int:
+        """ Allocate and insert the next [Run Log] row """
+        raise NotImplementedError
+
+    def migrate(self) -> None:
+        """ Add the tables and columns newer code writes to an existing database """
+        for table, (columns, key) in NEW_TABLES.items():
+            self.create_table(table, columns, key)
+        for table, columns in MIGRATIONS.items():
+            self.add_columns(table, columns)
+        for table in ROW_ID_TABLES:
+            self.add_row_id(table)
+        for table, indexes in INDEXES.items():
+            for name, columns in indexes.items():
+                self.create_index(table, name, columns)
+
+    def schema_changes(self) -> List[str]:
+        """ The tables and columns migrate() would add, read without changing anything """
+        existing = self.columns([*NEW_TABLES, *MIGRATIONS, *ROW_ID_TABLES])
+        changes = [f'table {table}' for table in NEW_TABLES if table not in existing]
+        for table, columns in MIGRATIONS.items():
+            changes += [f'column {table}.[{column}]' for column in columns if column not in existing.get(table, set())]
+        changes += [f'column {table}.[ID]' for table in ROW_ID_TABLES if 'ID' not in existing.get(table, set())]
+        indexes = self.indexes(list(INDEXES))
+        for table, names in INDEXES.items():
+            changes += [f'index [{name}]' for name in names if name not in indexes.get(table, set())]
+        return changes
+
+    def verify(self) -> None:
+        """ Raise SchemaOutOfDate unless the database has been migrated for this version """
+        changes = self.schema_changes()
+        if len(changes) > 0:
+            raise SchemaOutOfDate(f'{self.name} is missing {", ".join(changes)}; run python storage.py --migrate')
+
+    def columns(self, tables: List[str]) -> Dict[str, Set[str]]:
+        """ The column names of each of tables that exists """
+        raise NotImplementedError
+
+    def indexes(self, tables: List[str]) -> Dict[str, Set[str]]:
+        """ The index names of each of tables that has any """
+        raise NotImplementedError
+
+    def add_row_id(self, table: str) -> None:
+        raise NotImplementedError
+
+    def create_index(self, table: str, name: str, columns: List[str]) -> None:
+        raise NotImplementedError
+
+    def create_table(self, table: str, columns: dict, key: List[str]) -> None:
+        raise NotImplementedError
+
+    def add_columns(self, table: str, columns: dict) -> None:
+        raise NotImplementedError
+
+    def limit(self, sql: str, n: int) -> str:
+        """ Limit a 'SELECT ...' statement to its first n rows """
+        raise NotImplementedError
+
+    def page(self, table: str, keys: List[str], filters: dict = {}, after: tuple = None,
+             descending: bool = True, limit: int = 50) -> Tuple[List[str], List[tuple]]:
+        """ Keyset pagination: up to limit rows of table matching the
+            column = value filters, ordered by keys and starting after the
+            key values in after.  Returns (column names, rows). """
+        sql, values = self.page_sql(table, keys, filters, after, descending)
+        with self.connect() as db:
+            cursor = db.select(self.limit(sql, limit), values)
+            columns = [d[0] for d in cursor.description]
+            return columns, [tuple(row) for row in cursor.fetchall()]
+
+    def page_sql(self, table: str, keys: List[str], filters: dict = {}, after: tuple = None,
+                 descending: bool = True) -> Tuple[str, tuple]:
+        """ The statement and values of page(), without the limit """
+        where = [f'{column} = ?' for column in filters]
+        values = list(filters.values())
+        if after is not None:
+            op = '<' if descending else '>'
+            # (k1, k2) > (a1, a2) written out for both dialects
+            terms = []
+            for i, key in enumerate(keys):
+                equal = [f'{k} = ?' for k in keys[:i]]
+                terms.append('(' + ' AND '.join(equal + [f'{key} {op} ?']) + ')')
+                values.extend(after[:i + 1])
+            where.append('(' + ' OR '.join(terms) + ')')
+        direction = 'DESC' if descending else 'ASC'
+        sql = f'SELECT * FROM {table}'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + ', '.join(f'{k} {direction}' for k in keys)
+        return sql, tuple(values)
+
+    def table_bytes(self, table: str) -> int:
+        """ Space used by a table and its indexes, or None if the database cannot tell """
+        raise NotImplementedError
+
+    def checks_marker(self) -> tuple:
+        """ A cheap value that changes whenever a [Check] row is added, edited or deleted """
+        raise NotImplementedError
+
+    def stamp(self, table: str) -> tuple:
+        """ A cheap value that changes whenever rows are added to a log table,
+            a run is started or finished, or retention purges old rows """
+        with self.connect() as db:
+            if table == RUN_TABLE:
+                row = db.select(self.limit(f'SELECT [ID], [Run End DateTime] FROM {RUN_TABLE} ORDER BY [ID] DESC', 1)).fetchone()
+                purged = db.select(f'SELECT MIN([ID]) FROM {RUN_TABLE}').fetchone()
+            else:
+                row = db.select(f'''SELECT [Run ID], COUNT(*) FROM {table}
+                                    WHERE [Run ID] = (SELECT MAX([Run ID]) FROM {table}) GROUP BY [Run ID]''').fetchone()
+                # a kept keyframe can hold MIN([ID]) in place, but every purge
+                # moves the last run folded into intervals
+                purged = db.select(f'''SELECT (SELECT MIN([ID]) FROM {table}),
+                                           (SELECT MAX([Last Run ID]) FROM {INTERVAL_TABLE})''').fetchone()
+        return (tuple(row) if row is not None else ()) + tuple(purged)
+
+class SqlServerStorage(Storage):
+    dialect = 'mssql'
+
+    def __init__(self, server: str = DB_SERVER, name: str = DB_NAME, pool: ConnectionPool = None):
+        super().__init__(server, name, pool)
+
+    def add_check(self, values: tuple) -> int:
+        # [Check].[ID] is an identity column
+        with self.connect() as db:
+            check_id = db.select(f'''INSERT INTO [dbo].[Check] ({CHECK_COLUMNS.replace('[ID], ', '', 1)})
+                                     OUTPUT INSERTED.[ID]
+                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', values).fetchone()[0]
+            db.commit()
+        return int(check_id)
+
+    def new_run_id(self) -> int:
+        # [Run Log].[ID] is not an identity, so read the max with an index seek
+        # and hold a range lock until the insert commits
+        with self.connect() as db:
+            run_id = db.select('''INSERT INTO [Run Log] ([ID])
+                                  OUTPUT INSERTED.[ID]
+                                  SELECT ISNULL(MAX([ID]), 0) + 1 FROM [Run Log] WITH (UPDLOCK, HOLDLOCK)''').fetchone()[0]
+            db.commit()
+        return int(run_id)
+
+    def limit(self, sql: str, n: int) -> str:
+        return sql.replace('SELECT ', f'SELECT TOP ({int(n)}) ', 1)
+
+    def checks_marker(self) -> tuple:
+        # one row back however many checks there are; an edit that keeps the checksum is missed
+        with self.connect() as db:
+            return tuple(db.select('SELECT COUNT_BIG(*), MAX([ID]), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [Check]').fetchone())
+
+    def table_bytes(self, table: str) -> int:
+        with self.connect() as db:
+            row = db.select('''SELECT SUM([used_page_count]) * 8192 FROM sys.dm_db_partition_stats
+                               WHERE [object_id] = OBJECT_ID(?)''', (table,)).fetchone()
+        return int(row[0]) if row is not None and row[0] is not None else None
+
+    def create_table(self, table: str, columns: dict, key: List[str]) -> None:
+        definition = ', '.join([f'[{column}] {mssql_type}' for column, (mssql_type, _) in columns.items()] +
+                               [f'PRIMARY KEY ({", ".join(f"[{k}]" for k in key)})'])
+        with self.connect() as db:
+            db.update(f'''IF OBJECT_ID(N'{table}', N'U') IS NULL
+                          CREATE TABLE {table} ({definition})''')
+
+    def columns(self, tables: List[str]) -> Dict[str, Set[str]]:
+        existing = {}
+        with self.connect() as db:
+            rows = db.select(f'''SELECT [TABLE_NAME], [COLUMN_NAME] FROM INFORMATION_SCHEMA.COLUMNS
+                                 WHERE [TABLE_SCHEMA] = 'dbo' AND [TABLE_NAME] IN ({", ".join(["?"] * len(tables))})''',
+                             tuple(table[1:-1] for table in tables)).fetchall()
+        for table, column in rows:
+            existing.setdefault(f'[{table}]', set()).add(column)
+        return existing
+
+    def indexes(self, tables: List[str]) -> Dict[str, Set[str]]:
+        existing = {}
+        with self.connect() as db:
+            rows = db.select(f'''SELECT OBJECT_NAME([object_id]), [name] FROM sys.indexes
+                                 WHERE [object_id] IN ({", ".join(["OBJECT_ID(?)"] * len(tables))}) AND [name] IS NOT NULL''',
+                             tuple(tables)).fetchall()
+        for table, name in rows:
+            existing.setdefault(f'[{table}]', set()).add(name)
+        return existing
+
+    def add_row_id(self, table: str) -> None:
+        with self.connect() as db:
+            db.update(f'''IF COL_LENGTH('{table}', 'ID') IS NULL
+                          ALTER TABLE {table} ADD [ID] BIGINT IDENTITY(1, 1) NOT NULL''')
+
+    def create_index(self, table: str, name: str, columns: List[str]) -> None:
+        with self.connect() as db:
+            db.update(f'''IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE [object_id] = OBJECT_ID(?) AND [name] = ?)
+                          CREATE INDEX [{name}] ON {table} ({", ".join(f"[{c}]" for c in columns)})''', (table, name))
+
+    def add_columns(self, table: str, columns: dict) -> None:
+        with self.connect() as db:
+            for column, (mssql_type, _) in columns.items():
+                db.update(f'''IF COL_LENGTH('{table}', '{column}') IS NULL
+                              ALTER TABLE {table} ADD [{column}] {mssql_type} NULL''', commit=False)
+            db.commit()
+
+SQLITE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS [Check] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Name] TEXT, [Server] TEXT, [Check Type] TEXT,
+           [Check Category] TEXT, [Service] TEXT, [URL] TEXT, [Program] TEXT, [Instance Count] INTEGER,
+           [Database] TEXT, [Company] TEXT, [Business Unit] TEXT, [System] TEXT, [Job ID] TEXT,
+           [Object Type] TEXT, [Object ID] INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS [Run Log] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Run Start DateTime] TIMESTAMP, [Run End DateTime] TIMESTAMP,
+           [Total Checks] INTEGER, [Running] INTEGER, [Not Running] INTEGER, [Run Duration (secs)] REAL)''',
+    '''CREATE TABLE IF NOT EXISTS [Nav Job Check Log] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Run ID] INTEGER, [Check ID] INTEGER, [Earliest Start DateTime] TIMESTAMP, [Status] INTEGER,
+           [Job Queue Category Code] TEXT, [Is Running] INTEGER, [Last Run DateTime] TIMESTAMP,
+           [Last Run Status] INTEGER, [Last Run Error Message] TEXT,
+           [Start DateTime] TIMESTAMP, [End DateTime] TIMESTAMP, [Duration (secs)] REAL)''',
+    '''CREATE TABLE IF NOT EXISTS [SSIS Check Log] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Run ID] INTEGER, [Check ID] INTEGER, [Enabled] INTEGER, [Minutes Between Runs] INTEGER,
+           [Last Run DateTime] TIMESTAMP, [Last Run Status] INTEGER, [Is Running] INTEGER,
+           [Start DateTime] TIMESTAMP, [End DateTime] TIMESTAMP, [Duration (secs)] REAL)''',
+    '''CREATE TABLE IF NOT EXISTS [Program Check Log] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Run ID] INTEGER, [Check ID] INTEGER, [Program] TEXT, [Instance Count] INTEGER, [Is Running] INTEGER,
+           [Start DateTime] TIMESTAMP, [End DateTime] TIMESTAMP, [Duration (secs)] REAL)''',
+    '''CREATE TABLE IF NOT EXISTS [Service Check Log] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Run ID] INTEGER, [Check ID] INTEGER, [Service] TEXT, [State] INTEGER, [Is Running] INTEGER,
+           [Start DateTime] TIMESTAMP, [End DateTime] TIMESTAMP, [Duration (secs)] REAL)''',
+    '''CREATE TABLE IF NOT EXISTS [URL Check Log] (
+           [ID] INTEGER PRIMARY KEY AUTOINCREMENT, [Run ID] INTEGER, [Check ID] INTEGER, [URL] TEXT, [Status Code] INTEGER, [Is Running] INTEGER,
+           [Start DateTime] TIMESTAMP, [End DateTime] TIMESTAMP, [Duration (secs)] REAL)''',
+]
+
+def sqlite_connect(server: str, name: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(name, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+class SqliteStorage(Storage):
+    dialect = 'sqlite'
+
+    def __init__(self, path: str, pool: ConnectionPool = None):
+        super().__init__('sqlite', path, pool or ConnectionPool(sqlite_connect))
+        self.create()
+
+    def create(self) -> None:
+        with self.connect() as db:
+            for sql in SQLITE_SCHEMA:
+                db.update(sql, commit=False)
+            db.commit()
+        self.migrate()
+
+    def add_check(self, values: tuple) -> int:
+        with self.connect() as db:
+            cursor = db.insert(f'''INSERT INTO [Check] ({CHECK_COLUMNS.replace('[ID], ', '', 1)})
+                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', values)
+            return cursor.lastrowid
+
+    def new_run_id(self) -> int:
+        with self.connect() as db:
+            return db.insert('INSERT INTO [Run Log] DEFAULT VALUES').lastrowid
+
+    def limit(self, sql: str, n: int) -> str:
+        return f'{sql} LIMIT {int(n)}'
+
+    def checks_marker(self) -> tuple:
+        # SQLite has no table checksum, so any write to the file counts as a change
+        with self.connect() as db:
+            marker = tuple(db.select('SELECT COUNT(*), MAX([ID]) FROM [Check]').fetchone())
+        return marker + tuple(os.stat(path).st_mtime_ns for path in (self.name, f'{self.name}-wal') if os.path.exists(path))
+
+    def table_bytes(self, table: str) -> int:
+        # dbstat needs SQLITE_ENABLE_DBSTAT_VTAB; index pages are listed under their own names
+        name = table[1:-1]
+        try:
+            with self.connect() as db:
+                row = db.select('''SELECT SUM([pgsize]) FROM dbstat
+                                   WHERE [name] = ? OR [name] IN (SELECT [name] FROM sqlite_master
+                                                                 WHERE [type] = 'index' AND [tbl_name] = ?)''',
+                                (name, name)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return int(row[0]) if row[0] is not None else 0
+
+    def create_table(self, table: str, columns: dict, key: List[str]) -> None:
+        definition = ', '.join([f'[{column}] {sqlite_type}' for column, (_, sqlite_type) in columns.items()] +
+                               [f'PRIMARY KEY ({", ".join(f"[{k}]" for k in key)})'])
+        with self.connect() as db:
+            db.update(f'CREATE TABLE IF NOT EXISTS {table} ({definition})')
+
+    def columns(self, tables: List[str]) -> Dict[str, Set[str]]:
+        existing = {}
+        with self.connect() as db:
+            for table in tables:
+                names = {row[1] for row in db.select(f'PRAGMA table_info({table})').fetchall()}
+                if len(names) > 0:
+                    existing[table] = names
+        return existing
+
+    def indexes(self, tables: List[str]) -> Dict[str, Set[str]]:
+        existing = {}
+        with self.connect() as db:
+            for table in tables:
+                names = {row[1] for row in db.select(f'PRAGMA index_list({table})').fetchall()}
+                if len(names) > 0:
+                    existing[table] = names
+        return existing
+
+    def add_row_id(self, table: str) -> None:
+        # SQLite cannot add a key column in place, so the table is copied into a new one
+        with self.connect() as db:
+            columns = [row[1] for row in db.select(f'PRAGMA table_info({table})').fetchall()]
+            if 'ID' in columns:
+                return
+            sql = db.select("SELECT [sql] FROM sqlite_master WHERE [type] = 'table' AND [name] = ?",
+                            (table[1:-1],)).fetchone()[0]
+            old = f'[{table[1:-1]} Old]'
+            names = ', '.join(f'[{c}]' for c in columns)
+            db.update(f'ALTER TABLE {table} RENAME TO {old}', commit=False)
+            db.update(sql.replace('(', '([ID] INTEGER PRIMARY KEY AUTOINCREMENT, ', 1), commit=False)
+            db.update(f'INSERT INTO {table} ({names}) SELECT {names} FROM {old} ORDER BY [Run ID], [Check ID]', commit=False)
+            db.update(f'DROP TABLE {old}', commit=False)
+            db.commit()
+
+    def create_index(self, table: str, name: str, columns: List[str]) -> None:
+        with self.connect() as db:
+            db.update(f'CREATE INDEX IF NOT EXISTS [{name}] ON {table} ({", ".join(f"[{c}]" for c in columns)})')
+
+    def add_columns(self, table: str, columns: dict) -> None:
+        with self.connect() as db:
+            existing = [row[1] for row in db.select(f'PRAGMA table_info({table})').fetchall()]
+            for column, (_, sqlite_type) in columns.items():
+                if column not in existing:
+                    db.update(f'ALTER TABLE {table} ADD COLUMN [{column}] {sqlite_type}', commit=False)
+            db.commit()
+
+_storage: Storage = None
+
+def get_storage() -> Storage:
+    """ The process-wide store: the SQLite file named by SYSTEMS_CHECK_DB if
+        set, otherwise the NKPSystemsCheck SQL Server database, which must
+        already have been migrated with python storage.py --migrate """
+    global _storage
+    if _storage is None:
+        path = os.environ.get(STORAGE_ENV, '')
+        if len(path) > 0:
+            _storage = SqliteStorage(path)
+        else:
+            _storage = SqlServerStorage()
+            _storage.verify()
+    return _storage
+
+def set_storage(storage: Storage) -> None:
+    global _storage
+    _storage = storage
+
+if __name__ == '__main__':
+    # python storage.py --migrate -> add this version's tables and columns to the SQL Server database
+    # python storage.py dev.db checklist.json -> a local database seeded from the checklist
+    from argparse import ArgumentParser
+    from main import get_checks, check_values
+    parser = ArgumentParser(description='Migrate the check store or create a local one')
+    parser.add_argument('path', nargs='?', default='', help='local SQLite database to create')
+    parser.add_argument('checklist', nargs='?', default='', help='checklist to seed an empty local database from')
+    parser.add_argument('--migrate', action='store_true', help=f'migrate the {DB_NAME} database on {DB_SERVER}')
+    args = parser.parse_args()
+    if args.migrate:
+        storage = SqlServerStorage()
+        changes = storage.schema_changes()
+        storage.migrate()
+        print(f'Added {", ".join(changes)}' if len(changes) > 0 else f'{DB_NAME} is up to date')
+    elif len(args.path) > 0:
+        storage = SqliteStorage(args.path)
+        if len(args.checklist) > 0 and len(storage.select_checks()) == 0:
+            for check in get_checks(args.checklist):
+                storage.add_check(check_values(check))
+        print(f'{len(storage.select_checks())} checks in {args.path}')
+    else:
+        parser.print_usage()
@@ -0,0 +1,143 @@
+import pytest
+from threading import Thread, Event
+from breaker import CircuitBreaker, BreakerState, HostUnreachable, TrialPending, is_connect_failure, is_timeout
+
+# stand-ins for pyodbc's exceptions, which is_connect_failure knows by name
+class OperationalError(Exception):
+    ...
+
+class ProgrammingError(Exception):
+    ...
+
+def fail():
+    raise ConnectionError('host down')
+
+def trip(breaker: CircuitBreaker, host: str = 'sql01') -> None:
+    for _ in range(breaker.threshold):
+        with pytest.raises(ConnectionError):
+            breaker.call(host, fail)
+
+def test_opens_after_threshold_connect_failures():
+    breaker = CircuitBreaker(threshold=3)
+    breaker.begin_run(1)
+    trip(breaker)
+    assert breaker.hosts['sql01'].state == BreakerState.OPEN
+    with pytest.raises(HostUnreachable):
+        breaker.call('sql01', lambda: 'probed')
+    assert breaker.hosts['sql01'].skipped == 1
+    assert breaker.open_hosts() == ['sql01']
+
+def test_other_errors_do_not_count():
+    breaker = CircuitBreaker(threshold=1)
+    breaker.begin_run(1)
+    with pytest.raises(KeyError):
+        breaker.call('sql01', lambda: {}['missing'])
+    assert breaker.hosts['sql01'].state == BreakerState.CLOSED
+
+def test_half_open_trial_closes_or_reopens():
+    breaker = CircuitBreaker(threshold=1, cooldown_runs=1)
+    breaker.begin_run(1)
+    trip(breaker)
+    breaker.begin_run(2)
+    assert breaker.hosts['sql01'].state == BreakerState.HALF_OPEN
+    with pytest.raises(ConnectionError):
+        breaker.call('sql01', fail)
+    assert breaker.hosts['sql01'].state == BreakerState.OPEN
+    assert breaker.hosts['sql01'].opened_run == 2
+    breaker.begin_run(3)
+    assert breaker.call('sql01', lambda: 'probed') == 'probed'
+    assert breaker.hosts['sql01'].state == BreakerState.CLOSED
+
+def test_probes_during_a_trial_wait_for_it():
+    breaker = CircuitBreaker(threshold=1)
+    breaker.begin_run(1)
+    trip(breaker)
+    breaker.begin_run(2)
+    started, finish = Event(), Event()
+
+    def trial():
+        started.set()
+        finish.wait(5)
+        return 'trial'
+
+    thread = Thread(target=breaker.call, args=('sql01', trial))
+    thread.start()
+    started.wait(5)
+    with pytest.raises(TrialPending):
+        breaker.allow('sql01', wait=False)
+    finish.set()
+    assert breaker.call('sql01', lambda: 'after') == 'after'
+    thread.join()
+    assert breaker.hosts['sql01'].skipped == 0
+
+def test_a_trial_that_raises_something_else_hands_over():
+    breaker = CircuitBreaker(threshold=1)
+    breaker.begin_run(1)
+    trip(breaker)
+    breaker.begin_run(2)
+    with pytest.raises(KeyError):
+        breaker.call('sql01', lambda: {}['missing'])
+    assert breaker.call('sql01', lambda: 'next') == 'next'
+
+@pytest.mark.parametrize('error, expected', [
+    (ConnectionRefusedError(), True),
+    (TimeoutError('No free connection to sql01/msdb'), False),
+    (OperationalError('08001', '[08001] Named Pipes Provider: Could not open a connection'), True),
+    (OperationalError('HYT00', '[HYT00] Login timeout expired (0)'), True),
+    (OperationalError('HYT00', '[HYT00] Query timeout expired (0)'), False),
+    (ProgrammingError('42S02', "Invalid object name 'x'"), False),
+    (SystemError('[SC] OpenSCManager FAILED 1722: The RPC server is unavailable.'), True),
+    (SystemError('[SC] EnumQueryServicesStatus:OpenService FAILED 1060'), False),
+])
+def test_is_connect_failure(error, expected):
+    assert is_connect_failure(error) == expected
+
+def test_timeouts_leave_the_breaker_alone():
+    breaker = CircuitBreaker(threshold=1)
+    breaker.begin_run(1)
+    error = OperationalError('HYT00', '[HYT00] Query timeout expired (0)')
+
+    def query():
+        raise error
+
+    with pytest.raises(OperationalError):
+        breaker.call('sql01', query)
+    assert is_timeout(error) and is_timeout(TimeoutError('No free connection'))
+    assert breaker.hosts['sql01'].state == BreakerState.CLOSED
+
+def test_url_read_timeout_does_not_open_the_breaker():
+    import socket
+    from url import Url, check_urls
+    from main import probe_failed
+    # a listener that accepts connections but never answers
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+    free = socket.socket()
+    free.bind(('127.0.0.1', 0))
+    refused_port = free.getsockname()[1]
+    free.close()
+    try:
+        slow = Url(f'http://127.0.0.1:{server.getsockname()[1]}/', probe=False)
+        down = Url(f'http://127.0.0.1:{refused_port}/', probe=False)
+        check_urls([slow, down], read_timeout=0.2)
+    finally:
+        server.close()
+    assert slow.status_code == down.status_code == 0
+    assert not slow.connect_failed and down.connect_failed
+    breaker = CircuitBreaker(threshold=2)
+    breaker.begin_run(1)
+    for _ in range(breaker.threshold):
+        breaker.call('slow', lambda: slow, failed=probe_failed)
+        breaker.call('down', lambda: down, failed=probe_failed)
+    assert breaker.hosts['slow'].state == BreakerState.CLOSED
+    assert breaker.hosts['down'].state == BreakerState.OPEN
+
+def test_url_and_server_checks_of_a_host_share_its_key():
+    from main import Check, CheckType, CheckCategory, host_key
+    server = Check(1, 'sql', 'SQL01', CheckType.SERVICE, CheckCategory.NONE)
+    urls = [Check(i, 'web', 'x', CheckType.URL, CheckCategory.NONE, url=url) for i, url in
+            enumerate(['https://sql01.corp.local:8443/app', 'http://SQL01/', 'http://sql01:80/x'], 2)]
+    assert {host_key(check) for check in [server] + urls} == {'sql01'}
+    ip = Check(5, 'web', 'x', CheckType.URL, CheckCategory.NONE, url='http://10.0.0.5:8080/')
+    assert host_key(ip) == '10.0.0.5'
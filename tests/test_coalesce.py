@@ -0,0 +1,48 @@
+from main import Run, Check, CheckType, coalesce, probe_key
+from breaker import CircuitBreaker
+from service import WinService, WinServiceState
+from program import WinProc
+from url import Url
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, sql: str, values: tuple) -> None:
+        self.rows.append(values)
+
+def make_checks() -> list:
+    return [Check(1, 'web', 'SQL01', CheckType.SERVICE, service='W3SVC'),
+            Check(2, 'web again', 'sql01', CheckType.SERVICE, service='w3svc'),
+            Check(3, 'web process', 'sql01', CheckType.PROGRAM, program='w3svc'),
+            Check(4, 'web elsewhere', 'sql02', CheckType.SERVICE, service='w3svc'),
+            Check(5, 'site', 'web', CheckType.URL, url='HTTP://Web/app#top'),
+            Check(6, 'site again', 'web', CheckType.URL, url='http://web:80/app')]
+
+def test_duplicates_collapse_and_other_types_or_servers_do_not():
+    checks = make_checks()
+    assert probe_key(checks[0]) == probe_key(checks[1]) != probe_key(checks[2])
+    assert probe_key(checks[0]) != probe_key(checks[3])
+    first, duplicates = coalesce(checks)
+    assert [check._id for check in first] == [1, 3, 4, 5]
+    assert {check_id: [d._id for d in ds] for check_id, ds in duplicates.items()} == {1: [2], 5: [6]}
+
+def test_each_check_gets_its_own_log_row_from_one_probe():
+    checks = make_checks()
+    run = Run(checks, _id=7, breaker=CircuitBreaker(), writer=ListWriter())
+    probed = []
+
+    def probe(check):
+        probed.append(check._id)
+        if check.check_type == CheckType.SERVICE:
+            return WinService(check.service, check.server, state=WinServiceState.Running, is_running=True, probe=False)
+        elif check.check_type == CheckType.PROGRAM:
+            return WinProc(check.program, check.server, probe=False)
+        return Url(check.url, is_running=True, status_code=200, probe=False)
+
+    run.probe = probe
+    run.collect(run.checks, run.record, async_urls=False, batch=False)
+    assert sorted(probed) == [1, 3, 4, 5]
+    assert run.probes_saved == 2
+    assert sorted(row[1] for row in run.writer.rows) == [1, 2, 3, 4, 5, 6]
+    assert [check.is_running for check in checks] == [True, True, False, True, True, True]
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+from deadline import DeadlineBook, next_slot, last_slot, runs_on, ssis_deadline, jqe_deadline, NAV_BLANK_DT
+from ssis import Ssis
+from job import JobQueueEntry, JobStatus, ObjectType
+from breaker import CircuitBreaker
+from main import Run, Check, CheckType, deadline_key
+
+# (enabled, freq_type, freq_interval, freq_subday_type, freq_subday_interval, active_start_time)
+EVERY_15_MINUTES = (1, 4, 1, 4, 15, 60000)
+MONDAYS_AT_8 = (1, 8, 2, 1, 0, 80000)
+MONTHLY_ON_31ST = (1, 16, 31, 1, 0, 0)
+
+SUNDAY = datetime(2026, 10, 18)
+MONDAY = datetime(2026, 10, 19)
+
+def test_next_slot_within_and_across_days():
+    assert next_slot(EVERY_15_MINUTES, MONDAY.replace(hour=7, minute=7)) == MONDAY.replace(hour=7, minute=15)
+    assert next_slot(EVERY_15_MINUTES, MONDAY.replace(hour=7, minute=15)) == MONDAY.replace(hour=7, minute=30)
+    assert next_slot(EVERY_15_MINUTES, MONDAY.replace(hour=5)) == MONDAY.replace(hour=6)
+    assert next_slot(EVERY_15_MINUTES, MONDAY.replace(hour=23, minute=50)) == MONDAY.replace(hour=6) + timedelta(days=1)
+
+def test_last_slot_within_and_across_days():
+    assert last_slot(EVERY_15_MINUTES, MONDAY.replace(hour=7, minute=7)) == MONDAY.replace(hour=7)
+    assert last_slot(EVERY_15_MINUTES, MONDAY.replace(hour=5)) == SUNDAY.replace(hour=23, minute=45)
+
+def test_weekly_and_monthly_calendars():
+    assert next_slot(MONDAYS_AT_8, MONDAY.replace(hour=9)) == MONDAY.replace(hour=8) + timedelta(days=7)
+    assert last_slot(MONDAYS_AT_8, SUNDAY) == MONDAY.replace(hour=8) - timedelta(days=7)
+    # a monthly schedule on a day past the end of the month runs on its last day
+    assert runs_on(MONTHLY_ON_31ST, datetime(2026, 2, 28).date())
+    assert not runs_on(MONTHLY_ON_31ST, datetime(2026, 2, 27).date())
+
+def ssis(last_run_dt: datetime, is_running: bool = True) -> Ssis:
+    return Ssis('load', 'job-1', 'sql01', enabled=True, minutes_between_runs=30, last_run_dt=last_run_dt,
+                is_running=is_running, probe=False)
+
+def test_ssis_deadline_is_the_next_slot_or_the_run_window_end():
+    now = MONDAY.replace(hour=7, minute=7)
+    assert ssis_deadline(ssis(MONDAY.replace(hour=7)), EVERY_15_MINUTES, now) == MONDAY.replace(hour=7, minute=15)
+    assert ssis_deadline(ssis(MONDAY.replace(hour=7)), MONDAYS_AT_8, now) == MONDAY.replace(hour=7, minute=30)
+    assert ssis_deadline(ssis(MONDAY.replace(hour=7), is_running=False), EVERY_15_MINUTES, now) is None
+
+def test_ssis_deadline_waits_for_a_due_run():
+    # the 07:00 run has not reached the history yet
+    assert ssis_deadline(ssis(MONDAY.replace(hour=6, minute=45)), EVERY_15_MINUTES, MONDAY.replace(hour=7, minute=7)) is None
+
+def jqe(status: JobStatus, **kwargs) -> JobQueueEntry:
+    return JobQueueEntry('sql01', 'NAV', ObjectType.nothing, 50000, 'post', status=status, is_running=True,
+                         earliest_start_date_time=NAV_BLANK_DT, probe=False, **kwargs)
+
+def test_jqe_deadline():
+    assert jqe_deadline(jqe(JobStatus.In_Process), SUNDAY) is None
+    assert jqe_deadline(jqe(JobStatus.Finished), SUNDAY) == datetime.max
+    # an entry that only runs on Mondays holds until Monday starts
+    assert jqe_deadline(jqe(JobStatus.Ready, run_on_mondays=True), SUNDAY.replace(hour=12)) == MONDAY
+    assert jqe_deadline(jqe(JobStatus.Ready, run_on_mondays=True), MONDAY.replace(hour=12)) is None
+
+def test_book_caps_reuses_and_saves(tmp_path):
+    path = str(tmp_path / 'deadlines.json')
+    book = DeadlineBook(max_defer_minutes=60, path=path)
+    now = datetime.now()
+    book.observe('job', jqe(JobStatus.Finished), now)
+    assert book.entries['job'][0] == now + timedelta(minutes=60)
+    reused = book.reuse('job', JobQueueEntry, now + timedelta(minutes=59))
+    assert reused.status == JobStatus.Finished and reused.is_running
+    assert book.reuse('job', JobQueueEntry, now + timedelta(minutes=60)) is None
+    book.save()
+    assert DeadlineBook.load(path).reuse('job', JobQueueEntry, now).object_id_to_run == 50000
+    book.observe('job', jqe(JobStatus.In_Process), now)
+    assert book.reuse('job', JobQueueEntry, now) is None
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, sql: str, values: tuple) -> None:
+        self.rows.append(values)
+
+def test_reused_results_are_logged_without_duration_and_not_rolled_up():
+    book = DeadlineBook()
+    check = Check(1, 'post', 'sql01', CheckType.JOB, database='nav', object_id=50000)
+    book.observe(deadline_key(check), jqe(JobStatus.Finished), datetime.now())
+    run = Run([check], _id=7, breaker=CircuitBreaker(), writer=ListWriter(), deadlines=book)
+    run.collect(run.checks, run.record, batch=False)
+    assert run.probes_deferred == 1
+    assert run.results == []
+    assert run.writer.rows[0][1] == 1 and run.writer.rows[0][-1] is None
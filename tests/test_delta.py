@@ -0,0 +1,117 @@
+import pytest
+import catalog
+from datetime import datetime, timedelta
+from storage import SqliteStorage, set_storage, LOG_TABLES, ROLLUP_TABLES, INTERVAL_TABLE
+from log_writer import LogWriter
+from delta import DeltaLog, read_page, rebuild_run
+from rollup import rebuild_rollups
+from retention import compact_table, get_open_intervals
+from server import app
+
+RUNS = 10
+CHECKS = 3
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'delta.db'))
+    set_storage(storage)
+    catalog._catalog = None
+    yield storage
+    set_storage(None)
+    catalog._catalog = None
+
+def status(run: int, check_id: int) -> int:
+    """ check 2 goes down from run 4, check 3 flaps every third run """
+    if check_id == 2 and run >= 4:
+        return 500
+    if check_id == 3 and run % 3 == 0:
+        return 500
+    return 200
+
+def log_delta_runs(storage, runs: int = RUNS, keyframe_runs: int = 4) -> list:
+    """ runs runs of CHECKS URL checks logged with delta logging; returns every
+        (Run ID, Check ID, Status Code) a full log would have """
+    delta = DeltaLog(keyframe_runs)
+    delta.load(storage)
+    writer = LogWriter(storage)
+    start = datetime(2024, 5, 1)
+    expected = []
+    for run in range(1, runs + 1):
+        run_id = storage.new_run_id()
+        for check_id in range(1, CHECKS + 1):
+            code = status(run, check_id)
+            values = (run_id, check_id, 'http://a', code, int(code == 200), start, start, 0.1)
+            expected.append((run_id, check_id, code))
+            if not delta.skip('url', values):
+                writer.add('''INSERT INTO [URL Check Log] ([Run ID],[Check ID],[URL],[Status Code],[Is Running],
+                                                          [Start DateTime],[End DateTime],[Duration (secs)])
+                              VALUES (?,?,?,?,?,?,?,?)''', values)
+        delta.write(writer, run_id)
+        writer.flush('UPDATE [Run Log] SET [Run Start DateTime] = ?, [Run End DateTime] = ? WHERE [ID] = ?',
+                     (start, start + timedelta(minutes=1), run_id))
+        start += timedelta(minutes=5)
+    return expected
+
+def read_all(client, url: str) -> list:
+    items, cursor = [], None
+    while True:
+        response = client.get(url + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        items += response.json['items']
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            return items
+
+def row_count(storage, table: str) -> int:
+    with storage.connect() as db:
+        return db.select(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+def test_left_out_rows_are_rebuilt(storage):
+    expected = log_delta_runs(storage)
+    assert row_count(storage, LOG_TABLES['url']) < len(expected)
+    names, rows = rebuild_run(storage, 'url', 5)
+    run_col, check_col, code_col = (names.index(c) for c in ('Run ID', 'Check ID', 'Status Code'))
+    assert [(r[run_col], r[check_col], r[code_col]) for r in rows] == [e for e in expected if e[0] == 5]
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+@pytest.mark.parametrize('query', ['', '&check_id=2', '&is_running=0', '&run_id=6'])
+def test_pages_of_the_rebuilt_view(storage, order, query):
+    expected = log_delta_runs(storage)
+    items = read_all(app.test_client(), f'/api/logs/url?limit=4&order={order}{query}')
+    keys = [(item['Run ID'], item['Check ID'], item['ID']) for item in items]
+    assert keys == sorted(keys, reverse=order == 'desc')
+    wanted = [e for e in expected if (query != '&check_id=2' or e[1] == 2) and (query != '&is_running=0' or e[2] != 200)
+              and (query != '&run_id=6' or e[0] == 6)]
+    assert sorted((item['Run ID'], item['Check ID'], item['Status Code']) for item in items) == wanted
+
+def test_full_logs_are_paged_straight_from_the_table(storage):
+    expected = log_delta_runs(storage, keyframe_runs=1)
+    names, rows = read_page(storage, 'url', {}, None, False, 100)
+    assert len(rows) == len(expected) == row_count(storage, LOG_TABLES['url'])
+
+def test_rebuilt_rollups_count_left_out_runs(storage):
+    expected = log_delta_runs(storage)
+    assert rebuild_rollups(storage) == len(expected)
+    with storage.connect() as db:
+        runs = db.select(f'SELECT [Check ID], SUM([Runs]), SUM([Running]) FROM {ROLLUP_TABLES["day"]} GROUP BY [Check ID]').fetchall()
+    assert [tuple(r) for r in runs] == [(c, RUNS, sum(1 for e in expected if e[1] == c and e[2] == 200))
+                                        for c in range(1, CHECKS + 1)]
+
+def test_retention_keeps_the_rows_later_left_out_runs_need(storage):
+    expected = log_delta_runs(storage)
+    table = LOG_TABLES['url']
+    intervals = get_open_intervals(storage)
+    compact_table(storage, table, 6, intervals, batch_size=3)
+    client = app.test_client()
+    items = read_all(client, '/api/logs/url?limit=5&order=asc')
+    # the kept rows stay in the view until a newer row of their check is purged
+    assert len([item for item in items if item['Run ID'] <= 6]) <= CHECKS
+    assert sorted((item['Run ID'], item['Check ID'], item['Status Code']) for item in items
+                  if item['Run ID'] > 6) == [e for e in expected if e[0] > 6]
+    # a second pass does not fold the kept rows again
+    probes = {c: i.probes for c, i in intervals.items()}
+    compact_table(storage, table, 6, intervals)
+    assert {c: i.probes for c, i in intervals.items()} == probes
+    with storage.connect() as db:
+        folded = db.select(f'SELECT SUM([Probes]) FROM {INTERVAL_TABLE}').fetchone()[0]
+    assert folded == sum(1 for e in expected if e[0] <= 6)
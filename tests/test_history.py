@@ -0,0 +1,139 @@
+import re
+import sqlite3
+import pytest
+import history
+from history import HistoryTail
+
+class FakeDb:
+    """ Runs a tail's SQL Server statements on an SQLite table """
+    queries = []
+
+    def __init__(self, con: sqlite3.Connection):
+        self.con = con
+
+    def __call__(self, server: str, database: str) -> 'FakeDb':
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        ...
+
+    def select(self, sql: str, values: tuple = ()):
+        sql = ' '.join(sql.split())
+        self.queries.append(sql)
+        apply = re.search(r'AS k\((.*?)\) OUTER APPLY \(SELECT TOP 1 (.*?) FROM (\S+) WHERE (.*) ORDER BY (\S+) DESC\) h', sql)
+        if apply is not None:
+            names, fields, table, where, mark = apply.groups()
+            n = len(names.split(', '))
+            where = re.sub(r'k\.\[k\d+\]', '?', where)
+            rows = []
+            for i in range(0, len(values), n):
+                key = tuple(values[i:i + n])
+                row = self.con.execute(f'SELECT {fields} FROM {table} WHERE {where} ORDER BY {mark} DESC LIMIT 1', key).fetchone()
+                rows.append(key + (tuple(row) if row is not None else (None,) * (len(fields.split(', ')))))
+            return FakeCursor(rows)
+        top = re.search(r'TOP (\d+) ', sql)
+        if top is not None:
+            sql = sql.replace(top.group(0), '') + f' LIMIT {top.group(1)}'
+        return self.con.execute(sql, values)
+
+class FakeCursor:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def fetchall(self) -> list:
+        return self.rows
+
+@pytest.fixture
+def log(monkeypatch):
+    con = sqlite3.connect(':memory:')
+    con.execute('CREATE TABLE log ([entry] INTEGER PRIMARY KEY, [oid] INT, [descr] TEXT COLLATE NOCASE, [status] INT)')
+    monkeypatch.setattr(history, 'Db', FakeDb(con))
+    FakeDb.queries = []
+    return con
+
+def add(con, oid: int, descr: str, status: int) -> None:
+    con.execute('INSERT INTO log ([oid], [descr], [status]) VALUES (?,?,?)', (oid, descr, status))
+
+def make_tail() -> HistoryTail:
+    # status 1 is a run still in process
+    return HistoryTail('s', 'd', 'log', '[entry]', ['[oid]', '[descr]'], '[status]',
+                       unsettled=lambda row: row[0] == 1, batch_size=2, refresh_secs=0)
+
+def test_cold_start_reads_the_mark_and_each_job_once(log):
+    add(log, 1, 'A', 0)
+    add(log, 1, 'A', 2)
+    add(log, 2, 'B', 0)
+    tail = make_tail()
+    assert tail.last(1, 'a') == (2,)
+    assert tail.mark == 3
+    assert not any('GROUP BY' in q for q in FakeDb.queries)
+    assert tail.last(9, 'none') is None
+    FakeDb.queries = []
+    tail.refresh(keys=[(1, 'a'), (9, 'NONE')])
+    # known jobs, and jobs known to have no rows, are not looked up again
+    assert not any('APPLY' in q for q in FakeDb.queries)
+
+def test_rows_past_the_mark_and_unsettled_rows_are_read_again(log):
+    add(log, 1, 'A', 0)
+    tail = make_tail()
+    assert tail.last(1, 'A') == (0,)
+    add(log, 1, 'A', 1)
+    add(log, 3, 'C', 0)
+    add(log, 3, 'C', 2)
+    tail.refresh()
+    assert tail.last(1, 'A') == (1,) and tail.last(3, 'C') == (2,)
+    assert tail.pending == {2}
+    log.execute('UPDATE log SET [status] = 0 WHERE [entry] = 2')
+    assert tail.last(1, 'A') == (0,)
+    assert tail.pending == set()
+
+def test_saved_state_carries_on_past_the_mark(log, tmp_path, monkeypatch):
+    monkeypatch.setattr(history, '_tails', {})
+    monkeypatch.setattr(history, '_saved', None)
+    path = str(tmp_path / 'history_state.json')
+    add(log, 1, 'A', 0)
+    history.load_tails(path)
+    tail = history.get_tail('job', 'S', 'D', make_tail)
+    assert tail.last(1, 'A') == (0,)
+    history.save_tails(path)
+
+    # a new process
+    monkeypatch.setattr(history, '_tails', {})
+    monkeypatch.setattr(history, '_saved', None)
+    add(log, 1, 'A', 2)
+    history.load_tails(path)
+    FakeDb.queries = []
+    tail = history.get_tail('job', 's', 'd', make_tail)
+    assert tail.last(1, 'A') == (2,)
+    assert not any('APPLY' in q for q in FakeDb.queries)
+    assert any('> ?' in q for q in FakeDb.queries)
+
+def test_saved_state_is_dropped_when_the_marks_start_over(log, tmp_path, monkeypatch):
+    tail = make_tail()
+    tail.restore({'mark': 100, 'pending': [], 'latest': [[[1, 'a'], 100, [2]]]})
+    add(log, 1, 'A', 0)
+    assert tail.last(1, 'A') == (0,)
+    assert tail.mark == 1
+
+def test_rows_added_during_a_lookup_are_not_skipped(log, monkeypatch):
+    add(log, 1, 'A', 0)
+    add(log, 2, 'B', 0)
+    tail = make_tail()
+    lookup = tail.lookup
+
+    def racing_lookup(*args):
+        # two jobs log a run between the scan past the mark and the lookup
+        add(log, 2, 'B', 3)
+        add(log, 1, 'A', 2)
+        lookup(*args)
+
+    monkeypatch.setattr(tail, 'lookup', racing_lookup)
+    tail.refresh(keys=[(1, 'A')])
+    assert tail.mark == 2
+    monkeypatch.setattr(tail, 'lookup', lookup)
+    tail.refresh(force=True)
+    assert tail.last(2, 'B') == (3,) and tail.last(1, 'A') == (2,)
+    assert tail.mark == 4
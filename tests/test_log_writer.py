@@ -0,0 +1,40 @@
+import os
+import glob
+from datetime import datetime
+from storage import SqliteStorage
+from log_writer import LogWriter, read_journal
+
+INSERT = 'INSERT INTO [URL Check Log] ([Run ID],[Check ID],[URL],[Is Running],[Start DateTime]) VALUES (?,?,?,?,?)'
+
+def logged(storage) -> list:
+    with storage.connect() as db:
+        return db.select('SELECT [Run ID],[Check ID],[Start DateTime] FROM [URL Check Log] ORDER BY [Check ID]').fetchall()
+
+def test_rows_of_a_dead_writer_are_replayed(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'log.db'))
+    journal = str(tmp_path / 'journal')
+    start = datetime(2024, 5, 1, 12, 30)
+    writer = LogWriter(storage, flush_size=2, journal=journal)
+    for check_id in (1, 2, 3):
+        writer.add(INSERT, (1, check_id, 'http://a', 1, start))
+    assert [row[1] for row in logged(storage)] == [1, 2]
+    # the process dies with check 3 only in the journal
+    writer.journal.close()
+    writer.journal = None
+
+    LogWriter(storage, journal=journal).close()
+    assert [tuple(row) for row in logged(storage)] == [(1, 1, start), (1, 2, start), (1, 3, start)]
+    assert glob.glob(f'{journal}.*') == []
+
+def test_a_live_writer_keeps_its_journal(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'log.db'))
+    journal = str(tmp_path / 'journal')
+    writer = LogWriter(storage, journal=journal)
+    writer.add(INSERT, (1, 1, 'http://a', 1, datetime(2024, 5, 1)))
+    LogWriter(storage, journal=journal).close()
+    assert logged(storage) == []
+    with open(writer.journal_path) as f:
+        assert list(read_journal(f)) == [INSERT]
+    writer.close()
+    assert len(logged(storage)) == 1
+    assert not os.path.exists(writer.journal_path)
@@ -0,0 +1,90 @@
+import pytest
+import catalog
+from datetime import datetime, timedelta
+from storage import SqliteStorage, set_storage
+from server import app, encode_cursor
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'paging.db'))
+    set_storage(storage)
+    catalog._catalog = None
+    yield storage
+    set_storage(None)
+    catalog._catalog = None
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def log_runs(storage, runs: int, checks: int, repeats: int = 1) -> None:
+    """ runs runs in which every check is logged repeats times, as a daemon window can """
+    start = datetime(2024, 5, 1)
+    with storage.connect() as db:
+        for run in range(runs):
+            run_id = db.insert('INSERT INTO [Run Log] ([Run Start DateTime],[Run End DateTime]) VALUES (?,?)',
+                               (start, start + timedelta(minutes=1))).lastrowid
+            for check_id in range(1, checks + 1):
+                for repeat in range(repeats):
+                    db.insert('''INSERT INTO [URL Check Log] ([Run ID],[Check ID],[URL],[Status Code],[Is Running],
+                                                              [Start DateTime],[End DateTime],[Duration (secs)])
+                                 VALUES (?,?,?,?,?,?,?,?)''', (run_id, check_id, 'http://a', 200, (check_id + repeat) % 2,
+                                                               start, start, 0.1))
+            start += timedelta(minutes=5)
+
+def read_all(client, url: str) -> list:
+    items, cursor = [], None
+    while True:
+        response = client.get(url + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        items += response.json['items']
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            return items
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_log_pages_keep_rows_with_the_same_run_and_check(storage, client, order):
+    log_runs(storage, runs=3, checks=2, repeats=3)
+    items = read_all(client, f'/api/logs/url?limit=4&order={order}')
+    ids = [item['ID'] for item in items]
+    assert sorted(ids) == list(range(1, 19))
+    keys = [(item['Run ID'], item['Check ID'], item['ID']) for item in items]
+    assert keys == sorted(keys, reverse=order == 'desc')
+
+def test_log_pages_filter(storage, client):
+    log_runs(storage, runs=4, checks=3)
+    items = read_all(client, '/api/logs/url?limit=2&check_id=2')
+    assert [(item['Run ID'], item['Check ID']) for item in items] == [(4, 2), (3, 2), (2, 2), (1, 2)]
+    items = read_all(client, '/api/logs/url?limit=5&is_running=1&order=asc')
+    assert {item['Check ID'] for item in items} == {1, 3} and len(items) == 8
+
+def test_run_pages(storage, client):
+    log_runs(storage, runs=5, checks=1)
+    assert [item['ID'] for item in read_all(client, '/api/runs?limit=2')] == [5, 4, 3, 2, 1]
+
+@pytest.mark.parametrize('url', [
+    '/api/runs?limit=ten',
+    '/api/logs/url?check_id=abc',
+    '/api/logs/url?cursor=not-base64!',
+    f'/api/logs/url?cursor={encode_cursor([1, 2])}',
+    f'/api/logs/url?cursor={encode_cursor(["1", 2, 3])}',
+    f'/api/checks?sort=name&cursor={encode_cursor([1, 2])}',
+    f'/api/checks?cursor={encode_cursor({"a": 1})}',
+])
+def test_bad_arguments_are_rejected(storage, client, url):
+    with storage.connect() as db:
+        db.insert('''INSERT INTO [Check] ([Name],[Server],[Check Type],[Check Category],[URL],[Instance Count],[Object Type],[Object ID])
+                     VALUES ('site','web01','URL','AVA','http://a',0,'nothing',0)''')
+    assert client.get(url).status_code == 400
+
+def test_etag_changes_when_retention_purges_rows(storage, client):
+    from storage import LOG_TABLES
+    from retention import compact_table, get_open_intervals, purge_runs
+    log_runs(storage, runs=4, checks=2)
+    etag = client.get('/api/logs/url?limit=2').headers['ETag']
+    assert client.get('/api/logs/url?limit=2', headers={'If-None-Match': etag}).status_code == 304
+    compact_table(storage, LOG_TABLES['url'], 2, get_open_intervals(storage))
+    assert client.get('/api/logs/url?limit=2', headers={'If-None-Match': etag}).status_code == 200
+    etag = client.get('/api/runs?limit=2').headers['ETag']
+    purge_runs(storage, 2)
+    assert client.get('/api/runs?limit=2', headers={'If-None-Match': etag}).status_code == 200
@@ -0,0 +1,35 @@
+from program import parse_tasklist, get_process_table, WinProc
+
+TASKLIST = '''
+"System Idle Process","0","Services","0","8 K"
+"sqlservr.exe","2412","Services","0","1,204,516 K"
+"ProdSP2.exe","5120","Console","1","45,200 K"
+"prodsp2.exe","6004","Console","1","44,812 K"
+"Image, with comma.exe","77","Console","1","1,000 K"
+INFO: No tasks are running which match the specified criteria.
+'''
+
+def test_parse_tasklist():
+    processes = parse_tasklist(TASKLIST)
+    assert processes['sqlservr.exe'] == [2412]
+    assert processes['prodsp2.exe'] == [5120, 6004]
+    assert processes['image, with comma.exe'] == [77]
+    assert processes['system idle process'] == [0]
+    assert len(processes) == 4
+
+def test_instance_count():
+    assert WinProc('ProdSP2.exe', 'app01', tasklist=TASKLIST, should_be_running_count=2).is_running
+    proc = WinProc('ProdSP2.exe', 'app01', tasklist=TASKLIST, should_be_running_count=3)
+    assert proc.instances == [5120, 6004] and not proc.is_running
+    assert not WinProc('missing.exe', 'app01', tasklist=TASKLIST).is_running
+
+def test_process_table_is_reused_within_its_ttl():
+    calls = []
+    def runner(args):
+        calls.append(args)
+        return TASKLIST
+    table = get_process_table('app02', 60, runner)
+    assert get_process_table('APP02', 60, runner) is table
+    assert len(calls) == 1 and calls[0][:3] == ['tasklist', '/s', r'\\app02']
+    assert get_process_table('app02', 0, runner) is not table
+    assert len(calls) == 2
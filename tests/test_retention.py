@@ -0,0 +1,63 @@
+import pytest
+from datetime import datetime, timedelta
+from storage import SqliteStorage, LOG_TABLES, INTERVAL_TABLE, INTERVAL_COLUMNS
+from retention import compact_table, get_open_intervals
+
+TABLE = LOG_TABLES['url']
+START = datetime(2024, 5, 1)
+
+def is_running(run: int, check_id: int) -> bool:
+    """ check 1 is always up, check 2 is down in runs 4 to 6 """
+    return check_id == 1 or not 4 <= run <= 6
+
+@pytest.fixture
+def storage(tmp_path):
+    """ 8 runs five minutes apart, in which check 1 is logged once and check 2 twice """
+    storage = SqliteStorage(str(tmp_path / 'retention.db'))
+    with storage.connect() as db:
+        for run in range(1, 9):
+            start = START + timedelta(minutes=5 * (run - 1))
+            run_id = db.insert('INSERT INTO [Run Log] ([Run Start DateTime],[Run End DateTime]) VALUES (?,?)',
+                               (start, start + timedelta(minutes=1))).lastrowid
+            for check_id in (1, 2, 2):
+                db.insert('''INSERT INTO [URL Check Log] ([Run ID],[Check ID],[URL],[Status Code],[Is Running],
+                                                          [Start DateTime],[End DateTime],[Duration (secs)])
+                             VALUES (?,?,?,?,?,?,?,?)''', (run_id, check_id, 'http://a', 200, int(is_running(run, check_id)),
+                                                           start, start, 0.1))
+    return storage
+
+def run_ids(storage) -> list:
+    with storage.connect() as db:
+        return [row[0] for row in db.select(f'SELECT [Run ID] FROM {TABLE} ORDER BY [ID]').fetchall()]
+
+def stored_intervals(storage) -> list:
+    columns = ', '.join(f'[{c}]' for c in INTERVAL_COLUMNS)
+    with storage.connect() as db:
+        rows = db.select(f'SELECT {columns} FROM {INTERVAL_TABLE} ORDER BY [Check ID], [Start DateTime]').fetchall()
+    # (check ID, is running, probes, first run, last run)
+    return [(row[0], bool(row[3]), row[4], row[5], row[6]) for row in rows]
+
+@pytest.mark.parametrize('batch_size', [2, 3, 1000])
+def test_rows_up_to_the_cutoff_are_compacted_and_newer_rows_kept(storage, batch_size):
+    purged, added = compact_table(storage, TABLE, 5, get_open_intervals(storage), batch_size=batch_size)
+    # the cutoff run is compacted, the one after it is not, whatever the batches
+    assert purged == 5 * 3
+    assert run_ids(storage) == [6] * 3 + [7] * 3 + [8] * 3
+    assert added == 3
+    assert stored_intervals(storage) == [(1, True, 5, 1, 5), (2, True, 6, 1, 3), (2, False, 4, 4, 5)]
+
+def test_a_later_compaction_extends_the_open_intervals(storage):
+    compact_table(storage, TABLE, 5, get_open_intervals(storage), batch_size=2)
+    purged, added = compact_table(storage, TABLE, 7, get_open_intervals(storage), batch_size=2)
+    assert (purged, added) == (6, 1)
+    assert run_ids(storage) == [8] * 3
+    assert stored_intervals(storage) == [(1, True, 7, 1, 7), (2, True, 6, 1, 3), (2, False, 6, 4, 6),
+                                         (2, True, 2, 7, 7)]
+    with storage.connect() as db:
+        end = db.select(f'SELECT [End DateTime] FROM {INTERVAL_TABLE} WHERE [Check ID] = 1').fetchone()[0]
+    assert end == START + timedelta(minutes=30)
+
+def test_nothing_past_the_cutoff_is_touched(storage):
+    assert compact_table(storage, TABLE, 0, get_open_intervals(storage)) == (0, 0)
+    assert len(run_ids(storage)) == 8 * 3
+    assert stored_intervals(storage) == []
@@ -0,0 +1,76 @@
+import random
+import pytest
+from datetime import datetime, timedelta
+from storage import SqliteStorage
+from rollup import Sketch, Rollup, SKETCH_ACCURACY, update_rollups, query_rollups
+
+def durations(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [rng.lognormvariate(-1, 1.5) for _ in range(count)]
+
+@pytest.mark.parametrize('q', [0.01, 0.5, 0.9, 0.95, 0.99])
+def test_quantiles_are_within_the_sketch_accuracy(q):
+    values = durations(5000)
+    sketch = Sketch()
+    for value in values:
+        sketch.add(value)
+    exact = sorted(values)[int(q * (len(values) - 1))]
+    assert abs(sketch.quantile(q) - exact) <= SKETCH_ACCURACY * exact
+
+def test_merged_sketches_match_one_sketch_of_all_values():
+    first, second = durations(1000, seed=1), durations(700, seed=2)
+    merged, whole, other = Sketch(), Sketch(), Sketch()
+    for value in first:
+        merged.add(value)
+        whole.add(value)
+    for value in second:
+        other.add(value)
+        whole.add(value)
+    merged.merge(Sketch.from_text(other.to_text()))
+    assert merged.counts == whole.counts
+    assert merged.quantile(0.99) == whole.quantile(0.99)
+
+def test_rollups_merge_and_leave_untimed_runs_out_of_latency():
+    hour, rest = Rollup(), Rollup()
+    hour.add(True, 0.5)
+    hour.add(False, None)
+    rest.add(True, 0.2)
+    rest.add(True, 2.0)
+    hour.merge(rest)
+    assert (hour.runs, hour.running, hour.timed()) == (4, 3, 3)
+    assert (hour.duration_min, hour.duration_max) == (0.2, 2.0)
+    assert hour.to_json()['duration_avg'] == pytest.approx(0.9)
+    # a bucket of untimed runs does not reset the minimum
+    untimed = Rollup()
+    untimed.add(True, None)
+    hour.merge(untimed)
+    assert hour.duration_min == 0.2 and hour.runs == 5
+
+def results(start: datetime, count: int, check_ids: range) -> list:
+    """ one result per check every 10 minutes from start """
+    rng = random.Random(start.hour)
+    return [(check_id, rng.random() < 0.8, start + timedelta(minutes=10 * i), rng.uniform(0.05, 3))
+            for i in range(count) for check_id in check_ids]
+
+def test_incremental_updates_match_one_update(tmp_path):
+    start = datetime(2024, 5, 1, 9, 30)
+    batches = [results(start, 6, range(1, 4)), results(start + timedelta(hours=1), 9, range(1, 4)),
+               results(start + timedelta(hours=2, minutes=55), 3, range(2, 5))]
+    incremental = SqliteStorage(str(tmp_path / 'incremental.db'))
+    for batch in batches:
+        update_rollups(incremental, batch)
+    once = SqliteStorage(str(tmp_path / 'once.db'))
+    update_rollups(once, [r for batch in batches for r in batch])
+    day = start.replace(hour=0, minute=0)
+    for check_id in range(1, 5):
+        for granularity in ('hour', 'day'):
+            got, total = query_rollups(incremental, check_id, granularity, day, day + timedelta(days=1))
+            want, want_total = query_rollups(once, check_id, granularity, day, day + timedelta(days=1))
+            assert [bucket for bucket, _ in got] == [bucket for bucket, _ in want]
+            for (_, r), (_, w) in zip(got, want):
+                assert r.sketch.counts == w.sketch.counts
+                assert r.to_json() == pytest.approx(w.to_json())
+        assert total.runs == sum(1 for batch in batches for r in batch if r[0] == check_id)
+        assert total.to_json() == pytest.approx(want_total.to_json())
+    hours, _ = query_rollups(incremental, 2, 'hour', day, day + timedelta(days=1))
+    assert [bucket.hour for bucket, _ in hours] == [9, 10, 11, 12]
@@ -0,0 +1,48 @@
+from threading import Lock
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from main import Check, CheckType
+from storage import SqliteStorage
+from scheduler import Scheduler
+
+class ListCatalog:
+    def __init__(self, checks):
+        self.checks = {check._id: check for check in checks}
+
+    def all(self):
+        return list(self.checks.values())
+
+    def get(self, check_id):
+        return self.checks.get(check_id)
+
+def test_per_host_cap_is_kept_at_dispatch_without_blocking_workers(tmp_path):
+    checks = [Check(i, f'check {i}', 'sql01' if i <= 4 else 'sql02', CheckType.SERVICE, service='w3svc')
+              for i in range(1, 7)]
+    scheduler = Scheduler(SqliteStorage(str(tmp_path / 'scheduler.db')), intervals={CheckType.SERVICE: 60},
+                          jitter=0, max_workers=4, per_host=1)
+    scheduler.catalog = ListCatalog(checks)
+    lock, running, started = Lock(), {}, []
+
+    def execute(run, check):
+        with lock:
+            running[check.server] = running.get(check.server, 0) + 1
+            started.append((check.server, running[check.server], sum(running.values())))
+        sleep(0.05)
+        with lock:
+            running[check.server] -= 1
+            if len(started) == len(checks):
+                scheduler.stop()
+
+    scheduler.execute = execute
+    scheduler.window = scheduler.new_window()
+    scheduler.window_end = float('inf')
+    scheduler.futures = []
+    for check in checks:
+        scheduler.schedule(check._id, 0)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        scheduler.dispatch(pool)
+    assert sorted(server for server, _, _ in started) == ['sql01'] * 4 + ['sql02'] * 2
+    # never two probes of a host at once, but the hosts were probed side by side
+    assert all(count == 1 for _, count, _ in started)
+    assert max(total for _, _, total in started) == 2
+    assert scheduler.in_flight == {'sql01': 0, 'sql02': 0}
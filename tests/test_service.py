@@ -0,0 +1,44 @@
+import pytest
+from service import parse_sc_query, get_service_snapshot, WinService, WinServiceState
+
+SC_QUERY = '''
+SERVICE_NAME: MSSQLSERVER
+DISPLAY_NAME: SQL Server (MSSQLSERVER)
+        TYPE               : 10  WIN32_OWN_PROCESS
+        STATE              : 4  RUNNING
+                                (STOPPABLE, PAUSABLE, ACCEPTS_SHUTDOWN)
+        WIN32_EXIT_CODE    : 0  (0x0)
+        SERVICE_EXIT_CODE  : 0  (0x0)
+        CHECKPOINT         : 0x0
+        WAIT_HINT          : 0x0
+
+SERVICE_NAME: SQLSERVERAGENT
+DISPLAY_NAME: SQL Server Agent (MSSQLSERVER)
+        TYPE               : 10  WIN32_OWN_PROCESS
+        STATE              : 1  STOPPED
+        WIN32_EXIT_CODE    : 1077  (0x435)
+'''
+
+def test_parse_sc_query():
+    services = parse_sc_query(SC_QUERY)
+    assert list(services) == ['mssqlserver', 'sqlserveragent']
+    assert services['mssqlserver'].display_name == 'SQL Server (MSSQLSERVER)'
+    assert services['mssqlserver'].state == WinServiceState.Running
+    assert services['sqlserveragent'].state == WinServiceState.Stopped
+
+def test_parse_sc_query_ignores_text_before_the_first_service():
+    assert parse_sc_query('[SC] EnumQueryServicesStatus:OpenService FAILED 5:\n\nAccess is denied.\n') == {}
+
+def test_services_share_one_snapshot():
+    calls = []
+    def runner(args):
+        calls.append(args)
+        return SC_QUERY
+    snapshot = get_service_snapshot('sql01', runner)
+    agent = WinService('SqlServerAgent', 'sql01', snapshot=snapshot)
+    sql = WinService('MSSQLSERVER', 'sql01', snapshot=snapshot)
+    assert len(calls) == 1 and calls[0][:2] == ['sc', r'\\sql01']
+    assert (agent.state, agent.is_running) == (WinServiceState.Stopped, False)
+    assert sql.is_running and sql.display_name == 'SQL Server (MSSQLSERVER)'
+    with pytest.raises(SystemError):
+        WinService('Missing', 'sql01', snapshot=snapshot)
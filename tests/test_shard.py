@@ -0,0 +1,20 @@
+import pytest
+from shard import get_authkey, AUTHKEY_ENV
+
+def test_authkey_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv(AUTHKEY_ENV, 'secret')
+    assert get_authkey('10.1.2.3', create=True) == b'secret'
+    assert get_authkey('10.1.2.3') == b'secret'
+
+def test_no_authkey_refused_off_loopback(monkeypatch):
+    monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+    with pytest.raises(ValueError):
+        get_authkey('10.1.2.3', create=True)
+    with pytest.raises(ValueError):
+        get_authkey('localhost')
+
+def test_loopback_coordinator_makes_up_a_key_for_its_workers(monkeypatch):
+    monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+    key = get_authkey('localhost', create=True)
+    assert len(key) == 32
+    assert get_authkey('127.0.0.1') == key
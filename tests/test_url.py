@@ -0,0 +1,58 @@
+import asyncio
+from url import read_headers, read_body, fetch, ConnectionPool
+
+def reader(data: bytes, eof: bool = True) -> asyncio.StreamReader:
+    stream = asyncio.StreamReader()
+    stream.feed_data(data)
+    if eof:
+        stream.feed_eof()
+    return stream
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_read_headers():
+    async def read():
+        return await read_headers(reader(b'HTTP/1.1 301 Moved\r\nLocation: /login\r\nContent-Length: 0\r\n\r\nrest'), 1)
+    status_code, headers = run(read())
+    assert status_code == 301
+    assert headers == {'location': '/login', 'content-length': '0', 'http-version': 'HTTP/1.1'}
+
+def test_read_body_content_length():
+    async def read(data: bytes, expect: bytes):
+        return await read_body(reader(data, eof=False), {'content-length': '100'}, 1, expect)
+    assert run(read(b'0123456789' * 10, b'absent')) == (False, True)
+    # the first 20 bytes hold expect, so the other 80 are never waited for
+    assert run(read(b'0123456789' * 2, b'789')) == (True, False)
+
+def test_read_body_chunked():
+    body = b'5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n'
+    async def read(expect: bytes):
+        return await read_body(reader(body), {'transfer-encoding': 'chunked'}, 1, expect)
+    assert run(read(b'world')) == (True, False)
+    assert run(read(b'absent')) == (False, True)
+
+def test_read_body_stops_once_expect_is_seen():
+    async def read():
+        # the server never ends the body, so only an early stop returns
+        stream = reader(b'<html>status: OK', eof=False)
+        return await read_body(stream, {}, 1, b'OK')
+    assert run(read()) == (True, False)
+
+def test_fetch_stops_reading_at_expect():
+    async def serve(stream_reader, writer):
+        await stream_reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 1000000\r\n\r\nready' + b'.' * 1000)
+        await writer.drain()
+        # the rest of the body never comes
+
+    async def probe():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        pool = ConnectionPool()
+        try:
+            return await fetch(pool, f'http://127.0.0.1:{port}/', 'ready', read_timeout=1)
+        finally:
+            pool.close()
+            server.close()
+    assert run(probe()) == (200, True)
@@ -1,17 +1,36 @@
+import asyncio
+import ssl
 import requests
-from urllib.parse import urlparse
-from dataclasses import dataclass
+from urllib3.exceptions import NewConnectionError
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse, urljoin
+from dataclasses import dataclass, field
+from datetime import datetime
+from metrics import timed, retry
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+MAX_BODY = 256 * 1024
+DRAIN_LIMIT = 64 * 1024
+MAX_REDIRECTS = 5
+PER_HOST = 4
+REDIRECT_CODES = (301, 302, 303, 307, 308)
 
 @dataclass
 class Url:
     url: str
     is_running: bool = False
     status_code: int = 0
+    expect: str = ''
+    # no connection could be made, as opposed to a slow or broken answer
+    connect_failed: bool = field(default=False, repr=False)
+    probe: bool = field(default=True, repr=False)
 
     def __post_init__(self):
         if not self.is_valid():
             raise TypeError(f'Invalid URL: {self.url}')
-        self.update()
+        if self.probe:
+            self.update()
 
     def is_valid(self):
         min_attributes = ('scheme', 'netloc')
@@ -22,18 +41,232 @@ class Url:
     def check_url(self) -> bool:
         try:
             #Get Url
-            get = requests.get(self.url)
-            # if the request succeeds 
+            with timed('url', urlparse(self.url).hostname or '', 'execute'):
+                get = requests.get(self.url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            # if the request succeeds
             self.status_code = get.status_code
-            return get.status_code in [200]
+            return get.status_code in [200] and self.expect in get.text
         #Exception
         except requests.exceptions.RequestException as e:
             # print URL with Errs
             # raise SystemExit(f"{self.url}: is Not reachable \nErr: {e}")
+            self.connect_failed = is_connect_error(e)
             return False
 
     def update(self):
         self.is_running = self.check_url()
 
+def is_connect_error(error: requests.exceptions.RequestException) -> bool:
+    """ Whether requests failed to open a connection, rather than to read an answer """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if len(error.args) > 0 else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+class HttpError(Exception):
+    ...
+
+class ConnectFailed(ConnectionError):
+    """ No connection to the host could be opened """
+
+class ConnectionPool:
+    """ Keep-alive HTTP/1.1 connections shared by every probe of a host """
+    def __init__(self, per_host: int = PER_HOST, connect_timeout: float = CONNECT_TIMEOUT):
+        self.per_host = per_host
+        self.connect_timeout = connect_timeout
+        self.idle: Dict[tuple, list] = {}
+        self.limits: Dict[tuple, asyncio.Semaphore] = {}
+        self.ssl_context = ssl.create_default_context()
+
+    def limit(self, key: tuple) -> asyncio.Semaphore:
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.per_host)
+        return self.limits[key]
+
+    async def open(self, key: tuple) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """ Returns (reader, writer, reused) """
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        context = self.ssl_context if scheme == 'https' else None
+        with timed('url', host, 'connect'):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port, ssl=context, server_hostname=host if context else None),
+                    self.connect_timeout)
+            except ssl.SSLError:
+                # the host answered, with a certificate or protocol it should not have
+                raise
+            except (OSError, asyncio.TimeoutError) as e:
+                raise ConnectFailed(f'{host}:{port}: {e!r}') from e
+        return reader, writer, False
+
+    def release(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, keep: bool) -> None:
+        if keep and not writer.is_closing():
+            self.idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self) -> None:
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+def connection_key(url: str) -> tuple:
+    tokens = urlparse(url)
+    port = tokens.port or (443 if tokens.scheme == 'https' else 80)
+    return (tokens.scheme.lower(), tokens.hostname, port)
+
+async def read_headers(reader: asyncio.StreamReader, read_timeout: float) -> Tuple[int, Dict[str, str]]:
+    status_line = await asyncio.wait_for(reader.readline(), read_timeout)
+    if not status_line:
+        raise ConnectionResetError('Connection closed before the status line')
+    parts = status_line.decode('latin-1').split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise HttpError(f'Bad status line: {status_line!r}')
+    status_code = int(parts[1])
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), read_timeout)
+        line = line.decode('latin-1').strip()
+        if len(line) == 0:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    headers['http-version'] = parts[0]
+    return status_code, headers
+
+async def read_body(reader: asyncio.StreamReader, headers: Dict[str, str], read_timeout: float,
+                    expect: bytes = b'', limit: int = MAX_BODY) -> Tuple[bool, bool]:
+    """ Read at most limit bytes of the body, stopping early once expect is seen.
+        Returns (expect found, body fully consumed) """
+    body = b''
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while len(body) < limit:
+            size = await asyncio.wait_for(reader.readline(), read_timeout)
+            size = int(size.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                await asyncio.wait_for(reader.readline(), read_timeout)
+                return expect in body, True
+            body += await asyncio.wait_for(reader.readexactly(size + 2), read_timeout)
+            if expect and expect in body:
+                return True, False
+        return expect in body, False
+    if 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining > 0 and len(body) < limit:
+            chunk = await asyncio.wait_for(reader.read(min(remaining, 16 * 1024)), read_timeout)
+            if not chunk:
+                return expect in body, False
+            body += chunk
+            remaining -= len(chunk)
+            if expect and remaining > 0 and expect in body:
+                return True, False
+        return expect in body, remaining == 0
+    while len(body) < limit:
+        chunk = await asyncio.wait_for(reader.read(16 * 1024), read_timeout)
+        if not chunk:
+            break
+        body += chunk
+        if expect and expect in body:
+            break
+    return expect in body, False
+
+async def fetch(pool: ConnectionPool, url: str, expect: str = '', read_timeout: float = READ_TIMEOUT) -> Tuple[int, bool]:
+    """ GET url and return (status code, expect found), following redirects.
+        Only the status line and headers are read unless expect is set, and
+        then only as much of the body as it takes to find expect. """
+    for hop in range(MAX_REDIRECTS + 1):
+        key = connection_key(url)
+        tokens = urlparse(url)
+        path = tokens.path or '/'
+        if tokens.query:
+            path += f'?{tokens.query}'
+        host = tokens.netloc.rpartition('@')[-1]
+        request = (f'GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: systemsChecker\r\n'
+                   'Accept: */*\r\nConnection: keep-alive\r\n\r\n').encode('latin-1')
+        async with pool.limit(key):
+            for attempt in range(2):
+                try:
+                    reader, writer, reused = await pool.open(key)
+                except ConnectFailed as e:
+                    if hop == 0:
+                        raise
+                    # the probed host answered; only where it redirected to is down
+                    raise HttpError(f'Redirect to {url} failed: {e}') from e
+                try:
+                    with timed('url', key[1], 'execute'):
+                        writer.write(request)
+                        await writer.drain()
+                        status_code, headers = await read_headers(reader, read_timeout)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # an idle keep-alive connection may have been dropped by the server
+                    if not reused or attempt == 1:
+                        raise
+                    retry('url', key[1])
+                except BaseException:
+                    writer.close()
+                    raise
+            try:
+                keep = (headers.get('connection', '').lower() != 'close'
+                        and headers['http-version'] != 'HTTP/1.0')
+                found = False
+                if status_code in (204, 304) or 100 <= status_code < 200:
+                    pass
+                elif expect and status_code == 200:
+                    with timed('url', key[1], 'parse'):
+                        found, complete = await read_body(reader, headers, read_timeout, expect.encode())
+                    keep = keep and complete
+                elif headers.get('content-length', '') == '0':
+                    pass
+                elif 'content-length' in headers and int(headers['content-length']) <= DRAIN_LIMIT:
+                    _, complete = await read_body(reader, headers, read_timeout, limit=DRAIN_LIMIT)
+                    keep = keep and complete
+                else:
+                    keep = False
+            except BaseException:
+                pool.release(key, reader, writer, False)
+                raise
+            pool.release(key, reader, writer, keep)
+        if status_code in REDIRECT_CODES and 'location' in headers:
+            url = urljoin(url, headers['location'])
+            continue
+        return status_code, found or not expect
+    return status_code, False
+
+async def probe_urls(urls: List[Url], per_host: int = PER_HOST, connect_timeout: float = CONNECT_TIMEOUT,
+                     read_timeout: float = READ_TIMEOUT) -> List[Tuple[Url, datetime, datetime]]:
+    """ Probe every url concurrently, filling in status_code and is_running.
+        Returns (url, start, end) for each url, in order. """
+    pool = ConnectionPool(per_host, connect_timeout)
+
+    async def probe(url: Url) -> Tuple[Url, datetime, datetime]:
+        start_dt = datetime.now()
+        try:
+            url.status_code, found = await fetch(pool, url.url, url.expect, read_timeout)
+            url.is_running = url.status_code == 200 and found
+        except ConnectFailed:
+            url.is_running = False
+            url.connect_failed = True
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HttpError, ValueError):
+            url.is_running = False
+        return url, start_dt, datetime.now()
+
+    try:
+        return await asyncio.gather(*[probe(url) for url in urls])
+    finally:
+        pool.close()
+
+def check_urls(urls: List[Url], **kwargs) -> List[Tuple[Url, datetime, datetime]]:
+    """ Synchronous entry point for probe_urls """
+    return asyncio.run(probe_urls(urls, **kwargs))
+
 if __name__ == '__main__':
-    print(Url('https://nkpava02-1.nkparts.com:8443/AvalancheWeb/login.jsf'))
\ No newline at end of file
+    print(Url('https://nkpava02-1.nkparts.com:8443/AvalancheWeb/login.jsf'))